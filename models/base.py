@@ -1,24 +1,42 @@
-import copy
 import logging
+import os
+import shutil
+import tempfile
+import weakref
 import numpy as np
 import torch
 from torch import nn
-from torch.utils.data import DataLoader
-from utils.toolkit import tensor2numpy, accuracy
-from scipy.spatial.distance import cdist
+from utils.toolkit import tensor2numpy
+from utils.metrics import ConfusionMatrix, TaskAccuracyMatrix
+from utils.exemplar_store import ExemplarStore, CompressedExemplarStore
+from utils.disk_store import DiskArray, DiskRows, DiskExemplarStore, compact, new_file, spill
+from utils.synthesis_cache import SynthesisCache
+from utils.inversion import SynthesisScheduler
+from utils.herding import herding_selection_batch
+from utils.nme import NMEClassifier
+from utils.eval_policy import EvalPolicy
+from utils.feature_tracker import FeatureTracker
 
 EPSILON = 1e-8
 batch_size = 64
+# Feature extraction only runs inference, so it can use larger batches
+extract_batch_size = 256
 
 
 class BaseLearner(object):
+    # Learners whose loaders are built by get_batch_loader when batch_aug is set
+    supports_batch_aug = False
+    # Learners whose training loops call _track_features
+    supports_track_features = False
+
     def __init__(self, args):
         self._cur_task = -1
         self._known_classes = 0
         self._total_classes = 0
         self._network = None
         self._old_network = None
-        self._data_memory, self._targets_memory = np.array([]), np.array([])
+        self._nme = None
+        self._task_accuracy = TaskAccuracyMatrix()
         self.topk = 5
 
         self._memory_size = args['memory_size']
@@ -28,6 +46,81 @@ class BaseLearner(object):
         self._multiple_gpus = args['device']
         self._init_cls = args['init_cls']
         self._increment = args['increment']
+        # Optional: memory_codec ('png', 'webp', 'jpeg' or 'fp16') keeps exemplars encoded, memory_bytes budgets the
+        # memory in bytes instead of images (png unless a codec is given)
+        self._memory_bytes = args.get('memory_bytes')
+        codec = args.get('memory_codec', 'png' if self._memory_bytes is not None else None)
+        # Optional: memory_dir keeps exemplar images and the synthetic sets of learners that use _spill_rows in
+        # append-only files under that directory instead of RAM (in-memory datasets only)
+        self._memory_dir = args.get('memory_dir')
+        self._spill_disk = None
+        if self._memory_dir is not None:
+            if codec is not None:
+                raise ValueError('memory_dir and memory_codec/memory_bytes cannot be combined.')
+            if not os.path.exists(self._memory_dir):
+                os.makedirs(self._memory_dir)
+            self._memory_dir = tempfile.mkdtemp(prefix='memory_', dir=self._memory_dir)
+            weakref.finalize(self, shutil.rmtree, self._memory_dir, True)
+            self._memory = DiskExemplarStore(self._memory_dir)
+        elif codec is None:
+            self._memory = ExemplarStore()
+        else:
+            self._memory = CompressedExemplarStore(codec, quality=args.get('memory_quality', 90),
+                                                   downsample=args.get('memory_downsample', 2))
+        # Optional: augment whole batches as tensors instead of per-sample PIL transforms (in-memory datasets only)
+        self._batch_aug = args.get('batch_aug', False)
+        if self._batch_aug and not self.supports_batch_aug:
+            logging.warning('batch_aug is not supported by {}, using per-sample transforms.'.format(
+                type(self).__name__))
+        # Optional: fixed share of exemplars in every training batch, see ReplayBatchSampler
+        self._replay_ratio = args.get('replay_ratio')
+        # Optional: eval_every / eval_subsample / eval_async / eval_diagnostics, see EvalPolicy
+        self._eval_policy = EvalPolicy.from_args(args)
+        # Optional: collect features during the last N training epochs instead of extra extraction passes, see
+        # _track_features; track_clean_memory re-extracts only the exemplar rows, without augmentation
+        self._track_epochs = args.get('track_epoch_features', 0)
+        if self._track_epochs > 0 and not self.supports_track_features:
+            logging.warning('track_epoch_features is not supported by {}, extracting features after training.'.format(
+                type(self).__name__))
+            self._track_epochs = 0
+        self._track_clean_memory = args.get('track_clean_memory', False)
+        self._tracker = None
+        # Optional: pack the feature-inversion targets of all classes into batches of synthesis_batch images, see
+        # _scheduler (None: every class alone, in batches of the learner's batch_size)
+        self._synthesis_batch = args.get('synthesis_batch')
+        # Optional FeatureInverter settings: freeze an inverted sample after inversion_patience iterations without a
+        # relative improvement of inversion_tol (None: every sample runs all the iterations); optimize images
+        # inversion_coarse_factor times smaller before refining them at full resolution for the last
+        # inversion_fine_ratio of the iterations (1: full resolution throughout)
+        self._inversion_args = {'patience': args.get('inversion_patience'),
+                                'tol': args.get('inversion_tol', 1e-3),
+                                'coarse_factor': args.get('inversion_coarse_factor', 1),
+                                'fine_ratio': args.get('inversion_fine_ratio', 0.25)}
+        # Optional: directory of a content-addressed cache of synthesized batches, shared by runs, see SynthesisCache
+        self._synthesis_cache = SynthesisCache(args['synthesis_cache']) if args.get('synthesis_cache') else None
+        self._seed = args.get('seed')
+        # Optional: synthesize on a pool of synthesis_workers processes with synthesis_threads threads each (CPU
+        # only), see SynthesisScheduler.run
+        self._synthesis_workers = args.get('synthesis_workers', 0)
+        self._synthesis_threads = args.get('synthesis_threads', 1)
+
+    # _data_memory/_targets_memory are zero-copy views of the exemplar store. Assigning them (as learners that
+    # manage their memory by hand do) replaces the store content.
+    @property
+    def _data_memory(self):
+        return self._memory.data
+
+    @_data_memory.setter
+    def _data_memory(self, data):
+        self._memory.set_data(data)
+
+    @property
+    def _targets_memory(self):
+        return self._memory.targets
+
+    @_targets_memory.setter
+    def _targets_memory(self, targets):
+        self._memory.set_targets(targets)
 
     @property
     def exemplar_size(self):
@@ -50,12 +143,80 @@ class BaseLearner(object):
             return self._network.feature_dim
 
     def build_rehearsal_memory(self, data_manager, per_class):
+        if self._memory_bytes is not None:
+            per_class = self._samples_within_budget(data_manager)
+        self._memory.reserve(per_class * self._total_classes)
+        if self._tracker is not None and self._track_clean_memory and len(self._targets_memory) > 0:
+            self._clean_tracked_memory(data_manager)
         #self._fixed_memory: true (the number of examplars of each class is fixed)
         if self._fixed_memory:
             self._construct_exemplar_unified(data_manager, per_class)
         else:
             self._reduce_exemplar(data_manager, per_class)
             self._construct_exemplar(data_manager, per_class)
+        self._tracker = None
+        if isinstance(self._memory, DiskExemplarStore):
+            self._memory.compact()
+            logging.info('Exemplar memory: {:.1f} MB on disk under {}'.format(self._memory.nbytes() / 2**20,
+                                                                             self._memory_dir))
+        if isinstance(self._memory, CompressedExemplarStore):
+            logging.info('Exemplar memory: {:.1f} KB, bytes per class {}'.format(self._memory.nbytes() / 2**10,
+                                                                                  self._memory.class_nbytes()))
+
+    def _samples_within_budget(self, data_manager):
+        '''
+        Split memory_bytes evenly over the classes seen so far, shrink the old classes to their share, and
+        return how many exemplars of a new class are expected to fit in it, from the encoded size of a sample
+        of the new data. add_class trims every class to the budget anyway.
+        '''
+        class_budget = self._memory_bytes // self._total_classes
+        self._memory.set_class_budget(class_budget)
+        data, targets, _ = data_manager.get_dataset(np.arange(self._known_classes, self._total_classes),
+                                                    source='train', mode='test', ret_data=True)
+        sample = np.random.RandomState(self._cur_task).choice(len(data), min(64, len(data)), replace=False)
+        sample_nbytes = np.mean([image.nbytes for image in self._memory.encode(data[sample])])
+        per_class = int(min(class_budget // sample_nbytes, np.bincount(targets)[self._known_classes:].min()))
+        logging.info('{} bytes per class, about {} exemplars of {:.0f} bytes'.format(class_budget, per_class,
+                                                                                     sample_nbytes))
+
+        return max(per_class, 1)
+
+    def _spill_rows(self, data):
+        '''
+        Rows kept across tasks, such as synthesized images: a DiskRows view of an append-only file under
+        memory_dir when it is set, else data itself. File ids of path datasets stay in memory.
+        '''
+        if self._memory_dir is None or len(data) == 0 or np.ndim(data) < 2:
+            return data
+        if self._spill_disk is None:
+            data = np.asarray(data)
+            self._spill_disk = DiskArray(new_file(self._memory_dir, 'synthetic_'), data.shape[1:], data.dtype)
+        return spill(self._spill_disk, data)
+
+    def _append_rows(self, data, rows):
+        '''np.concatenate((data, rows)) for row sets; with memory_dir only the new rows are written.'''
+        if len(data) == 0 or len(rows) == 0:
+            return self._spill_rows(rows if len(data) == 0 else data)
+        data, rows = self._spill_rows(data), self._spill_rows(rows)
+        if not isinstance(data, DiskRows):
+            return np.concatenate((data, rows))
+        return DiskRows(self._spill_disk, np.concatenate((data.rows, rows.rows)))
+
+    def _compact_spilled(self, *names):
+        '''
+        Once most of the rows written by _spill_rows are superseded, copy the ones still held by the attributes
+        names into a new file and point the attributes at it.
+        '''
+        if self._spill_disk is None:
+            return
+        live = [name for name in names
+                if isinstance(getattr(self, name), DiskRows) and getattr(self, name).disk is self._spill_disk]
+        if self._spill_disk.length <= 2 * sum(len(getattr(self, name)) for name in live):
+            return
+        self._spill_disk, views = compact(self._spill_disk, [getattr(self, name) for name in live],
+                                          new_file(self._memory_dir, 'synthetic_'))
+        for name, view in zip(live, views):
+            setattr(self, name, view)
 
     def save_checkpoint(self, filename):
         self._network.cpu()
@@ -69,27 +230,41 @@ class BaseLearner(object):
         pass
 
     def _evaluate(self, y_pred, y_true):
+        confusion = ConfusionMatrix()
+        confusion.update(y_pred, y_true)
+
+        return self._evaluate_confusion(confusion)
+
+    def _evaluate_confusion(self, confusion):
         ret = {}
-        grouped = accuracy(y_pred.T[0], y_true, self._known_classes, self._init_cls, self._increment)
+        grouped = confusion.grouped(self._known_classes, self._init_cls, self._increment)
         ret['grouped'] = grouped
         ret['top1'] = grouped['total']
-        ret['top{}'.format(self.topk)] = np.around((y_pred.T == np.tile(y_true, (self.topk, 1))).sum()*100/len(y_true),
-                                                   decimals=2)
+        ret['top{}'.format(self.topk)] = confusion.topk_accuracy()
+        ret['mcr'] = np.around(confusion.mean_class_recall()*100, decimals=2)
 
         return ret
 
     def eval_task(self):
-        y_pred, y_true = self._eval_cnn(self.test_loader)
-        cnn_accy = self._evaluate(y_pred, y_true)
+        mean_banks = {'class_means': self._class_means} if hasattr(self, '_class_means') else {}
+        cnn_confusion, nme_confusions = self._eval_single_pass(self.test_loader, mean_banks)
+        cnn_accy = self._evaluate_confusion(cnn_confusion)
+        self._update_task_accuracy(cnn_confusion)
 
         if hasattr(self, '_class_means'):
-            y_pred, y_true = self._eval_nme(self.test_loader, self._class_means)
-            nme_accy = self._evaluate(y_pred, y_true)
+            nme_accy = self._evaluate_confusion(nme_confusions['class_means'])
         else:
             nme_accy = None
 
         return cnn_accy, nme_accy
 
+    def _update_task_accuracy(self, confusion):
+        # Row of the task-by-task accuracy matrix for the current task, from the CNN predictions
+        self._task_accuracy.update(confusion, self._total_classes)
+        logging.info('Task accuracy matrix:\n{}'.format(self._task_accuracy.matrix))
+        logging.info('Forgetting: {}, Backward transfer: {}'.format(self._task_accuracy.forgetting(),
+                                                                   self._task_accuracy.backward_transfer()))
+
     def incremental_train(self):
         pass
 
@@ -115,168 +290,226 @@ class BaseLearner(object):
 
         return np.around(tensor2numpy(correct)*100 / total, decimals=2)
 
-    def _eval_cnn(self, loader):
+    def _monitor_accuracy(self, model, loader, epoch, epochs, *args):
+        # Per-epoch test accuracy of the progress line, scheduled by the eval policy; epoch counts from 1
+        return self._eval_policy.evaluate(self._compute_accuracy, model, loader, epoch, epochs, *args)
+
+    def _eval_forward(self, inputs, targets):
+        # logits, features and targets of one test batch, overridden by networks that also take the labels
+        outputs = self._network(inputs)
+        return outputs['logits'], outputs['features'], targets
+
+    def _eval_single_pass(self, loader, mean_banks):
+        '''
+        One forward per test batch: CNN top-k from the logits, and NME top-k against every {bank name: class
+        means} in mean_banks from the features of that same forward.
+        Predictions are folded into confusion matrices batch by batch, nothing is kept per sample.
+        Returns the CNN ConfusionMatrix and {bank name: ConfusionMatrix}.
+        '''
         self._network.eval()
-        y_pred, y_true = [], []
-        for _, (_, inputs, targets) in enumerate(loader):
-            inputs = inputs.to(self._device)
+        for bank, class_means in mean_banks.items():
+            self._update_nme(bank, class_means)
+        cnn_confusion = ConfusionMatrix(self._total_classes)
+        nme_confusions = {bank: ConfusionMatrix(self._total_classes) for bank in mean_banks}
+        for _, inputs, targets in loader:
+            inputs, targets = inputs.to(self._device), targets.to(self._device)
             with torch.no_grad():
-                outputs = self._network(inputs)['logits']
-            predicts = torch.topk(outputs, k=self.topk, dim=1, largest=True, sorted=True)[1]  # [bs, topk]
-            y_pred.append(predicts.cpu().numpy())
-            y_true.append(targets.cpu().numpy())
-
-        return np.concatenate(y_pred), np.concatenate(y_true)  # [N, topk]
-
-    def _eval_nme(self, loader, class_means):
-        self._network.eval()
-        vectors, y_true = self._extract_vectors(loader)
-        vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
+                logits, features, targets = self._eval_forward(inputs, targets)
+            y_true = targets.cpu().numpy()
+            cnn_confusion.update(torch.topk(logits, k=self.topk, dim=1, largest=True, sorted=True)[1].cpu().numpy(),
+                                 y_true)
+            vectors = features / (features.norm(dim=1, keepdim=True) + EPSILON)
+            for bank in mean_banks:
+                nme_confusions[bank].update(self._nme.predict(bank, vectors, self.topk), y_true)
+
+        return cnn_confusion, nme_confusions
+
+    def _nme_topk(self, vectors, class_means, bank='class_means'):
+        return self._update_nme(bank, class_means).predict(bank, vectors, self.topk)
+
+    def _update_nme(self, bank, class_means):
+        # bank names the set of means (e.g. 'inverse_class_means') so each keeps its own device copy
+        if self._nme is None:
+            self._nme = NMEClassifier(self._device)
+        self._nme.update(bank, class_means)
+
+        return self._nme
+
+    def _track_features(self, idxes, features, targets, epoch, epochs):
+        '''
+        Called by training loops with the sample indexes, features and targets of every batch; epoch counts from
+        1. During the last track_epoch_features epochs the normalized features are kept, and exemplar
+        construction then reads them instead of extracting features again. They come from augmented views in
+        train mode, so they approximate the test-mode features of a separate pass.
+        '''
+        if self._track_epochs <= 0 or epoch <= epochs - self._track_epochs:
+            return
+        if self._tracker is None:
+            # Dropped once the memory of the task is built
+            self._tracker = FeatureTracker(self.feature_dim, self._device)
+        with torch.no_grad():
+            vectors = features / (features.norm(dim=1, keepdim=True) + EPSILON)
+        self._tracker.update(tensor2numpy(idxes) if torch.is_tensor(idxes) else idxes, vectors, targets)
+
+    def _tracked_vectors(self, targets, start=0):
+        # Tracked vectors of the training rows start.. if they are exactly the rows asked for, else None
+        if self._tracker is None:
+            return None
+        return self._tracker.rows_matching(targets, start)
 
-        dists = cdist(class_means, vectors, 'sqeuclidean')  # [nb_classes, N]
-        scores = dists.T  # [N, nb_classes], choose the one with the smallest distance
+    def _tracked_memory_start(self):
+        # Exemplar rows come after the new-class rows in the training set
+        return len(self._tracker) - len(self._targets_memory)
 
-        return np.argsort(scores, axis=1)[:, :self.topk], y_true  # [N, topk]
+    def _clean_tracked_memory(self, data_manager):
+        # One non-augmented pass over the exemplars, replacing their tracked vectors and their classes' means
+        start = self._tracked_memory_start()
+        if self._tracked_vectors(self._targets_memory, start) is None:
+            return
+        _, _, vectors = self._extract_normalized_vectors(data_manager, [], appendent=self._get_memory(),
+                                                         use_tracked=False)
+        self._tracker.replace(np.arange(start, len(self._tracker)), vectors)
 
     def _extract_vectors(self, loader):
+        # Features of the evaluation forward, so exemplar means and NME test features come from the same path
         self._network.eval()
         vectors, targets = [], []
         for _, _inputs, _targets in loader:
-            _targets = _targets.numpy()
-            if isinstance(self._network, nn.DataParallel):
-                _vectors = tensor2numpy(self._network.module.extract_vector(_inputs.to(self._device)))
-            else:
-                _vectors = tensor2numpy(self._network.extract_vector(_inputs.to(self._device)))
-
-            vectors.append(_vectors)
-            targets.append(_targets)
+            with torch.no_grad():
+                _, _vectors, _ = self._eval_forward(_inputs.to(self._device), _targets.to(self._device))
+            vectors.append(tensor2numpy(_vectors))
+            targets.append(_targets.numpy())
 
         return np.concatenate(vectors), np.concatenate(targets)
 
+    def _extract_normalized_vectors(self, data_manager, class_idxes, appendent=None, use_tracked=True):
+        '''
+        One pass, in test mode, over the train data of class_idxes followed by the rows of appendent (e.g. the
+        exemplar memory). Returns data, targets and L2-normalized vectors aligned row by row, so that herding,
+        exemplar means and old-class means are all served by a single forward pass per task.
+        No pass at all when the features of these rows were tracked during training.
+        '''
+        data, targets, _ = data_manager.get_dataset(class_idxes, source='train', mode='test', appendent=appendent,
+                                                    ret_data=True)
+        if len(targets) == 0:
+            return data, targets, np.zeros((0, self.feature_dim), dtype=np.float32)
+        vectors = self._tracked_vectors(targets) if use_tracked else None
+        if vectors is not None:
+            return data, targets, vectors
+        loader = data_manager.get_loader(class_idxes, source='train', mode='test', batch_size=extract_batch_size,
+                                         appendent=appendent)
+        vectors, _ = self._extract_vectors(loader)
+        vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
+
+        return data, targets, vectors
+
+    def _class_means_of(self, data_manager, appendent, class_idxes):
+        '''
+        [len(class_idxes), feature_dim] normalized means of the rows of every class of class_idxes in appendent
+        (a (data, targets) part or a list of them, such as the exemplar memory and synthesized images), from a
+        single extraction pass.
+        '''
+        means = np.zeros((len(class_idxes), self.feature_dim))
+        if len(class_idxes) == 0:
+            return means
+        _, targets, vectors = self._extract_normalized_vectors(data_manager, [], appendent=appendent,
+                                                               use_tracked=False)
+        for i, class_idx in enumerate(class_idxes):
+            mean = np.mean(vectors[targets == class_idx], axis=0)
+            means[i, :] = mean / np.linalg.norm(mean)
+
+        return means
+
+    def _scheduler(self, inverter, model, batch_size):
+        '''
+        SynthesisScheduler of the learner. By default every class is inverted in batches of at most batch_size, as
+        its per-class DataLoader did: the BN-statistics and image priors are batch losses, packing classes changes
+        them. With synthesis_batch set, the targets of all the classes are packed into batches of that size.
+        '''
+        if self._synthesis_batch is None:
+            return SynthesisScheduler(inverter, model, self._device, batch_size, pack_keys=False)
+        return SynthesisScheduler(inverter, model, self._device, self._synthesis_batch)
+
+    def _synthesize(self, scheduler, data_manager, class_idxes, appendent=None):
+        '''
+        Feature inversion of the train data of class_idxes followed by the rows of appendent (e.g. the selected
+        exemplars of several classes), packed across classes by scheduler. Returns {class_idx: synthesized
+        [N, C, H, W] batch in [0, 1]}, the rows of every class in dataset order.
+        '''
+        loader = data_manager.get_loader(class_idxes, source='train', mode='test', batch_size=extract_batch_size,
+                                         appendent=appendent)
+        for _, images, targets in loader:
+            targets = tensor2numpy(targets)
+            for class_idx in np.unique(targets):
+                scheduler.submit(int(class_idx), images[torch.from_numpy(targets == class_idx)])
+
+        return scheduler.run(self._synthesis_cache, self._seed, self._synthesis_workers, self._synthesis_threads)
+
     def _reduce_exemplar(self, data_manager, m):
         logging.info('Reducing exemplars...({} per classes)'.format(m))
-        dummy_data, dummy_targets = copy.deepcopy(self._data_memory), copy.deepcopy(self._targets_memory)
         self._class_means = np.zeros((self._total_classes, self.feature_dim))
-        self._data_memory, self._targets_memory = np.array([]), np.array([])
+        memory_vectors = None
+        if self._tracker is not None and self._known_classes > 0:
+            memory_vectors = self._tracked_vectors(self._targets_memory, self._tracked_memory_start())
+        if memory_vectors is not None:
+            # reduce keeps the first m exemplars of every class, take their tracked vectors before it runs
+            targets = self._targets_memory.copy()
+            kept = np.concatenate([np.flatnonzero(targets == class_idx)[:m]
+                                   for class_idx in range(self._known_classes)])
+            targets, vectors = targets[kept], memory_vectors[kept]
+            self._memory.reduce(m)
+        else:
+            self._memory.reduce(m)
+            _, targets, vectors = self._extract_normalized_vectors(data_manager, [], appendent=self._get_memory())
 
+        # Exemplar means
         for class_idx in range(self._known_classes):
-            mask = np.where(dummy_targets == class_idx)[0]
-            dd, dt = dummy_data[mask][:m], dummy_targets[mask][:m]
-            self._data_memory = np.concatenate((self._data_memory, dd)) if len(self._data_memory) != 0 else dd
-            self._targets_memory = np.concatenate((self._targets_memory, dt)) if len(self._targets_memory) != 0 else dt
-
-            # Exemplar mean
-            idx_dataset = data_manager.get_dataset([], source='train', mode='test', appendent=(dd, dt))
-            idx_loader = DataLoader(idx_dataset, batch_size=batch_size, shuffle=False, num_workers=4)
-            vectors, _ = self._extract_vectors(idx_loader)
-            vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
-            mean = np.mean(vectors, axis=0)
+            mean = np.mean(vectors[targets == class_idx], axis=0)
             mean = mean / np.linalg.norm(mean)
 
             self._class_means[class_idx, :] = mean
 
     def _construct_exemplar(self, data_manager, m):
         logging.info('Constructing exemplars...({} per classes)'.format(m))
-        for class_idx in range(self._known_classes, self._total_classes):
-            data, targets, idx_dataset = data_manager.get_dataset(np.arange(class_idx, class_idx+1), source='train',
-                                                                  mode='test', ret_data=True)
-            idx_loader = DataLoader(idx_dataset, batch_size=batch_size, shuffle=False, num_workers=4)
-            vectors, _ = self._extract_vectors(idx_loader)
-            vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
-            class_mean = np.mean(vectors, axis=0)
-
-            # Select
-            selected_exemplars = []
-            exemplar_vectors = []  # [n, feature_dim]
-            for k in range(1, m+1):
-                S = np.sum(exemplar_vectors, axis=0)  # [feature_dim] sum of selected exemplars vectors
-                mu_p = (vectors + S) / k  # [n, feature_dim] sum to all vectors
-                i = np.argmin(np.sqrt(np.sum((class_mean - mu_p) ** 2, axis=1)))
-                selected_exemplars.append(np.array(data[i]))  # New object to avoid passing by inference
-                exemplar_vectors.append(np.array(vectors[i]))  # New object to avoid passing by inference
-
-                vectors = np.delete(vectors, i, axis=0)  # Remove it to avoid duplicative selection
-                data = np.delete(data, i, axis=0)  # Remove it to avoid duplicative selection
-
-            # uniques = np.unique(selected_exemplars, axis=0)
-            # print('Unique elements: {}'.format(len(uniques)))
-            selected_exemplars = np.array(selected_exemplars)
-            exemplar_targets = np.full(m, class_idx)
-            self._data_memory = np.concatenate((self._data_memory, selected_exemplars)) if len(self._data_memory) != 0 \
-                else selected_exemplars
-            self._targets_memory = np.concatenate((self._targets_memory, exemplar_targets)) if \
-                len(self._targets_memory) != 0 else exemplar_targets
-
-            # Exemplar mean
-            idx_dataset = data_manager.get_dataset([], source='train', mode='test',
-                                                   appendent=(selected_exemplars, exemplar_targets))
-            idx_loader = DataLoader(idx_dataset, batch_size=batch_size, shuffle=False, num_workers=4)
-            vectors, _ = self._extract_vectors(idx_loader)
-            vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
-            mean = np.mean(vectors, axis=0)
-            mean = mean / np.linalg.norm(mean)
-
-            self._class_means[class_idx, :] = mean
+        new_classes = np.arange(self._known_classes, self._total_classes)
+        data, targets, vectors = self._extract_normalized_vectors(data_manager, new_classes)
+        self._herd_new_classes(new_classes, data, targets, vectors, m, self._class_means)
 
     def _construct_exemplar_unified(self, data_manager, m):
         logging.info('Constructing exemplars for new classes...({} per classes)'.format(m))
         _class_means = np.zeros((self._total_classes, self.feature_dim))
 
+        # New classes and current exemplars go through the newly trained network together
+        new_classes = np.arange(self._known_classes, self._total_classes)
+        data, targets, vectors = self._extract_normalized_vectors(data_manager, new_classes,
+                                                                  appendent=self._get_memory())
+
         # Calculate the means of old classes with newly trained network
         for class_idx in range(self._known_classes):
-            mask = np.where(self._targets_memory == class_idx)[0]
-            class_data, class_targets = self._data_memory[mask], self._targets_memory[mask]
-
-            class_dset = data_manager.get_dataset([], source='train', mode='test',
-                                                  appendent=(class_data, class_targets))
-            class_loader = DataLoader(class_dset, batch_size=batch_size, shuffle=False, num_workers=4)
-            vectors, _ = self._extract_vectors(class_loader)
-            vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
-            mean = np.mean(vectors, axis=0)
-            mean = mean / np.linalg.norm(mean)
+            mean = self._tracker.class_mean(class_idx) if self._tracker is not None else None
+            if mean is None:
+                mean = np.mean(vectors[targets == class_idx], axis=0)
+                mean = mean / np.linalg.norm(mean)
 
             _class_means[class_idx, :] = mean
 
         # Construct exemplars for new classes and calculate the means
-        for class_idx in range(self._known_classes, self._total_classes):
-            data, targets, class_dset = data_manager.get_dataset(np.arange(class_idx, class_idx+1), source='train',
-                                                                 mode='test', ret_data=True)
-            class_loader = DataLoader(class_dset, batch_size=batch_size, shuffle=False, num_workers=4)
-
-            vectors, _ = self._extract_vectors(class_loader)
-            vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
-            class_mean = np.mean(vectors, axis=0)
-
-            # Select
-            selected_exemplars = []
-            exemplar_vectors = []
-            for k in range(1, m+1):
-                S = np.sum(exemplar_vectors, axis=0)  # [feature_dim] sum of selected exemplars vectors
-                mu_p = (vectors + S) / k  # [n, feature_dim] sum to all vectors
-                i = np.argmin(np.sqrt(np.sum((class_mean - mu_p) ** 2, axis=1)))
-
-                selected_exemplars.append(np.array(data[i]))  # New object to avoid passing by inference
-                exemplar_vectors.append(np.array(vectors[i]))  # New object to avoid passing by inference
-
-                vectors = np.delete(vectors, i, axis=0)  # Remove it to avoid duplicative selection
-                data = np.delete(data, i, axis=0)  # Remove it to avoid duplicative selection
-
-            selected_exemplars = np.array(selected_exemplars)
-            exemplar_targets = np.full(m, class_idx)
-            self._data_memory = np.concatenate((self._data_memory, selected_exemplars)) if len(self._data_memory) != 0 \
-                else selected_exemplars
-            self._targets_memory = np.concatenate((self._targets_memory, exemplar_targets)) if \
-                len(self._targets_memory) != 0 else exemplar_targets
-
-            # Exemplar mean
-            exemplar_dset = data_manager.get_dataset([], source='train', mode='test',
-                                                     appendent=(selected_exemplars, exemplar_targets))
-            exemplar_loader = DataLoader(exemplar_dset, batch_size=batch_size, shuffle=False, num_workers=4)
-            vectors, _ = self._extract_vectors(exemplar_loader)
-            vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
-            mean = np.mean(vectors, axis=0)
-            mean = mean / np.linalg.norm(mean)
-
-            _class_means[class_idx, :] = mean
+        self._herd_new_classes(new_classes, data, targets, vectors, m, _class_means)
 
         self._class_means = _class_means
+
+    def _herd_new_classes(self, new_classes, data, targets, vectors, m, class_means):
+        # Select, all new classes in one batched herding call
+        class_rows = [np.flatnonzero(targets == class_idx) for class_idx in new_classes]
+        selections = herding_selection_batch([vectors[rows] for rows in class_rows], m, self._device)
+        for class_idx, rows, selected in zip(new_classes, class_rows, selections):
+            exemplar_rows = rows[selected]
+            self._memory.add_class(class_idx, data[exemplar_rows], np.full(m, class_idx))
+            # A byte budget may keep only a prefix of the selection
+            exemplar_rows = exemplar_rows[:len(self._memory.get_class(class_idx)[1])]
+
+            # Exemplar mean, the exemplar vectors were extracted with the same network and transforms
+            mean = np.mean(vectors[exemplar_rows], axis=0)
+            mean = mean / np.linalg.norm(mean)
+
+            class_means[class_idx, :] = mean
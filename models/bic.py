@@ -7,6 +7,7 @@ from torch.nn import functional as F
 from torch.utils.data import DataLoader
 from models.base import BaseLearner
 from utils.inc_net import IncrementalNetWithBias
+from utils.toolkit import tensor2numpy
 
 # ImageNet1000, ResNet18
 '''
@@ -107,6 +108,7 @@ class BiC(BaseLearner):
         for epoch in range(1, epochs+1):
             self._network.train()
             losses = 0.
+            correct, total = 0, 0
             for i, (_, inputs, targets) in enumerate(train_loader):
                 inputs, targets = inputs.to(self._device), targets.to(self._device)
                 logits = self._network(inputs)['logits']
@@ -131,9 +133,13 @@ class BiC(BaseLearner):
                 optimizer.step()
                 losses += loss.item()
 
+                _, preds = torch.max(logits, dim=1)
+                correct += preds.eq(targets.expand_as(preds)).cpu().sum()
+                total += len(targets)
+
             scheduler.step()
-            train_acc = self._compute_accuracy(self._network, train_loader)
-            test_acc = self._compute_accuracy(self._network, test_loader)
+            train_acc = np.around(tensor2numpy(correct)*100 / total, decimals=2)
+            test_acc = self._monitor_accuracy(self._network, test_loader, epoch, epochs)
             info = '{} => Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.3f}, Test_accy {:.3f}'.format(
                 stage, self._cur_task, epoch, epochs, losses/len(train_loader), train_acc, test_acc)
             logging.info(info)
@@ -126,7 +126,7 @@ class DR(BaseLearner):
             scheduler.step()
             # train_acc = self._compute_accuracy(self._network, train_loader)
             train_acc = np.around(tensor2numpy(correct)*100 / total, decimals=2)
-            test_acc = self._compute_accuracy(self._network, test_loader)
+            test_acc = self._monitor_accuracy(self._network, test_loader, epoch+1, epochs)
             info = 'Updated CNN => Epoch {}/{}, Loss {:.3f}, Train accy {:.2f}, Test accy {:.2f}'.format(
                 epoch+1, epochs, losses/len(train_loader), train_acc, test_acc)
             prog_bar.set_description(info)
@@ -146,6 +146,7 @@ class DR(BaseLearner):
         for _, epoch in enumerate(prog_bar):
             self.expert.train()
             losses = 0.
+            correct, total = 0, 0
             for i, (_, inputs, targets) in enumerate(train_loader):
                 inputs, targets = inputs.to(self._device), (targets - self._known_classes).to(self._device)
                 logits = self.expert(inputs)['logits']
@@ -153,13 +154,17 @@ class DR(BaseLearner):
                 loss = F.cross_entropy(logits, targets)
                 losses += loss.item()
 
+                _, preds = torch.max(logits, dim=1)
+                correct += preds.eq(targets.expand_as(preds)).cpu().sum()
+                total += len(targets)
+
                 optimizer.zero_grad()
                 loss.backward()
                 optimizer.step()
 
             scheduler.step()
-            train_acc = self._compute_accuracy(self.expert, train_loader, self._known_classes)
-            test_acc = self._compute_accuracy(self.expert, test_loader, self._known_classes)
+            train_acc = np.around(tensor2numpy(correct)*100 / total, decimals=2)
+            test_acc = self._monitor_accuracy(self.expert, test_loader, epoch+1, epochs_expert, self._known_classes)
             info = 'Expert CNN => Epoch {}/{}, Loss {:.3f}, Train accy {:.2f}, Test accy {:.2f}'.format(
                 epoch+1, epochs_expert, losses/len(train_loader), train_acc, test_acc)
             prog_bar.set_description(info)
@@ -175,7 +175,7 @@ class End2End(BaseLearner):
             scheduler.step()
             # train_acc = self._compute_accuracy(self._network, train_loader)
             train_acc = np.around(tensor2numpy(correct)*100 / total, decimals=2)
-            test_acc = self._compute_accuracy(self._network, test_loader)
+            test_acc = self._monitor_accuracy(self._network, test_loader, epoch, epochs_)
             info1 = '{} => '.format(process)
             info2 = 'Task {}, Epoch {}/{}, Loss {:.3f}, Train_accy {:.2f}, Test_accy {:.2f}'.format(
                 self._cur_task, epoch+1, epochs_, losses/len(train_loader), train_acc, test_acc)
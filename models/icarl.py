@@ -9,6 +9,7 @@ from torch.utils.data import DataLoader
 from models.base import BaseLearner
 from utils.inc_net import IncrementalNet
 from utils.toolkit import target2onehot, tensor2numpy
+from utils.data_manager import ReplayBatchSampler
 
 EPSILON = 1e-8
 
@@ -51,6 +52,8 @@ hyperparameters = ["epochs_init", "lrate_init", "milestones_init", "lrate_decay_
 
 
 class iCaRL(BaseLearner):
+    supports_batch_aug = True
+    supports_track_features = True
 
     def __init__(self, args):
         super().__init__(args)
@@ -75,11 +78,27 @@ class iCaRL(BaseLearner):
         logging.info('Learning on {}-{}'.format(self._known_classes, self._total_classes))
 
         # Loader
-        train_dataset = data_manager.get_dataset(np.arange(self._known_classes, self._total_classes), source='train',
-                                                 mode='train', appendent=self._get_memory())
-        self.train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
-        test_dataset = data_manager.get_dataset(np.arange(0, self._total_classes), source='test', mode='test')
-        self.test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+        if self._batch_aug:
+            self.train_loader = data_manager.get_batch_loader(np.arange(self._known_classes, self._total_classes),
+                                                              source='train', mode='train', batch_size=batch_size,
+                                                              shuffle=True, appendent=self._get_memory(),
+                                                              device=self._device)
+            self.test_loader = data_manager.get_batch_loader(np.arange(0, self._total_classes), source='test',
+                                                             mode='test', batch_size=batch_size, device=self._device)
+        else:
+            if self._replay_ratio is not None and self._cur_task > 0:
+                train_dataset = data_manager.get_dataset(np.arange(self._known_classes, self._total_classes),
+                                                         source='train', mode='train', appendent=self._get_memory())
+                self.train_loader = DataLoader(train_dataset, num_workers=num_workers,
+                                               batch_sampler=ReplayBatchSampler(train_dataset, batch_size,
+                                                                                self._replay_ratio))
+            else:
+                self.train_loader = data_manager.get_loader(np.arange(self._known_classes, self._total_classes),
+                                                            source='train', mode='train', batch_size=batch_size,
+                                                            shuffle=True, appendent=self._get_memory(),
+                                                            num_workers=num_workers)
+            self.test_loader = data_manager.get_loader(np.arange(0, self._total_classes), source='test', mode='test',
+                                                       batch_size=batch_size, num_workers=num_workers)
 
         # Procedure
         if len(self._multiple_gpus) > 1:
@@ -119,9 +138,11 @@ class iCaRL(BaseLearner):
             self._network.train()
             losses = 0.
             correct, total = 0, 0
-            for i, (_, inputs, targets) in enumerate(train_loader):
+            for i, (idxes, inputs, targets) in enumerate(train_loader):
                 inputs, targets = inputs.to(self._device), targets.to(self._device)
-                logits = self._network(inputs)['logits']
+                outputs = self._network(inputs)
+                logits = outputs['logits']
+                self._track_features(idxes, outputs['features'], targets, epoch+1, epochs_num)
                 onehots = target2onehot(targets, self._total_classes)
 
                 if self._old_network is None:
@@ -147,7 +168,7 @@ class iCaRL(BaseLearner):
             scheduler.step()
             # train_acc = self._compute_accuracy(self._network, train_loader)
             train_acc = np.around(tensor2numpy(correct)*100 / total, decimals=2)
-            test_acc = self._compute_accuracy(self._network, test_loader)
+            test_acc = self._monitor_accuracy(self._network, test_loader, epoch+1, epochs_num)
             info = 'Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.2f}, Test_accy {:.2f}'.format(
                 self._cur_task, epoch+1, epochs_num, losses/len(train_loader), train_acc, test_acc)
             prog_bar.set_description(info)
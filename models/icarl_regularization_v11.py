@@ -3,21 +3,19 @@ import numpy as np
 from numpy.core.fromnumeric import mean
 from tqdm import tqdm
 import torch
-import random
 import os
-import time
 import errno
 import copy
 from torch import nn
 from torch import optim
 from torch.nn import functional as F
 from torch.utils.data import DataLoader
-from torchvision.transforms import  transforms as T
 from models.base import BaseLearner
+from utils.inversion import FeatureInverter, to_uint8
 from utils.inc_net import IncrementalNet,Twobn_IncrementalNet
 from utils.toolkit import target2onehot, tensor2numpy
-from scipy.spatial.distance import cdist
 from utils.pgd_attack import create_attack
+from utils.herding import herding_selection
 from matplotlib import pyplot as plt
 
 EPSILON = 1e-8
@@ -62,19 +60,6 @@ hyperparameters = ["epochs_init", "lrate_init", "milestones_init", "lrate_decay_
                    "epochs","lrate", "milestones", "lrate_decay", "weight_decay","batch_size", "num_workers",\
                    "duplex", "iterations", "optim_type"]
 
-def get_image_prior_losses(inputs_jit):
-    # COMPUTE total variation regularization loss
-    diff1 = inputs_jit[:, :, :, :-1] - inputs_jit[:, :, :, 1:]
-    diff2 = inputs_jit[:, :, :-1, :] - inputs_jit[:, :, 1:, :]
-    diff3 = inputs_jit[:, :, 1:, :-1] - inputs_jit[:, :, :-1, 1:]
-    diff4 = inputs_jit[:, :, :-1, :-1] - inputs_jit[:, :, 1:, 1:]
-
-    loss_var_l2 = torch.norm(diff1) + torch.norm(diff2) + torch.norm(diff3) + torch.norm(diff4)
-    loss_var_l1 = (diff1.abs() / 255.0).mean() + (diff2.abs() / 255.0).mean() + (
-            diff3.abs() / 255.0).mean() + (diff4.abs() / 255.0).mean()
-    loss_var_l1 = loss_var_l1 * 255.0
-    return loss_var_l1, loss_var_l2
-
 class icarl_regularization_v11(BaseLearner):
     def __init__(self, args):
         print('create icarl_regularization_v10!!')
@@ -94,17 +79,16 @@ class icarl_regularization_v11(BaseLearner):
     def after_task(self):
         self._old_network = self._network.copy().freeze()
         self._known_classes = self._total_classes
+        self._compact_spilled('_inverse_data_memory', '_data_train_inverse')
         logging.info('Exemplar size: {}'.format(self.exemplar_size))
 
     def eval_task(self):
-        y_pred, y_true = self._eval_cnn(self.test_loader)
-        cnn_accy = self._evaluate(y_pred, y_true)
-
-        y_pred, y_true = self._eval_nme(self.test_loader, self._class_means)
-        nme_accy = self._evaluate(y_pred, y_true)
-
-        y_pred, y_true = self._eval_nme(self.test_loader, self._inverse_class_means)
-        inverse_nme_accy = self._evaluate(y_pred, y_true)
+        cnn_confusion, nme_confusions = self._eval_single_pass(self.test_loader, {
+            'class_means': self._class_means, 'inverse_class_means': self._inverse_class_means})
+        cnn_accy = self._evaluate_confusion(cnn_confusion)
+        self._update_task_accuracy(cnn_confusion)
+        nme_accy = self._evaluate_confusion(nme_confusions['class_means'])
+        inverse_nme_accy = self._evaluate_confusion(nme_confusions['inverse_class_means'])
 
         return cnn_accy, nme_accy, inverse_nme_accy
 
@@ -140,7 +124,8 @@ class icarl_regularization_v11(BaseLearner):
             else:
                 self._generator.to(self._device)
             self._get_train_inverse_data(data_manager=data_manager)
-            self._eval_generator(data_manager=data_manager)
+            if self._eval_policy.diagnostics:
+                self._eval_generator(data_manager=data_manager)
             train_inverse_dataset = data_manager.get_dataset(np.arange(self._known_classes, self._total_classes), source='train',
                                                     mode='train', appendent=self._get_train_inverse_memory())
             self.train_inverse_loader = DataLoader(train_inverse_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
@@ -154,7 +139,8 @@ class icarl_regularization_v11(BaseLearner):
         #update memory
         if self._total_classes != sum(data_manager._increments):
             self.build_rehearsal_memory(data_manager, self.samples_per_class)
-            self._eval_classifier(data_manager=data_manager)
+            if self._eval_policy.diagnostics:
+                self._eval_classifier(data_manager=data_manager)
 
         if len(self._multiple_gpus) > 1:
             self._network = self._network.module
@@ -334,7 +320,7 @@ class icarl_regularization_v11(BaseLearner):
 
             scheduler.step()
             train_acc = np.around(tensor2numpy(correct) * 100 / total, decimals=2)
-            test_acc = self._compute_accuracy(self._network, test_loader)
+            test_acc = self._monitor_accuracy(self._network, test_loader, epoch+1, epochs_num)
             info = 'Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.2f}, Test_accy {:.2f}'.format(
                 self._cur_task, epoch + 1, epochs_num, losses / len(train_loader), train_acc, test_acc)
             prog_bar.set_description(info)
@@ -375,7 +361,7 @@ class icarl_regularization_v11(BaseLearner):
 
             scheduler.step()
             train_acc = np.around(tensor2numpy(correct) * 100 / total, decimals=2)
-            test_acc = self._compute_accuracy(self._generator, test_loader)
+            test_acc = self._monitor_accuracy(self._generator, test_loader, epoch+1, epochs_num)
             info = 'Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.2f}, Test_accy {:.2f}'.format(
                 self._cur_task, epoch + 1, epochs_num, losses / len(train_loader), train_acc, test_acc)
             prog_bar.set_description(info)
@@ -399,56 +385,10 @@ class icarl_regularization_v11(BaseLearner):
 
         return np.around(tensor2numpy(correct)*100 / total, decimals=2)
 
-    def _eval_cnn(self, loader):
-        #my add
-        # self.topk = 1
-
-        self._network.eval()
-        y_pred, y_true = [], []
-        for _, (_, inputs, targets) in enumerate(loader):
-            inputs = inputs.to(self._device)
-            targets = targets.to(self._device)
-
-            with torch.no_grad():
-                ret_dict, targets = self._network(inputs, targets)
-                outputs = ret_dict['logits']
-            predicts = torch.topk(outputs, k=self.topk, dim=1, largest=True, sorted=True)[1]  # [bs, topk]
-            y_pred.append(predicts.cpu().numpy())
-            y_true.append(targets.cpu().numpy())
-
-        return np.concatenate(y_pred), np.concatenate(y_true)  # [N, topk]
-
-    def _eval_nme(self, loader, class_means):
-        self._network.eval()
-        vectors, y_true = self._extract_vectors(loader)
-        vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
-
-        dists = cdist(class_means, vectors, 'sqeuclidean')  # [nb_classes, N]
-        scores = dists.T  # [N, nb_classes], choose the one with the smallest distance
-
-        return np.argsort(scores, axis=1)[:, :self.topk], y_true  # [N, topk]
-
-    def _extract_vectors(self, loader):
-        self._network.eval()
-        vectors, targets = [], []
-        for _, _inputs, _targets in loader:
-            tmp = _targets.clone()
-            _targets = _targets.numpy()
-
-            if isinstance(self._network, nn.DataParallel):
-                _vectors = tensor2numpy(self._network.module.extract_vector(_inputs.to(self._device)))
-            else:
-                # _vectors = tensor2numpy(self._network.extract_vector(_inputs.to(self._device)))
-                ret_dict , _ = self._network(_inputs.to(self._device), tmp.to(self._device))
-                _vectors = ret_dict['features']
-                _vectors = tensor2numpy(_vectors)
-
-
-            vectors.append(_vectors)
-            targets.append(_targets)
+    def _eval_forward(self, inputs, targets):
+        ret_dict, targets = self._network(inputs, targets)
+        return ret_dict['logits'], ret_dict['features'], targets
 
-        return np.concatenate(vectors), np.concatenate(targets)
- 
     #reduce_exemplar and recalculate the mean
     def _reduce_exemplar(self, data_manager, m):
         logging.info('Reducing exemplars...({} per classes)'.format(m))
@@ -460,8 +400,7 @@ class icarl_regularization_v11(BaseLearner):
         for class_idx in range(self._known_classes):
             mask = np.where(dummy_targets == class_idx)[0]
             dd, dt = dummy_data[mask][:m], dummy_targets[mask][:m]
-            self._data_memory = np.concatenate((self._data_memory, dd)) if len(self._data_memory) != 0 else dd
-            self._targets_memory = np.concatenate((self._targets_memory, dt)) if len(self._targets_memory) != 0 else dt
+            self._memory.append(dd, dt)
             
             # Exemplar mean
             idx_dataset = data_manager.get_dataset([], source='train', mode='test', appendent=(dd, dt))
@@ -473,49 +412,28 @@ class icarl_regularization_v11(BaseLearner):
 
             self._class_means[class_idx, :] = mean
 
-            inverse_old_class_images_ = []
-            for _ , images , _ in idx_loader:
-                inverse_images_batch = self.rebuild_image_fv_bn(images.to(self._device), self._network.convnet, randstart=True)
-                inverse_images_batch = inverse_images_batch.detach().cpu().numpy().transpose(0,2,3,1)
-                inverse_images_batch = (inverse_images_batch*255).astype(np.uint8)
-                inverse_old_class_images_.extend(inverse_images_batch)
-
-            inverse_old_class_images_ = np.array(inverse_old_class_images_)
-            
-            self._inverse_data_memory = np.concatenate((self._inverse_data_memory, inverse_old_class_images_)) if \
-                len(self._inverse_data_memory) != 0 else inverse_old_class_images_
-            self._inverse_targets_memory = np.concatenate((self._inverse_targets_memory, dt)) if \
-                len(self._inverse_targets_memory) != 0 else dt
+        # Inverse images of the kept exemplars, packed across classes
+        if self._known_classes > 0:
+            inverse_images = self._synthesize(self._synthesizer(self._network.convnet), data_manager, [],
+                                              appendent=self._get_memory())
+            self._append_inverse_memory(inverse_images)
 
     def _construct_exemplar(self, data_manager, m):
         logging.info('Constructing exemplars...({} per classes)'.format(m))
+        selected_sets = []
         for class_idx in range(self._known_classes, self._total_classes):
             data, targets, idx_dataset = data_manager.get_dataset(np.arange(class_idx, class_idx+1), source='train',
                                                                     mode='test', ret_data=True)
             idx_loader = DataLoader(idx_dataset, batch_size=batch_size, shuffle=False, num_workers=4)
             vectors, _ = self._extract_vectors(idx_loader)
             vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
-            class_mean = np.mean(vectors, axis=0)
 
             # Select
-            selected_exemplars = []
-            exemplar_vectors = []  # [n, feature_dim]
-            for k in range(1, m+1):
-                S = np.sum(exemplar_vectors, axis=0)  # [feature_dim] sum of selected exemplars vectors
-                mu_p = (vectors + S) / k  # [n, feature_dim] sum to all vectors
-                i = np.argmin(np.sqrt(np.sum((class_mean - mu_p) ** 2, axis=1)))
-                selected_exemplars.append(np.array(data[i]))  # New object to avoid passing by inference
-                exemplar_vectors.append(np.array(vectors[i]))  # New object to avoid passing by inference
-
-                vectors = np.delete(vectors, i, axis=0)  # Remove it to avoid duplicative selection
-                data = np.delete(data, i, axis=0)  # Remove it to avoid duplicative selection
-
-            selected_exemplars = np.array(selected_exemplars)
+            selected = herding_selection(vectors, m, self._device)
+            selected_exemplars = data[selected]
             exemplar_targets = np.full(m, class_idx)
-            self._data_memory = np.concatenate((self._data_memory, selected_exemplars)) if len(self._data_memory) != 0 \
-                else selected_exemplars
-            self._targets_memory = np.concatenate((self._targets_memory, exemplar_targets)) if \
-                len(self._targets_memory) != 0 else exemplar_targets
+            self._memory.append(selected_exemplars, exemplar_targets)
+            selected_sets.append((selected_exemplars, exemplar_targets))
 
             # Exemplar mean
             idx_dataset = data_manager.get_dataset([], source='train', mode='test',
@@ -528,46 +446,40 @@ class icarl_regularization_v11(BaseLearner):
 
             self._class_means[class_idx, :] = mean
 
-            inverse_old_class_images_ = []
-            for _ , images , _ in idx_loader:
-                inverse_images_batch = self.rebuild_image_fv_bn(images.to(self._device), self._network.convnet, randstart=True)
-                inverse_images_batch = inverse_images_batch.detach().cpu().numpy().transpose(0,2,3,1)
-                inverse_images_batch = (inverse_images_batch*255).astype(np.uint8)
-                inverse_old_class_images_.extend(inverse_images_batch)
+        # Inverse images of the selected exemplars, packed across classes
+        inverse_images = self._synthesize(self._synthesizer(self._network.convnet), data_manager, [],
+                                          appendent=selected_sets)
+        self._append_inverse_memory(inverse_images)
 
-            inverse_old_class_images_ = np.array(inverse_old_class_images_)
-            
-            self._inverse_data_memory = np.concatenate((self._inverse_data_memory, inverse_old_class_images_)) if \
-                len(self._inverse_data_memory) != 0 else inverse_old_class_images_
-            self._inverse_targets_memory = np.concatenate((self._inverse_targets_memory, exemplar_targets)) if \
-                len(self._inverse_targets_memory) != 0 else exemplar_targets
+    def _append_inverse_memory(self, inverse_images):
+        for class_idx, images in inverse_images.items():
+            inverse_targets = np.full(len(images), class_idx)
+            self._inverse_data_memory = self._append_rows(self._inverse_data_memory, to_uint8(images))
+            self._inverse_targets_memory = np.concatenate((self._inverse_targets_memory, inverse_targets)) if \
+                len(self._inverse_targets_memory) != 0 else inverse_targets
 
     def _construct_exemplar_unified(self, data_manager, m):
         logging.info('Constructing exemplars for new classes...({} per classes)'.format(m))
         _class_means = np.zeros((self._total_classes, self.feature_dim))
         _inverse_class_means = np.zeros((self._total_classes, self.feature_dim))
 
-        # Calculate the means of old classes with newly trained network
+        # Calculate the means of old classes with newly trained network, from one pass over the memory followed by the
+        # inverse memory
+        nb_memory = len(self._targets_memory)
+        _, memory_targets, memory_vectors = self._extract_normalized_vectors(
+            data_manager, [], appendent=[(self._data_memory, self._targets_memory),
+                                         (self._inverse_data_memory, self._inverse_targets_memory)], use_tracked=False)
+        memory_targets, memory_vectors, memory_inverse_vectors = (memory_targets[:nb_memory], memory_vectors[:nb_memory],
+                                                                  memory_vectors[nb_memory:])
         for class_idx in range(self._known_classes):
-            mask = np.where(self._targets_memory == class_idx)[0]
-            class_data, class_targets = self._data_memory[mask], self._targets_memory[mask]
-            class_dset = data_manager.get_dataset([], source='train', mode='test',
-                                                  appendent=(class_data, class_targets))
-            class_loader = DataLoader(class_dset, batch_size=batch_size, shuffle=False, num_workers=4)
-            vectors, _ = self._extract_vectors(class_loader)
-            vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
+            vectors = memory_vectors[memory_targets == class_idx]
             mean = np.mean(vectors, axis=0)
             mean = mean / np.linalg.norm(mean)
 
             _class_means[class_idx, :] = mean
 
             inverse_mask = np.where(self._inverse_data_memory == class_idx)[0]
-            inverse_class_data, inverse_class_targets = self._inverse_data_memory[inverse_mask], self._inverse_targets_memory[inverse_mask]
-            inverse_class_dset = data_manager.get_dataset([], source='train', mode='test',
-                                                  appendent=(inverse_class_data, inverse_class_targets))
-            inverse_class_loader = DataLoader(inverse_class_dset, batch_size=batch_size, shuffle=False, num_workers=4)
-            inverse_vectors, _ = self._extract_vectors(inverse_class_loader)
-            inverse_vectors = (inverse_vectors.T / (np.linalg.norm(inverse_vectors.T, axis=0) + EPSILON)).T
+            inverse_vectors = memory_inverse_vectors[inverse_mask]
             inverse_mean = np.mean(np.concatenate((vectors, inverse_vectors), axis=0), axis=0)
             inverse_mean = inverse_mean / np.linalg.norm(inverse_mean)
 
@@ -575,38 +487,21 @@ class icarl_regularization_v11(BaseLearner):
 
 
 
-        # Construct exemplars for new classes and calculate the means
-        for class_idx in range(self._known_classes, self._total_classes):
-            data, targets, class_dset = data_manager.get_dataset(np.arange(class_idx, class_idx+1), source='train',
-                                                                 mode='test', ret_data=True)
-            class_loader = DataLoader(class_dset, batch_size=batch_size, shuffle=False, num_workers=4)
-            vectors, _ = self._extract_vectors(class_loader)
-            vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
-            class_mean = np.mean(vectors, axis=0)
+        # Construct exemplars for new classes and calculate the means, from one extraction pass over their train data
+        # and one over the inverse images of the task
+        new_classes = np.arange(self._known_classes, self._total_classes)
+        data, targets, class_vectors = self._extract_normalized_vectors(data_manager, new_classes)
+        _, _, train_inverse_vectors = self._extract_normalized_vectors(
+            data_manager, [], appendent=(self._data_train_inverse, self._targets_train_inverse), use_tracked=False)
+        for class_idx in new_classes:
+            rows = np.flatnonzero(targets == class_idx)
 
             # Select
-            selected_exemplars = []
-            exemplar_vectors = []
-
-            for k in range(1, m + 1):
-                S = np.sum(exemplar_vectors, axis=0)  # [feature_dim] sum of selected exemplars vectors
-                mu_p = (vectors + S) / k  # [n, feature_dim] sum to all vectors
-                i = np.argmin(np.sqrt(np.sum((class_mean - mu_p) ** 2, axis=1)))
-
-                selected_exemplars.append(np.array(data[i]))  # New object to avoid passing by inference
-                exemplar_vectors.append(np.array(vectors[i]))  # New object to avoid passing by inference
-                
-                vectors = np.delete(vectors, i, axis=0)  # Remove it to avoid duplicative selection
-                data = np.delete(data, i, axis=0)  # Remove it to avoid duplicative selection
-
-            selected_exemplars = np.array(selected_exemplars)
+            selected = rows[herding_selection(class_vectors[rows], m, self._device)]
+            selected_exemplars = data[selected]
             exemplar_targets = np.full(m, class_idx)
-            # Exemplar mean
-            exemplar_dset = data_manager.get_dataset([], source='train', mode='test',
-                                                     appendent=(selected_exemplars, exemplar_targets))
-            exemplar_loader = DataLoader(exemplar_dset, batch_size=batch_size, shuffle=False, num_workers=4)
-            vectors, _ = self._extract_vectors(exemplar_loader)
-            vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
+            # Exemplar mean, the exemplar vectors were extracted with the same network and transforms
+            vectors = class_vectors[selected]
             mean = np.mean(vectors, axis=0)
             mean = mean / np.linalg.norm(mean)
 
@@ -614,25 +509,16 @@ class icarl_regularization_v11(BaseLearner):
 
 
             inverse_mask = np.where(self._data_train_inverse == class_idx)[0]
-            inverse_class_data, inverse_class_targets = self._data_train_inverse[inverse_mask], self._targets_train_inverse[inverse_mask]
-            inverse_class_dset = data_manager.get_dataset([], source='train', mode='test',
-                                                  appendent=(inverse_class_data, inverse_class_targets))
-            inverse_class_loader = DataLoader(inverse_class_dset, batch_size=batch_size, shuffle=False, num_workers=4)
-            inverse_vectors, _ = self._extract_vectors(inverse_class_loader)
-            inverse_vectors = (inverse_vectors.T / (np.linalg.norm(inverse_vectors.T, axis=0) + EPSILON)).T
+            inverse_vectors = train_inverse_vectors[inverse_mask]
             inverse_mean = np.mean(np.concatenate((vectors, inverse_vectors), axis=0), axis=0)
             inverse_mean = inverse_mean / np.linalg.norm(inverse_mean)
 
             _inverse_class_means[class_idx, :] = inverse_mean
 
             # add to memory
-            self._data_memory = np.concatenate((self._data_memory, selected_exemplars)) if len(self._data_memory) != 0 \
-                else selected_exemplars
-            self._targets_memory = np.concatenate((self._targets_memory, exemplar_targets)) if \
-                len(self._targets_memory) != 0 else exemplar_targets
+            self._memory.append(selected_exemplars, exemplar_targets)
         
-        self._inverse_data_memory = np.concatenate((self._inverse_data_memory, self._data_train_inverse)) if len(self._inverse_data_memory) != 0 \
-                else copy.deepcopy(self._data_train_inverse)
+        self._inverse_data_memory = self._append_rows(self._inverse_data_memory, self._data_train_inverse)
         self._inverse_targets_memory = np.concatenate((self._inverse_targets_memory, self._targets_train_inverse)) if len(self._inverse_targets_memory) != 0 \
                 else copy.deepcopy(self._targets_train_inverse)
         
@@ -643,27 +529,14 @@ class icarl_regularization_v11(BaseLearner):
     def _get_train_inverse_data(self, data_manager):
         logging.info('Constructing inverse exemplars for new classes.')
         # get inverse image
-        exemplar_dset = data_manager.get_dataset(np.arange(self._known_classes, self._total_classes), source='train', mode='test',
-                                                    appendent=[])
-        exemplar_loader = DataLoader(exemplar_dset, batch_size=batch_size, shuffle=False, num_workers=4)
-
-        inverse_images_ = []
-        inverse_targets_ = []         
-
-        count = 0
-        for _ , images, targets in exemplar_loader:
-            #use generator to generate images
-            inverse_images_batch = self.rebuild_image_fv_bn(images.to(self._device), self._generator.convnet, randstart=True)
-            inverse_images_batch = inverse_images_batch.detach().cpu().numpy().transpose(0,2,3,1)
-            inverse_images_batch = (inverse_images_batch*255).astype(np.uint8)
-            inverse_images_.extend(inverse_images_batch)
-            inverse_targets_.extend(targets)
-            count += 1
-
-        inverse_images_ = np.array(inverse_images_)
-        inverse_targets_ = np.array(inverse_targets_)
-
-        self._data_train_inverse = inverse_images_
+        #use generator to generate images
+        inverse_images = self._synthesize(self._synthesizer(self._generator.convnet), data_manager,
+                                          np.arange(self._known_classes, self._total_classes))
+        inverse_images_ = np.concatenate([to_uint8(images) for images in inverse_images.values()])
+        inverse_targets_ = np.concatenate([np.full(len(images), class_idx)
+                                           for class_idx, images in inverse_images.items()])
+
+        self._data_train_inverse = self._spill_rows(inverse_images_)
         self._targets_train_inverse = inverse_targets_
         logging.info('Finishing constructing inverse exemplars for new classes. The number of exemplars is {}'.format(self._data_train_inverse.shape[0]))
 
@@ -675,96 +548,14 @@ class icarl_regularization_v11(BaseLearner):
                 logging.info('Return data for consistency regularization. The number of exemplars is {}'.format(self._data_train_inverse.shape[0]))
                 return (self._data_train_inverse, self._targets_train_inverse)
             else:
-                data_train = np.concatenate((self._data_train_inverse, self._data_memory, self._inverse_data_memory), axis=0)
-                targets_train = np.concatenate((self._targets_train_inverse, self._targets_memory, self._inverse_targets_memory), axis=0)
-                logging.info('Return data for consistency regularization. The number of exemplars is {}'.format(data_train.shape[0]))
-                return (data_train, targets_train)
-
-    def rebuild_image_fv_bn(self,image, model, randstart=True):
-        model.eval()
-        model.set_hook()
-        normalize = T.Normalize(mean=(0.5071, 0.4867, 0.4408),
-                                std=(0.2675, 0.2565, 0.2761))
-
-        with torch.no_grad():
-            # ori_fv = model.fv( image.to(device) )
-            ori_fv = model.fv(image)
-
-        def criterion(x, y):
-            rnd_fv = model.fv(normalize(x))
-            return torch.div(torch.norm(rnd_fv - ori_fv, dim=1), torch.norm(ori_fv, dim=1)).mean()
-
-
-
-        if randstart == True:
-            if len(image.shape) == 3:
-                rand_x = torch.randn_like(image.unsqueeze(0), requires_grad=True, device=self._device)
-            else:
-                rand_x = torch.randn_like(image, requires_grad=True, device=self._device)
-
-
-        start_time = time.time()
-        lr = 0.01
-        r_feature = 1e-3
-
-        lim_0 = 10
-        lim_1 = 10
-        var_scale_l2 = 1e-4
-        var_scale_l1 = 0.0
-        l2_scale = 1e-5
-        first_bn_multiplier = 1
-
-        loss_max = 1e4
-        best_img = None
-        optimizer = optim.Adam([rand_x], lr=lr, betas=[0.5, 0.9], eps=1e-8)
-        for i in range(iterations):
-            # roll
-            off1 = random.randint(-lim_0, lim_0)
-            off2 = random.randint(-lim_1, lim_1)
-            inputs_jit = torch.roll(rand_x, shifts=(off1, off2), dims=(2, 3))
-
-            # R_prior losses
-            loss_var_l1, loss_var_l2 = get_image_prior_losses(inputs_jit)
-
-            # l2 loss on images
-            loss_l2 = torch.norm(inputs_jit.view(inputs_jit.shape[0], -1), dim=1).mean()
-
-            # main loss
-            main_loss = criterion(inputs_jit, torch.tensor([0]))
-
-            # bn loss
-            if iterations == 600:
-                if i <= 200:
-                    r_feature = 1e-3
-                elif i <= 400:
-                    r_feature = 1e-2
-                elif i <= 600:
-                    r_feature = 5e-2
-            elif iterations == 2000:
-                if i <= 500:
-                    r_feature = 1e-3
-                elif i <= 1200:
-                    r_feature = 5e-3
-                elif i <= 2000:
-                    r_feature = 1e-2
-
-            rescale = [first_bn_multiplier] + [1. for _ in range(len(model.loss_r_feature_layers) - 1)]
-            loss_r_feature = sum(
-                [rescale[idx] * item.r_feature for idx, item in enumerate(model.loss_r_feature_layers)])
-            loss = main_loss + r_feature * loss_r_feature + var_scale_l2 * loss_var_l2 + var_scale_l1 * loss_var_l1 + l2_scale * loss_l2
-
-            optimizer.zero_grad()
-            loss.backward()
-
-            optimizer.step()
-            rand_x.data = torch.clamp(rand_x.data, 0, 1)
-            # if (i+1) % 100 == 0 :
-            #     print(i, 'rand_strat ', randstart)
-            #     print(
-            #         f'loss {loss:.3f} , fv_loss {main_loss:.3f} , loss_r_fea {loss_r_feature:.3f} , loss_l2 {loss_l2:.3f} , loss_var_l2 {loss_var_l2:.3f}')
-
-            best_img = rand_x.clone().detach()
-
-        print("inverse --- %s seconds ---" % (time.time() - start_time))
-        model.remove_hook()
-        return best_img
\ No newline at end of file
+                # Zero-copy: get_dataset indexes into every part instead of concatenating them
+                memory = [(self._data_train_inverse, self._targets_train_inverse),
+                          (self._data_memory, self._targets_memory),
+                          (self._inverse_data_memory, self._inverse_targets_memory)]
+                logging.info('Return data for consistency regularization. The number of exemplars is {}'.format(sum(len(targets) for _, targets in memory)))
+                return memory
+
+    def _synthesizer(self, model):
+        inverter = FeatureInverter(iterations, mean=(0.5071, 0.4867, 0.4408), std=(0.2675, 0.2565, 0.2761),
+                                   **self._inversion_args)
+        return self._scheduler(inverter, model, batch_size)
\ No newline at end of file
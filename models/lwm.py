@@ -138,7 +138,7 @@ class LwM(BaseLearner):
             scheduler.step()
             # train_acc = self._compute_accuracy(self._network, train_loader)
             train_acc = np.around(tensor2numpy(correct)*100 / total, decimals=2)
-            test_acc = self._compute_accuracy(self._network, test_loader)
+            test_acc = self._monitor_accuracy(self._network, test_loader, epoch, epochs)
             info1 = 'Task {}, Epoch {}/{} => clf_loss {:.2f}, '.format(self._cur_task, epoch, epochs, clf_losses/(i+1))
             info2 = 'distill_loss {:.2f}, attention_loss {:.2f}, Train_accy {:.2f}, Test_accy {:.2f}'.format(
                 distill_losses/(i+1), attention_losses/(i+1), train_acc, test_acc)
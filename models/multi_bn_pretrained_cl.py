@@ -104,7 +104,7 @@ class multi_bn_pretrained_cl(BaseLearner):
 
     def after_task(self):
         self._known_classes = self._total_classes
-        # weighted_accs = self.caculate_weighted_average(self._init_cls, self._increment, self._task_acc)
+        # weighted_accs = weighted_task_average(self._task_acc, self._init_cls, self._increment)
         # logging.info(50*"-")
         # logging.info("log_accs")
         # logging.info(50*"-")
@@ -389,20 +389,3 @@ class multi_bn_pretrained_cl(BaseLearner):
                 y_b = tmp
             label_index = int(((2 * self._cur_class - y_a - 1) * y_a) / 2 + (y_b - y_a) - 1)
         return label_index + self._total_classes
-    
-    def caculate_weighted_average(self, init_class, increment, task_acc):
-        weighted_accs = []
-        class_each_step = []
-        for i in range(len(task_acc)):
-            if i == 0:
-                class_each_step.append(init_class)
-            else:
-                class_each_step.append(increment)
-        class_each_step = np.array(class_each_step)
-        task_acc = np.array(task_acc)
-
-        for i in range(len(task_acc)):
-            temp_acc = class_each_step[:i+1] / sum(class_each_step[:i+1])
-            weighted_accs.append(round(sum(task_acc[:i+1] * temp_acc), 2))
-        
-        return weighted_accs
\ No newline at end of file
@@ -9,7 +9,6 @@ from torch.utils.data import DataLoader
 from utils.inc_net import IncrementalNet
 from models.base import BaseLearner
 from utils.toolkit import tensor2numpy
-from scipy.spatial.distance import cdist
 from utils.toolkit import tensor2numpy, accuracy
 
 EPSILON = 1e-8
@@ -171,7 +170,7 @@ class multibn_cl(BaseLearner):
             scheduler.step()
             # train_acc = self._compute_accuracy(self._network, train_loader)
             train_acc = np.around(tensor2numpy(correct)*100 / total, decimals=2)
-            test_acc = self._compute_accuracy(self._network, test_loader)
+            test_acc = self._monitor_accuracy(self._network, test_loader, epoch, epochs_)
             info1 = '{} => '.format(process)
             info2 = 'Task {}, Epoch {}/{}, Loss {:.3f}, Train_accy {:.2f}, Test_accy {:.2f}'.format(
                 self._cur_task, epoch+1, epochs_, losses/len(train_loader), train_acc, test_acc)
@@ -254,10 +253,7 @@ class multibn_cl(BaseLearner):
         vectors, y_true = self._extract_vectors(loader)
         vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
 
-        dists = cdist(class_means, vectors, 'sqeuclidean')  # [nb_classes, N]
-        scores = dists.T  # [N, nb_classes], choose the one with the smallest distance
-
-        return np.argsort(scores, axis=1)[:, :self.topk], y_true  # [N, topk]
+        return self._nme_topk(vectors, class_means), y_true  # [N, topk]
 
     def _extract_vectors(self, loader):
         self._network.eval()
@@ -133,7 +133,7 @@ class PODNet(BaseLearner):
 
             scheduler.step()
             train_acc = np.around(tensor2numpy(correct)*100 / total, decimals=2)
-            test_acc = self._compute_accuracy(self._network, test_loader)
+            test_acc = self._monitor_accuracy(self._network, test_loader, epoch, epochs)
             info1 = 'Task {}, Epoch {}/{} => '.format(self._cur_task, epoch, epochs)
             info2 = 'LSC_loss {:.2f}, Spatial_loss {:.2f}, Flat_loss {:.2f}, Train_acc {:.2f}, Test_acc {:.2f}'.format(
                 lsc_losses/(i+1), spatial_losses/(i+1), flat_losses/(i+1), train_acc, test_acc)
@@ -177,7 +177,7 @@ class UCIR(BaseLearner):
             scheduler.step()
             # train_acc = self._compute_accuracy(self._network, train_loader)
             train_acc = np.around(tensor2numpy(correct)*100 / total, decimals=2)
-            test_acc = self._compute_accuracy(self._network, test_loader)
+            test_acc = self._monitor_accuracy(self._network, test_loader, epoch, epochs)
             info1 = 'Task {}, Epoch {}/{} => '.format(self._cur_task, epoch, epochs)
             info2 = 'CE_loss {:.3f}, LF_loss {:.3f}, IS_loss {:.3f}, Train_accy {:.2f}, Test_accy {:.2f}'.format(
                 ce_losses/(i+1), lf_losses/(i+1), is_losses/(i+1), train_acc, test_acc)
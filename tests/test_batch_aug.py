@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+from torchvision import transforms
+from utils.batch_aug import BatchAugment, BatchLoader
+
+_MEAN, _STD = (0.5071, 0.4867, 0.4408), (0.2675, 0.2565, 0.2761)
+
+
+def _images(n=6, size=8, seed=0):
+    return np.random.RandomState(seed).randint(0, 256, (n, size, size, 3)).astype(np.uint8)
+
+
+def _per_sample(trsf_list, images):
+    # The torchvision pipeline DummyDataset runs on every PIL image
+    trsf = transforms.Compose(trsf_list)
+    return torch.stack([trsf(Image.fromarray(image)) for image in images])
+
+
+@pytest.mark.parametrize('trsf_list', [
+    [transforms.ToTensor(), transforms.Normalize(_MEAN, _STD)],
+    [transforms.RandomHorizontalFlip(p=1.), transforms.ToTensor(), transforms.Normalize(_MEAN, _STD)],
+    [transforms.RandomCrop(8), transforms.RandomHorizontalFlip(p=0.), transforms.ToTensor()],
+    [transforms.ColorJitter(brightness=(0.6, 0.6)), transforms.ToTensor(), transforms.Normalize(_MEAN, _STD)],
+])
+def test_matches_torchvision_when_deterministic(trsf_list):
+    torch.manual_seed(0)
+    images = _images()
+    out = BatchAugment(trsf_list)(torch.from_numpy(images))
+    expected = _per_sample(trsf_list, images)
+    assert out.dtype == torch.float32 and out.shape == (6, 3, 8, 8)
+    # PIL rounds the brightness result to uint8
+    assert torch.allclose(out, expected, atol=1.01 / 255 / min(_STD))
+
+
+def test_random_crop_and_flip_ranges():
+    torch.manual_seed(0)
+    images = _images(n=32)
+    out = BatchAugment([transforms.RandomCrop(8, padding=2), transforms.RandomHorizontalFlip(),
+                        transforms.ToTensor()])(torch.from_numpy(images))
+    assert out.shape == (32, 3, 8, 8) and out.min() >= 0 and out.max() <= 1
+    padded = np.pad(images, ((0, 0), (2, 2), (2, 2), (0, 0)))
+    flips = []
+    for i in range(32):
+        crops = {(y, x, flip): torch.from_numpy(np.ascontiguousarray(
+                     padded[i, y:y+8, x:x+8][:, ::-1] if flip else padded[i, y:y+8, x:x+8])).permute(2, 0, 1) / 255.
+                 for y in range(5) for x in range(5) for flip in (False, True)}
+        # Every output is one of the valid crops of the zero-padded image, flipped or not
+        matches = [key for key, crop in crops.items() if torch.equal(crop, out[i])]
+        assert len(matches) > 0
+        flips.append(matches[0][2])
+    assert 0 < sum(flips) < 32
+
+
+def test_same_seed_same_batch():
+    trsf_list = [transforms.RandomCrop(8, padding=2), transforms.RandomHorizontalFlip(),
+                 transforms.ColorJitter(brightness=63 / 255), transforms.ToTensor(), transforms.Normalize(_MEAN, _STD)]
+    images = torch.from_numpy(_images())
+    torch.manual_seed(3)
+    first = BatchAugment(trsf_list)(images)
+    torch.manual_seed(3)
+    assert torch.equal(first, BatchAugment(trsf_list)(images))
+
+
+def test_unsupported_transform():
+    with pytest.raises(NotImplementedError):
+        BatchAugment([transforms.RandomRotation(10), transforms.ToTensor()])
+
+
+def test_batch_loader():
+    images, labels = _images(n=10), np.arange(10) % 3
+    trsf_list = [transforms.ToTensor(), transforms.Normalize(_MEAN, _STD)]
+    loader = BatchLoader(images, labels, trsf_list, batch_size=4, shuffle=True)
+    assert len(loader) == 3
+    expected = _per_sample(trsf_list, images)
+    seen = []
+    for idx, inputs, targets in loader:
+        assert inputs.dtype == torch.float32 and targets.dtype == torch.int64
+        assert torch.allclose(inputs, expected[idx], atol=1e-6)
+        assert torch.equal(targets, torch.from_numpy(labels)[idx])
+        seen.extend(idx.tolist())
+    assert sorted(seen) == list(range(10))
@@ -0,0 +1,120 @@
+import numpy as np
+import utils.data_manager as data_manager
+from utils.data import iCIFAR10
+
+
+class _FakeCIFAR(iCIFAR10):
+    # 10 classes of 6 train and 2 test images, the value of every image is its index
+    def download_data(self):
+        self.train_data = np.repeat(np.arange(60, dtype=np.uint8), 4 * 4 * 3).reshape(60, 4, 4, 3)
+        self.train_targets = np.repeat(np.arange(10), 6)
+        self.test_data = np.repeat(np.arange(20, dtype=np.uint8), 4 * 4 * 3).reshape(20, 4, 4, 3)
+        self.test_targets = np.repeat(np.arange(10), 2)
+
+
+def _manager(monkeypatch, **kwargs):
+    monkeypatch.setattr(data_manager, '_get_idata', lambda name: _FakeCIFAR())
+    kwargs.setdefault('num_workers', 0)
+    return data_manager.DataManager('cifar10', False, 0, 5, 5, **kwargs)
+
+
+def test_persistent_pools_by_num_workers(monkeypatch):
+    manager = _manager(monkeypatch, persistent_workers=True)
+    loader = manager.get_loader([0, 1], 'train', 'test', batch_size=4)
+    assert manager.get_loader([2], 'train', 'test', batch_size=4, num_workers=0)._pool is loader._pool
+    # Another num_workers is not silently served by the pool of the default one
+    other = manager.get_loader([2], 'train', 'test', batch_size=4, num_workers=1)
+    assert other._pool is not loader._pool
+    assert sorted(manager._pools) == [0, 1]
+    targets = np.concatenate([targets.numpy() for _, _, targets in loader])
+    assert np.array_equal(targets, np.repeat([0, 1], 6))
+
+
+def _baseline_rows(y, low, high):
+    # DataManager._select before the class index
+    return np.where(np.logical_and(y >= low, y < high))[0]
+
+
+def test_class_index_matches_baseline_selection():
+    y = np.random.RandomState(0).randint(0, 8, 200)
+    y[y == 5] = 6  # class 5 has no rows
+    class_index = data_manager._build_class_index(y, 10)
+    for indices in ([0], [3, 4, 5], [7, 2, 6], [5], [8, 9], list(range(10))):
+        expected = np.concatenate([_baseline_rows(y, idx, idx + 1) for idx in indices])
+        assert np.array_equal(data_manager._select_rows(class_index, indices), expected)
+    # A contiguous range holds the rows of a low/high selection, grouped by class like get_dataset always did
+    assert np.array_equal(np.sort(data_manager._select_rows(class_index, range(2, 6))), _baseline_rows(y, 2, 6))
+    rows = data_manager._select_rows(class_index, [])
+    assert rows.dtype == np.int64 and len(rows) == 0
+
+
+def test_split_rows_matches_baseline_split():
+    y = np.random.RandomState(1).randint(0, 4, 100)
+    class_index = data_manager._build_class_index(y, 6)
+    np.random.seed(2)
+    train_rows, val_rows = data_manager._split_rows(class_index, [0, 2, 3], 5)
+    # Baseline get_dataset_with_split: the same draws, made on the np.where rows of every class
+    np.random.seed(2)
+    for idx, start in zip([0, 2, 3], range(0, 15, 5)):
+        class_rows = _baseline_rows(y, idx, idx + 1)
+        val_indx = np.random.choice(len(class_rows), 5, replace=False)
+        assert np.array_equal(val_rows[start:start+5], class_rows[val_indx])
+        train = train_rows[np.isin(train_rows, class_rows)]
+        assert np.array_equal(train, np.setdiff1d(class_rows, class_rows[val_indx]))
+    assert len(train_rows) + len(val_rows) == np.isin(y, [0, 2, 3]).sum()
+
+    # Empty classes, or no val samples, leave everything in train
+    train_rows, val_rows = data_manager._split_rows(class_index, [4, 1], 0)
+    assert np.array_equal(train_rows, _baseline_rows(y, 1, 2)) and len(val_rows) == 0
+    train_rows, val_rows = data_manager._split_rows(class_index, [], 3)
+    assert len(train_rows) == len(val_rows) == 0
+
+
+def _memory(values, targets):
+    return np.repeat(np.asarray(values, dtype=np.uint8), 4 * 4 * 3).reshape(-1, 4, 4, 3), np.asarray(targets)
+
+
+def test_composite_dataset_indexes_new_data_then_memory(monkeypatch):
+    manager = _manager(monkeypatch)
+    exemplars, synthetic = _memory([200, 201, 202], [0, 0, 1]), _memory([250, 251], [2, 3])
+    dataset = manager.get_dataset([4, 3], 'train', 'test', appendent=[exemplars, synthetic, _memory([], [])])
+    assert isinstance(dataset, data_manager.CompositeDataset) and len(dataset) == 17
+    # Zero-copy: the dataset holds the arrays it was given, not copies
+    assert dataset.sources[0][0] is manager._train_data
+    assert dataset.sources[1][0] is exemplars[0] and dataset.sources[2][0] is synthetic[0]
+    dataset.trsf = lambda image: np.asarray(image)[0, 0, 0]
+    values = [int(dataset[i][1]) for i in range(len(dataset))]
+    assert values == list(range(24, 30)) + list(range(18, 24)) + [200, 201, 202, 250, 251]
+    labels = [4] * 6 + [3] * 6 + [0, 0, 1, 2, 3]
+    assert [int(dataset[i][2]) for i in range(len(dataset))] == labels
+    assert dataset.labels.tolist() == labels
+    assert [dataset[i][0] for i in range(len(dataset))] == list(range(17))
+
+
+def test_replay_sampler_composition_and_epoch_length(monkeypatch):
+    manager = _manager(monkeypatch)
+    dataset = manager.get_dataset([5, 6, 7], 'train', 'train', appendent=[_memory(range(100, 105), [0] * 5),
+                                                                          _memory(range(110, 112), [1, 1])])
+    sampler = data_manager.ReplayBatchSampler(dataset, batch_size=8, replay_ratio=0.25)
+    new = set(np.flatnonzero(dataset.source_ids == 0).tolist())
+    old = set(np.flatnonzero(dataset.source_ids != 0).tolist())
+    # 18 new-class samples, 6 per batch: 3 batches of 6 new and 2 replayed samples
+    assert (sampler.nb_new, sampler.nb_old) == (6, 2) and len(sampler) == 3
+    for _ in range(3):
+        batches = list(sampler)
+        assert len(batches) == len(sampler)
+        assert all(len(batch) == 8 and len(new.intersection(batch)) == 6 for batch in batches)
+        # Every new-class sample once per epoch, the replayed ones cycle through the 7 memory rows
+        assert sorted(i for batch in batches for i in batch if i in new) == sorted(new)
+        replayed = [i for batch in batches for i in batch if i in old]
+        assert len(replayed) == 6 and len(set(replayed[:6])) == 6
+
+    # An uneven last batch keeps its replayed samples
+    sampler = data_manager.ReplayBatchSampler(dataset, batch_size=8, replay_ratio=0.5)
+    batches = list(sampler)
+    assert len(sampler) == len(batches) == 5
+    assert [len(new.intersection(batch)) for batch in batches] == [4, 4, 4, 4, 2]
+    assert all(len(old.intersection(batch)) == 4 for batch in batches)
+    # Without memory every batch is new-class data
+    plain = manager.get_dataset([5], 'train', 'train')
+    assert [len(batch) for batch in data_manager.ReplayBatchSampler(plain, 4, 0.5)] == [4, 2]
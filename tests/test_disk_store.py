@@ -0,0 +1,67 @@
+import copy
+import pickle
+import numpy as np
+from utils.disk_store import DiskArray, DiskExemplarStore, DiskRows, compact, spill
+
+
+def _images(n, value, size=4):
+    return np.full((n, size, size, 3), value, dtype=np.uint8)
+
+
+def test_disk_array_round_trip(tmp_path):
+    rng = np.random.RandomState(0)
+    data = rng.randint(0, 256, (50, 4, 4, 3)).astype(np.uint8)
+    disk = DiskArray(str(tmp_path / 'rows.bin'), (4, 4, 3), np.uint8, page_rows=8, cache_pages=2)
+    assert np.array_equal(disk.append(data[:20]), np.arange(20))
+    disk.get(19)  # caches the partially filled last page
+    disk.append(data[20:])
+    assert np.array_equal(disk.take(np.arange(50)), data)
+    assert np.array_equal(disk.take([49, 3, 17]), data[[49, 3, 17]])
+    # Workers map the file themselves
+    assert np.array_equal(pickle.loads(pickle.dumps(disk)).take(np.arange(50)), data)
+    assert copy.deepcopy(disk) is disk
+
+
+def test_disk_rows_views(tmp_path):
+    data = np.arange(10 * 2).reshape(10, 2).astype(np.float32)
+    disk = DiskArray(str(tmp_path / 'rows.bin'), (2,), np.float32)
+    view = spill(disk, data)
+    assert spill(disk, view) is view
+    assert view.shape == (10, 2) and view.nbytes == data.nbytes
+    assert np.array_equal(view[3], data[3])
+    assert np.array_equal(np.asarray(view[2:5]), data[2:5])
+    assert np.array_equal(np.asarray(view[data[:, 0] > 10]), data[data[:, 0] > 10])
+
+    # Masked assignment appends the new rows and remaps the view, the other views keep the old rows
+    part = view[:4]
+    view[np.array([1, 3])] = np.full((2, 2), -1, dtype=np.float32)
+    assert disk.length == 12
+    expected = data.copy()
+    expected[[1, 3]] = -1
+    assert np.array_equal(np.asarray(view), expected)
+    assert np.array_equal(np.asarray(part), data[:4])
+
+    new_disk, (new_view,) = compact(disk, [view], str(tmp_path / 'compact.bin'))
+    assert new_disk.length == 10 and np.array_equal(np.asarray(new_view), expected)
+
+
+def test_disk_exemplar_store(tmp_path):
+    store = DiskExemplarStore(str(tmp_path / 'memory'), page_rows=4)
+    for class_idx in range(3):
+        store.add_class(class_idx, _images(5, class_idx))
+    assert isinstance(store.data, DiskRows) and len(store) == 15
+    store.add_class(1, _images(2, 9))
+    store.reduce(3)
+    assert store.classes == [0, 1, 2]
+    assert np.array_equal(store.get_class(1)[0], _images(2, 9))
+    assert np.array_equal(store.get_class(2)[0], _images(3, 2))
+    assert store.class_nbytes() == {0: 3 * 48, 1: 2 * 48, 2: 3 * 48}
+
+    store.replace_rows(store.targets == 0, _images(3, 7))
+    assert np.array_equal(store.get_class(0)[0], _images(3, 7))
+    assert np.array_equal(store.get_class(2)[0], _images(3, 2))
+
+    # Superseded rows are reclaimed
+    store.compact()
+    assert store._disk.length == len(store) == 8
+    assert np.array_equal(np.asarray(store.data), np.concatenate((_images(3, 7), _images(2, 9), _images(3, 2))))
@@ -0,0 +1,46 @@
+import math
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import DataLoader
+from utils.data_manager import DummyDataset
+from utils.eval_policy import EvalPolicy
+
+
+def _compute(model, loader):
+    return float(len(loader.dataset))
+
+
+def _loader(labels):
+    images = np.zeros((len(labels), 4, 4, 3), dtype=np.uint8)
+    return DataLoader(DummyDataset(images, np.asarray(labels), lambda x: torch.zeros(1), False), batch_size=8)
+
+
+def test_eval_every():
+    policy = EvalPolicy(every=2)
+    loader = _loader(np.arange(10))
+    assert math.isnan(policy.evaluate(_compute, None, loader, 1, 5))
+    assert policy.evaluate(_compute, None, loader, 2, 5) == 10
+    # The last epoch is always evaluated
+    assert policy.evaluate(_compute, None, loader, 5, 5) == 10
+    with pytest.raises(ValueError):
+        EvalPolicy(every=0)
+
+
+def test_stratified_subsample():
+    policy = EvalPolicy(subsample=3)
+    loader = _loader(np.repeat(np.arange(4), [5, 2, 6, 3]))
+    monitor = policy._monitor_loader(loader)
+    labels = np.asarray(loader.dataset.labels)[monitor.dataset.indices]
+    assert np.array_equal(np.bincount(labels), [3, 2, 3, 3])
+    assert policy._monitor_loader(loader) is monitor
+    # Full test set on the last epoch
+    assert policy.evaluate(_compute, None, loader, 4, 4) == 16
+
+
+def test_async_reports_finished_evaluations():
+    policy = EvalPolicy(async_eval=True)
+    loader = _loader(np.arange(6))
+    assert math.isnan(policy.evaluate(_compute, torch.nn.Linear(1, 1), loader, 1, 3))
+    assert policy.evaluate(_compute, torch.nn.Linear(1, 1), loader, 2, 3) == 6
+    assert policy.evaluate(_compute, torch.nn.Linear(1, 1), loader, 3, 3) == 6
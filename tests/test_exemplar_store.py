@@ -0,0 +1,68 @@
+import numpy as np
+from utils.exemplar_store import ExemplarStore
+
+
+def _images(n, value):
+    return np.full((n, 4, 4, 3), value, dtype=np.uint8)
+
+
+def _reference_memory(store_classes, m=None):
+    # Exemplar memory as the learners built it before the store: one concatenation per class
+    data, targets = np.zeros((0, 4, 4, 3), dtype=np.uint8), np.zeros(0, dtype=np.int64)
+    for class_idx, n in store_classes:
+        data = np.concatenate((data, _images(n, class_idx)[:m]))
+        targets = np.concatenate((targets, np.full(len(_images(n, class_idx)[:m]), class_idx)))
+    return data, targets
+
+
+def test_add_class_and_reduce():
+    store = ExemplarStore()
+    store.reserve(20)
+    for class_idx in range(4):
+        store.add_class(class_idx, _images(5, class_idx))
+    data, targets = _reference_memory([(c, 5) for c in range(4)])
+    assert np.array_equal(store.data, data) and np.array_equal(store.targets, targets)
+
+    store.reduce(3)
+    data, targets = _reference_memory([(c, 5) for c in range(4)], m=3)
+    assert np.array_equal(store.data, data) and np.array_equal(store.targets, targets)
+    assert store.classes == [0, 1, 2, 3]
+    assert store.class_nbytes() == {c: 3 * 48 for c in range(4)}
+
+
+def test_add_class_replaces_existing_rows():
+    store = ExemplarStore()
+    for class_idx in range(3):
+        store.add_class(class_idx, _images(4, class_idx))
+    store.add_class(1, _images(2, 9), np.full(2, 1))
+    data, targets = store.get_class(1)
+    assert np.array_equal(data, _images(2, 9)) and np.array_equal(targets, [1, 1])
+    assert len(store) == 10
+    store.add_class(0, _images(6, 7))
+    assert np.array_equal(store.get_class(0)[0], _images(6, 7))
+    assert np.array_equal(store.get_class(2)[0], _images(4, 2))
+
+
+def test_assignment_like_learners():
+    store = ExemplarStore()
+    store.set_data(_images(6, 1))
+    store.set_targets(np.repeat([0, 1], 3))
+    store.append(_images(2, 5), np.array([2, 2]))
+    assert len(store) == 8
+    # Truncation through a prefix view keeps the buffer
+    store.set_data(store.data[:-2])
+    store.set_targets(store.targets[:-2])
+    assert len(store) == 6 and np.array_equal(store.targets, [0, 0, 0, 1, 1, 1])
+
+
+def test_replace_rows():
+    store = ExemplarStore()
+    caller_data = _images(6, 1)
+    store.set_data(caller_data)
+    store.set_targets(np.repeat([0, 1], 3))
+    mask = store.targets == 1
+    store.replace_rows(mask, _images(3, 8))
+    assert np.array_equal(store.get_class(1)[0], _images(3, 8))
+    assert np.array_equal(store.get_class(0)[0], _images(3, 1))
+    # The array handed in is not written to
+    assert np.array_equal(caller_data, _images(6, 1))
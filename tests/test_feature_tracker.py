@@ -0,0 +1,28 @@
+import numpy as np
+import torch
+from utils.feature_tracker import FeatureTracker
+
+
+def test_running_means_over_batches():
+    rng = np.random.RandomState(0)
+    vectors = rng.randn(40, 6).astype(np.float32)
+    targets = rng.randint(0, 3, 40)
+    tracker = FeatureTracker(6)
+    for start in range(0, 40, 7):
+        idxes = np.arange(start, min(start + 7, 40))
+        tracker.update(idxes, torch.from_numpy(vectors[idxes]), torch.from_numpy(targets[idxes]))
+    for class_idx in range(3):
+        mean = vectors[targets == class_idx].mean(0)
+        assert np.allclose(tracker.class_mean(class_idx), mean / np.linalg.norm(mean), atol=1e-5)
+    assert tracker.class_mean(5) is None
+    assert np.array_equal(tracker.rows_matching(targets[10:20], 10), vectors[10:20])
+    assert tracker.rows_matching(targets[10:20] + 1, 10) is None
+    assert tracker.rows_matching(targets[30:], 35) is None
+
+
+def test_replace_recomputes_class_means():
+    tracker = FeatureTracker(2)
+    tracker.update(np.arange(4), torch.tensor([[1., 0.], [1., 0.], [0., 1.], [0., 1.]]), torch.tensor([0, 0, 1, 1]))
+    tracker.replace(np.array([1]), np.array([[0., 1.]], dtype=np.float32))
+    assert np.allclose(tracker.class_mean(0), np.array([1., 1.]) / np.sqrt(2))
+    assert np.allclose(tracker.class_mean(1), [0., 1.])
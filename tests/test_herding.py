@@ -0,0 +1,40 @@
+import numpy as np
+from utils.herding import herding_selection, herding_selection_batch
+
+
+def _reference_herding(vectors, m):
+    # The original per-class loop of BaseLearner._construct_exemplar, returning row indexes of vectors
+    class_mean = np.mean(vectors, axis=0)
+    rows = np.arange(len(vectors))
+    selected, exemplar_vectors = [], []
+    for k in range(1, m+1):
+        S = np.sum(exemplar_vectors, axis=0)
+        mu_p = (vectors + S) / k
+        i = np.argmin(np.sqrt(np.sum((class_mean - mu_p) ** 2, axis=1)))
+        selected.append(rows[i])
+        exemplar_vectors.append(np.array(vectors[i]))
+        vectors = np.delete(vectors, i, axis=0)
+        rows = np.delete(rows, i, axis=0)
+    return np.array(selected)
+
+
+def _normalized(rng, n, dim):
+    vectors = rng.randn(n, dim)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def test_herding_matches_reference():
+    rng = np.random.RandomState(0)
+    for n, m in [(40, 10), (25, 25), (60, 1)]:
+        vectors = _normalized(rng, n, 16)
+        assert np.array_equal(herding_selection(vectors, m), _reference_herding(vectors, m))
+
+
+def test_herding_batch_of_uneven_classes():
+    rng = np.random.RandomState(1)
+    vectors_list = [_normalized(rng, n, 8) for n in (30, 12, 45)]
+    selected = herding_selection_batch(vectors_list, 12)
+    for vectors, indices in zip(vectors_list, selected):
+        assert len(np.unique(indices)) == 12
+        assert np.array_equal(indices, _reference_herding(vectors, 12))
+    assert herding_selection_batch([], 5) == []
@@ -0,0 +1,96 @@
+import os
+import time
+import numpy as np
+from PIL import Image
+import utils.data_manager as data_manager
+from utils.data import iImageNet100
+from utils.image_cache import ImageCache, parallel_map, _decode_resized
+
+
+def _slow_square(x):
+    # Early items finish last, so an unordered map would return them out of order
+    time.sleep(0.02 if x % 3 == 0 else 0)
+    return x * x
+
+
+def test_parallel_map_keeps_order():
+    items = list(range(20))
+    expected = [x * x for x in items]
+    assert list(parallel_map(_slow_square, items, num_workers=1)) == expected
+    assert list(parallel_map(_slow_square, iter(items), num_workers=2, chunksize=1)) == expected
+    assert list(parallel_map(_slow_square, [], num_workers=2)) == []
+
+
+def _save(path, value, size):
+    Image.fromarray(np.full(size + (3,), value, dtype=np.uint8)).save(path)
+    return path
+
+
+def _images(root, nb=6):
+    # Sizes (h, w) below and above the short side, targets deliberately not grouped by class
+    sizes = [(8, 12), (24, 16), (16, 16), (40, 20), (10, 10), (20, 30)]
+    paths = [_save(os.path.join(root, '{}.png'.format(i)), 10 * i, sizes[i]) for i in range(nb)]
+    return paths, np.arange(nb) % 2
+
+
+def test_cache_hits_and_misses(tmp_path):
+    paths, targets = _images(str(tmp_path))
+    cache_dir = str(tmp_path / 'cache')
+    assert not ImageCache.exists(cache_dir)
+    ImageCache.build(paths, targets, cache_dir, short_side=12, num_workers=1)
+    assert ImageCache.exists(cache_dir)
+    cache = ImageCache(cache_dir)
+    assert len(cache) == 6 and all(path in cache for path in paths)
+    # Rows are grouped by class, stable within a class
+    assert cache.rows_of(paths).tolist() == [0, 3, 1, 4, 2, 5]
+    expected = [_decode_resized((path, 12)) for path in paths]
+    assert [min(image.shape[:2]) for image in expected] == [8, 12, 12, 12, 10, 12]
+
+    # Later reads come from the cache, not from the files
+    for path in paths:
+        _save(path, 255, (4, 4))
+    for i, path in enumerate(paths):
+        assert np.array_equal(np.asarray(cache(path)), expected[i])
+        assert np.array_equal(cache.get(cache.rows_of([path])[0]), expected[i])
+    # Paths outside of the cache are decoded from disk
+    extra = _save(str(tmp_path / 'extra.png'), 99, (5, 7))
+    assert extra not in cache and cache.rows_of([extra, paths[1]]).tolist() == [-1, 3]
+    assert np.asarray(cache(extra)).shape == (5, 7, 3)
+
+
+class _FakeImageNet(iImageNet100):
+    class_order = [0, 1]
+    paths, targets = None, None
+
+    def download_data(self):
+        self.train_data, self.train_targets = np.array(self.paths[:-2]), self.targets[:-2]
+        self.test_data, self.test_targets = np.array(self.paths[-2:]), self.targets[-2:]
+
+
+def _manager(monkeypatch, paths, targets):
+    monkeypatch.setattr(_FakeImageNet, 'paths', paths)
+    monkeypatch.setattr(_FakeImageNet, 'targets', targets)
+    monkeypatch.setattr(data_manager, '_get_idata', lambda name: _FakeImageNet())
+    return data_manager.DataManager('imagenet100', False, 0, 1, 1, image_cache_size=12, num_workers=0)
+
+
+def test_cache_is_rebuilt_when_paths_are_missing(tmp_path, monkeypatch):
+    monkeypatch.setenv('DATASETCACHE', str(tmp_path / 'cache'))
+    builds = []
+    build = ImageCache.build
+    monkeypatch.setattr(ImageCache, 'build', staticmethod(
+        lambda paths, *args, **kwargs: builds.append(len(paths)) or build(paths, *args, num_workers=1)))
+    paths, targets = _images(str(tmp_path))
+
+    manager = _manager(monkeypatch, paths[:5], targets[:5])
+    assert builds == [5]
+    # Another run over the same paths reuses the cache
+    manager = _manager(monkeypatch, paths[:5], targets[:5])
+    assert builds == [5]
+    # A path the cache does not hold invalidates it
+    manager = _manager(monkeypatch, paths, targets)
+    assert builds == [5, 6]
+    cache_dir = str(tmp_path / 'cache' / 'imagenet100_12')
+    assert len(ImageCache(cache_dir)) == 6
+    for file_id, path in enumerate(paths):
+        assert np.array_equal(np.asarray(manager._loader(file_id)), _decode_resized((path, 12)))
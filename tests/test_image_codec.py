@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from utils.exemplar_store import CompressedExemplarStore
+from utils.image_codec import EncodedImage, decode_rows, encode_image, to_pil
+
+
+def _image(seed=0, size=16):
+    return np.random.RandomState(seed).randint(0, 256, (size, size, 3)).astype(np.uint8)
+
+
+@pytest.mark.parametrize('codec', ['png', 'webp'])
+def test_lossless_round_trip(codec):
+    image = _image()
+    encoded = encode_image(image, codec)
+    assert encoded.nbytes == len(encoded.payload)
+    assert np.array_equal(np.asarray(encoded.decode()), image)
+
+
+@pytest.mark.parametrize('codec', ['jpeg', 'fp16'])
+def test_lossy_round_trip(codec):
+    image = np.tile(np.linspace(0, 255, 16, dtype=np.uint8)[:, None, None], (1, 16, 3))
+    decoded = np.asarray(encode_image(image, codec, quality=95, downsample=2).decode())
+    assert decoded.shape == image.shape
+    assert np.abs(decoded.astype(np.int64) - image).mean() < 12
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        encode_image(_image(), 'gif')
+
+
+def test_decode_rows():
+    images = np.stack([_image(i) for i in range(3)])
+    assert decode_rows(images) is images
+    encoded = np.empty(3, dtype=object)
+    encoded[:] = [encode_image(image) for image in images]
+    assert np.array_equal(decode_rows(encoded), images)
+    assert np.array_equal(np.asarray(to_pil(images[0])), images[0])
+
+
+def test_compressed_store_round_trip():
+    images = np.stack([_image(i) for i in range(6)])
+    store = CompressedExemplarStore('png')
+    store.add_class(0, images[:3])
+    store.append(images[3:], np.array([1, 1, 1]))
+    assert store.data.dtype == object and isinstance(store.data[0], EncodedImage)
+    assert np.array_equal(decode_rows(store.data), images)
+    assert store.nbytes() == sum(image.nbytes for image in store.data) + store.targets.nbytes
+    # File ids of path-based datasets are kept as they are
+    ids = CompressedExemplarStore().encode(np.arange(3))
+    assert list(ids) == [0, 1, 2]
+
+
+def test_compressed_store_budget_and_replace_rows():
+    images = np.stack([_image(i) for i in range(8)])
+    store = CompressedExemplarStore('png')
+    store.add_class(0, images[:4])
+    store.add_class(1, images[4:])
+    row_nbytes = max(store.class_nbytes().values()) // 4
+    store.set_class_budget(3 * row_nbytes)
+    assert all(nbytes <= 3 * row_nbytes for nbytes in store.class_nbytes().values())
+    nb_kept = len(store.get_class(1)[0])
+    assert np.array_equal(decode_rows(store.get_class(1)[0]), images[4:4+nb_kept])
+
+    # Re-synthesized rows are encoded and the byte accounting follows them
+    flat = np.zeros((nb_kept, 16, 16, 3), dtype=np.uint8)
+    store.replace_rows(store.targets == 1, flat)
+    assert np.array_equal(decode_rows(store.get_class(1)[0]), flat)
+    assert store.class_nbytes()[1] == sum(encode_image(image).nbytes for image in flat)
+    assert np.array_equal(decode_rows(store.get_class(0)[0]), images[:len(store.get_class(0)[0])])
@@ -0,0 +1,103 @@
+import math
+import random
+import torch
+from torch import nn
+from utils.inversion import FeatureInverter, get_image_prior_losses, get_sample_prior_losses
+
+
+class _BNHook(object):
+    def __init__(self, module):
+        self.hook = module.register_forward_hook(self.hook_fn)
+
+    def hook_fn(self, module, input, output):
+        mean = input[0].mean([0, 2, 3])
+        var = input[0].transpose(0, 1).flatten(1).var(1, unbiased=False)
+        self.r_feature = torch.norm(module.running_var - var, 2) + torch.norm(module.running_mean - mean, 2)
+
+    def close(self):
+        self.hook.remove()
+
+
+class _Net(nn.Module):
+    # The interface FeatureInverter expects from a convnet: fv() and BN hooks set by set_hook()
+    def __init__(self):
+        super().__init__()
+        self.conv = nn.Conv2d(3, 4, 3, padding=1)
+        self.bn = nn.BatchNorm2d(4)
+        self.loss_r_feature_layers = []
+
+    def fv(self, x):
+        return torch.relu(self.bn(self.conv(x))).mean([2, 3])
+
+    def set_hook(self):
+        self.loss_r_feature_layers.append(_BNHook(self.bn))
+
+    def remove_hook(self):
+        for hook in self.loss_r_feature_layers:
+            hook.close()
+        self.loss_r_feature_layers = []
+
+
+def _invert(inverter, model, targets, seed=0):
+    random.seed(seed)
+    torch.manual_seed(seed)
+    return inverter.invert(model, targets)
+
+
+def test_sample_priors_sum_to_batch_priors():
+    x = torch.rand(5, 3, 6, 6)
+    l1, l2 = get_image_prior_losses(x)
+    sample_l1, sample_l2 = get_sample_prior_losses(x)
+    assert sample_l1.shape == sample_l2.shape == (5,)
+    assert torch.allclose(sample_l1.mean(), l1, rtol=1e-5)
+    assert torch.all(sample_l2 <= l2)
+
+
+def test_inversion_in_range_and_deterministic():
+    torch.manual_seed(0)
+    model = _Net().eval()
+    model.set_hook()
+    targets = torch.rand(4, 3, 8, 8)
+    inverter = FeatureInverter(5, jitter=1)
+    images = _invert(inverter, model, targets)
+    assert images.shape == targets.shape
+    assert images.min() >= 0 and images.max() <= 1
+    assert torch.equal(images, _invert(inverter, model, targets))
+    coarse = FeatureInverter(6, jitter=2, coarse_factor=2, fine_ratio=0.5)
+    assert _invert(coarse, model, targets).shape == targets.shape
+
+
+def test_patience_shrinks_the_batch():
+    torch.manual_seed(0)
+    model = _Net().eval()
+    model.set_hook()
+    targets = torch.rand(8, 3, 8, 8)
+    sizes = []
+    model.bn.register_forward_hook(lambda module, input, output: sizes.append(len(input[0])))
+    images = _invert(FeatureInverter(60, jitter=1, patience=3, tol=0.05), model, targets)
+    assert images.shape == targets.shape and images.min() >= 0 and images.max() <= 1
+    # The target features, then one forward per iteration on the samples not frozen yet, until all are
+    assert sizes[0] == 8 and sizes[1] == 8
+    assert all(a >= b for a, b in zip(sizes[1:], sizes[2:]))
+    assert 0 < min(sizes) < 8 and len(sizes) < 61
+    # A huge tol freezes every sample after patience iterations
+    sizes.clear()
+    _invert(FeatureInverter(50, jitter=1, patience=2, tol=0.99), model, targets)
+    assert sizes == [8, 8, 8, 8]
+
+
+def test_coarse_to_fine_shape_and_finite_loss(monkeypatch):
+    torch.manual_seed(0)
+    model = _Net().eval()
+    model.set_hook()
+    targets = torch.rand(3, 3, 8, 8)
+    sizes, losses = [], []
+    model.bn.register_forward_hook(lambda module, input, output: sizes.append(tuple(input[0].shape[2:])))
+    backward = torch.Tensor.backward
+    monkeypatch.setattr(torch.Tensor, 'backward',
+                        lambda loss, *args, **kwargs: losses.append(loss.item()) or backward(loss, *args, **kwargs))
+    images = _invert(FeatureInverter(6, jitter=2, coarse_factor=2, fine_ratio=0.5), model, targets)
+    assert images.shape == targets.shape and images.min() >= 0 and images.max() <= 1
+    # Half of the iterations at 4x4, the rest at full resolution, each one with a finite loss
+    assert sizes.count((4, 4)) == 4 and sizes.count((8, 8)) == 4
+    assert len(losses) == 6 and all(math.isfinite(loss) for loss in losses)
@@ -0,0 +1,97 @@
+import pickle
+import threading
+import numpy as np
+import torch
+from torchvision import transforms
+from utils.image_codec import encode_image
+from utils.loader_pool import LoaderPool, PooledLoader, make_keys
+from utils.shared_array import is_shared
+
+
+def _pool(train, num_workers=0):
+    trsfs = {'test': transforms.ToTensor()}
+    return LoaderPool({'train': train, 'test': train}, trsfs, False, None, num_workers)
+
+
+def _collect(loader):
+    idxes, images, labels = [], [], []
+    for idx, inputs, targets in loader:
+        idxes.append(idx)
+        images.append(inputs)
+        labels.append(targets)
+    return torch.cat(idxes), torch.cat(images), torch.cat(labels)
+
+
+def _data(n, seed):
+    return np.random.RandomState(seed).randint(0, 256, (n, 4, 4, 3)).astype(np.uint8)
+
+
+def test_make_keys():
+    keys = make_keys(np.array([5, 2]), [(np.zeros(3), np.zeros(3)), (np.zeros(1), np.zeros(1))])
+    assert keys.dtype == np.int64
+    assert keys.tolist() == [[0, 5], [0, 2], [1, 0], [1, 1], [1, 2], [2, 0]]
+
+
+def test_pooled_loader_matches_rows_then_appendents():
+    train = (_data(20, 0), np.arange(20) % 4)
+    memory = (_data(5, 1), np.array([7, 7, 8, 8, 8]))
+    encoded = np.empty(2, dtype=object)
+    encoded[:] = [encode_image(image) for image in _data(2, 2)]
+    rows = np.array([3, 0, 11, 19])
+    pool = _pool(train)
+    loader = PooledLoader(pool, 'test', 'train', rows, [memory, (encoded, np.array([9, 9]))], batch_size=3)
+    assert len(loader) == 4
+
+    idx, images, labels = _collect(loader)
+    expected = np.concatenate((train[0][rows], memory[0], _data(2, 2)))
+    assert idx.tolist() == list(range(11))
+    assert torch.equal(images, torch.from_numpy(expected).permute(0, 3, 1, 2).float() / 255)
+    assert labels.tolist() == [3, 0, 3, 3, 7, 7, 8, 8, 8, 9, 9]
+
+    # Shuffled loaders yield every sample once, with the index of its unshuffled position
+    idx, shuffled, _ = _collect(PooledLoader(pool, 'test', 'train', rows, [memory], batch_size=4, shuffle=True))
+    assert sorted(idx.tolist()) == list(range(9))
+    assert torch.equal(shuffled, images[:9][idx])
+
+
+def test_batches_ship_integer_keys_and_segment_names():
+    memory = (_data(500, 3), np.zeros(500, dtype=np.int64))
+    loader = PooledLoader(_pool((_data(4, 0), np.zeros(4))), 'test', 'train', np.arange(4), [memory], 8)
+    assert is_shared(loader._parts[0][0])
+    batch = loader._batch(np.arange(8))
+    assert batch[3].dtype == np.int64
+    # The exemplar images travel by segment name, not by value
+    assert len(pickle.dumps(batch)) < memory[0].nbytes // 10
+
+
+def test_nested_loaders():
+    pool = _pool((_data(6, 0), np.arange(6)))
+    outer = PooledLoader(pool, 'test', 'train', np.arange(6), [], batch_size=2)
+    inner = PooledLoader(pool, 'test', 'train', np.array([5]), [], batch_size=2)
+    labels = []
+    for _, _, targets in outer:
+        labels.append((targets.tolist(), _collect(inner)[2].tolist()))
+    assert labels == [([0, 1], [5]), ([2, 3], [5]), ([4, 5], [5])]
+
+
+
+def test_concurrent_loaders():
+    # e.g. an eval_async evaluation iterating while the training loop claims the pool
+    pool = _pool((_data(40, 0), np.arange(40) % 5))
+    loaders = [PooledLoader(pool, 'test', 'train', np.arange(40)[np.arange(40) % 5 == c], [], batch_size=3)
+               for c in range(2)]
+    errors = []
+
+    def consume(loader, class_idx):
+        try:
+            for _ in range(20):
+                assert _collect(loader)[2].tolist() == [class_idx] * 8
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=consume, args=(loader, c)) for c, loader in enumerate(loaders)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == [] and not pool._active.locked()
@@ -0,0 +1,64 @@
+import numpy as np
+from utils.metrics import ConfusionMatrix, TaskAccuracyMatrix
+
+
+def _reference_accuracy(y_pred, y_true, nb_old, init_cls=0, increment=10):
+    # The original utils.toolkit.accuracy
+    all_acc = {}
+    all_acc['total'] = np.around((y_pred == y_true).sum()*100 / len(y_true), decimals=2)
+
+    if init_cls != 0:
+        idxes = np.where(np.logical_and(y_true >= 0, y_true < init_cls))[0]
+        label = '{}-{}'.format(str(0).rjust(2, '0'), str(init_cls-1).rjust(2, '0'))
+        all_acc[label] = np.around((y_pred[idxes] == y_true[idxes]).sum()*100 / len(idxes), decimals=2)
+
+    for class_id in range(init_cls, np.max(y_true), increment):
+        idxes = np.where(np.logical_and(y_true >= class_id, y_true < class_id + increment))[0]
+        label = '{}-{}'.format(str(class_id).rjust(2, '0'), str(class_id+increment-1).rjust(2, '0'))
+        all_acc[label] = np.around((y_pred[idxes] == y_true[idxes]).sum()*100 / len(idxes), decimals=2)
+
+    idxes = np.where(y_true < nb_old)[0]
+    all_acc['old'] = 0 if len(idxes) == 0 else np.around((y_pred[idxes] == y_true[idxes]).sum()*100 / len(idxes),
+                                                         decimals=2)
+
+    idxes = np.where(y_true >= nb_old)[0]
+    all_acc['new'] = np.around((y_pred[idxes] == y_true[idxes]).sum()*100 / len(idxes), decimals=2)
+
+    return all_acc
+
+
+def _grouped(y_pred, y_true, nb_old, init_cls, increment, batch_size=37):
+    confusion = ConfusionMatrix()
+    for start in range(0, len(y_true), batch_size):
+        confusion.update(y_pred[start:start+batch_size], y_true[start:start+batch_size])
+    return confusion.grouped(nb_old, init_cls, increment)
+
+
+def test_grouped_matches_toolkit_accuracy():
+    rng = np.random.RandomState(0)
+    for nb_classes, nb_old, init_cls, increment in [(30, 20, 10, 10), (50, 0, 0, 10), (25, 15, 5, 5)]:
+        y_true = rng.randint(0, nb_classes, 1000)
+        y_pred = np.where(rng.rand(1000) < 0.6, y_true, rng.randint(0, nb_classes, 1000))
+        assert _grouped(y_pred, y_true, nb_old, init_cls, increment) == \
+            _reference_accuracy(y_pred, y_true, nb_old, init_cls, increment)
+
+
+def test_topk_accuracy():
+    y_true = np.array([0, 1, 2, 3])
+    y_pred = np.array([[0, 1], [2, 1], [0, 1], [3, 2]])
+    confusion = ConfusionMatrix()
+    confusion.update(y_pred, y_true)
+    assert confusion.accuracy() == 50.
+    assert confusion.topk_accuracy() == 75.
+
+
+def test_task_accuracy_matrix():
+    tasks = TaskAccuracyMatrix()
+    confusion = ConfusionMatrix()
+    confusion.update(np.array([0, 1]), np.array([0, 1]))
+    tasks.update(confusion, 2)
+    confusion = ConfusionMatrix()
+    confusion.update(np.array([0, 0, 2, 3]), np.array([0, 1, 2, 3]))
+    tasks.update(confusion, 4)
+    assert tasks.forgetting() == 50.
+    assert tasks.backward_transfer() == -50.
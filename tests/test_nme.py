@@ -0,0 +1,34 @@
+import numpy as np
+from scipy.spatial.distance import cdist
+from utils.nme import NMEClassifier
+
+
+def _reference_ranking(class_means, vectors, topk):
+    # The original BaseLearner._eval_nme ranking
+    scores = cdist(class_means, vectors, 'sqeuclidean').T
+    return np.argsort(scores, axis=1)[:, :topk]
+
+
+def test_nme_ranking_matches_cdist():
+    rng = np.random.RandomState(0)
+    class_means = rng.randn(20, 32)
+    vectors = rng.randn(300, 32)
+    nme = NMEClassifier(chunk_size=64)
+    nme.update('class_means', class_means)
+    assert np.array_equal(nme.predict('class_means', vectors, 5), _reference_ranking(class_means, vectors, 5))
+
+
+def test_nme_incremental_update():
+    rng = np.random.RandomState(1)
+    class_means = rng.randn(10, 8)
+    vectors = rng.randn(50, 8)
+    nme = NMEClassifier()
+    nme.update('class_means', class_means)
+    # Old means moved and new classes were added
+    class_means[2] = rng.randn(8)
+    class_means = np.concatenate((class_means, rng.randn(5, 8)))
+    nme.update('class_means', class_means)
+    assert np.array_equal(nme.predict('class_means', vectors, 3), _reference_ranking(class_means, vectors, 3))
+    # topk is capped by the number of classes
+    assert nme.predict('class_means', vectors, 100).shape == (50, 15)
+    assert nme.predict('class_means', vectors[:0], 3).shape == (0, 3)
@@ -0,0 +1,27 @@
+import os
+import numpy as np
+from utils.path_table import PathTable, IdLoader
+
+
+def test_path_table_round_trip():
+    paths = [os.path.join('data', 'train', 'cls{}'.format(i % 3), 'img_{}.JPEG'.format(i)) for i in range(10)]
+    table = PathTable(paths)
+    other = [os.path.join('other', 'root', 'é_{}.png'.format(i)) for i in range(3)]
+    ids = table.append(other)
+    assert np.array_equal(ids, np.arange(10, 13))
+    assert len(table) == 13
+    assert [table[i] for i in range(len(table))] == paths + other
+    assert len(table.append([])) == 0
+
+
+def test_id_loader_falls_back_to_table():
+    table = PathTable(['a/x.png', 'a/y.png'])
+
+    class Cache(object):
+        def load(self, row):
+            return 'cached {}'.format(row)
+
+    loader = IdLoader(table, lambda path: 'disk ' + path, Cache(), np.array([5, -1]))
+    assert loader(0) == 'cached 5'
+    assert loader(1) == 'disk a/y.png'
+    assert loader(table.append(['b/z.png'])[0]) == 'disk b/z.png'
@@ -0,0 +1,37 @@
+import gc
+import multiprocessing
+import pickle
+from multiprocessing import shared_memory
+import numpy as np
+import pytest
+from utils.shared_array import is_shared, to_shared
+
+
+def test_shared_array_pickles_by_name():
+    array = to_shared(np.arange(1000, dtype=np.float64))
+    assert is_shared(array) and is_shared(array[10:20])
+    restored = pickle.loads(pickle.dumps(array[10:20]))
+    assert np.array_equal(restored, np.arange(10, 20))
+    assert len(pickle.dumps(array)) < 500
+    assert not is_shared(array[[1, 2, 3]])
+
+
+def _sum_in_child(array, queue):
+    queue.put(float(array.sum()))
+
+
+def test_segment_outlives_child_attach_and_is_unlinked_with_the_array():
+    array = to_shared(np.arange(100, dtype=np.float64))
+    name = array._shm.name
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_sum_in_child, args=(array, queue))
+    process.start()
+    assert queue.get(timeout=60) == array.sum()
+    process.join()
+    # The child attached without taking ownership, the segment is still there
+    assert np.array_equal(pickle.loads(pickle.dumps(array)), np.arange(100))
+    del array
+    gc.collect()
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=name)
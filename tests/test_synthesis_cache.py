@@ -0,0 +1,31 @@
+import torch
+from utils.inversion import FeatureInverter
+from utils.synthesis_cache import SynthesisCache
+
+
+def test_put_get(tmp_path):
+    cache = SynthesisCache(str(tmp_path / 'synthesis'))
+    images = torch.rand(4, 3, 8, 8)
+    key = cache.key('digest', torch.zeros(4, 3, 8, 8), FeatureInverter(10), 1)
+    assert cache.get(key) is None
+    cache.put(key, images)
+    assert torch.equal(cache.get(key), images)
+
+
+def test_key_depends_on_everything_synthesis_depends_on():
+    targets = torch.zeros(2, 3, 4, 4)
+    inverter = FeatureInverter(10)
+    key = SynthesisCache.key('digest', targets, inverter, 0)
+    assert key == SynthesisCache.key('digest', targets.clone(), FeatureInverter(10), 0)
+    assert key != SynthesisCache.key('other', targets, inverter, 0)
+    assert key != SynthesisCache.key('digest', targets + 1, inverter, 0)
+    assert key != SynthesisCache.key('digest', targets, FeatureInverter(20), 0)
+    assert key != SynthesisCache.key('digest', targets, inverter, 1)
+
+
+def test_model_digest():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(3, 2), torch.nn.BatchNorm1d(2))
+    digest = SynthesisCache.model_digest(model)
+    model[1].running_mean += 1
+    assert SynthesisCache.model_digest(model) != digest
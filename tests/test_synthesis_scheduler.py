@@ -0,0 +1,77 @@
+import numpy as np
+import torch
+from torch import nn
+from utils.inversion import SynthesisScheduler
+from utils.synthesis_cache import SynthesisCache
+
+
+class _Model(nn.Module):
+    def set_hook(self):
+        pass
+
+    def remove_hook(self):
+        pass
+
+
+def _scheduler(pack_size, pack_keys=True):
+    class Doubler(object):
+        def invert(self, model, targets):
+            model.batches.append(len(targets))
+            return targets * 2
+
+    model = _Model()
+    model.batches = []
+    return SynthesisScheduler(Doubler(), model, 'cpu', pack_size, pack_keys), model
+
+
+def test_scheduler_packs_and_scatters():
+    scheduler, model = _scheduler(4)
+    sizes = {0: 3, 1: 0, 2: 6, 3: 1}
+    for key, n in sizes.items():
+        scheduler.submit(key, torch.full((n, 1, 1, 1), float(key)))
+    assert len(scheduler) == 10
+    results = scheduler.run()
+    assert list(results) == [0, 1, 2, 3]
+    assert model.batches == [4, 4, 2]
+    for key, n in sizes.items():
+        assert torch.equal(results[key], torch.full((n, 1, 1, 1), 2. * key))
+
+    scheduler, model = _scheduler(None)
+    scheduler.submit(5, torch.ones(3, 1, 1, 1))
+    scheduler.submit(4, torch.ones(2, 1, 1, 1))
+    scheduler.submit(5, torch.ones(1, 1, 1, 1))
+    assert [len(images) for images in scheduler.run().values()] == [4, 2]
+    assert model.batches == [4, 2]
+
+
+def test_scheduler_batches_every_key_alone():
+    scheduler, model = _scheduler(4, pack_keys=False)
+    sizes = {0: 3, 1: 0, 2: 9, 3: 1}
+    for key, n in sizes.items():
+        scheduler.submit(key, torch.full((n, 1, 1, 1), float(key)))
+    results = scheduler.run()
+    # Batches of at most pack_size images, never mixing keys, like per-class DataLoaders
+    assert model.batches == [3, 4, 4, 1, 1]
+    for key, n in sizes.items():
+        assert torch.equal(results[key], torch.full((n, 1, 1, 1), 2. * key))
+
+
+def test_scheduler_streams_keys_as_they_complete():
+    scheduler, model = _scheduler(4)
+    for key, n in [(0, 3), (1, 0), (2, 6), (3, 1)]:
+        scheduler.submit(key, torch.zeros(n, 1, 1, 1))
+    done = [(key, len(model.batches)) for key, _ in scheduler.stream()]
+    # (key, number of packed batches synthesized when it was yielded)
+    assert done == [(1, 0), (0, 1), (2, 3), (3, 3)]
+    assert list(scheduler.stream()) == []
+
+
+def test_scheduler_uses_cache(tmp_path):
+    cache = SynthesisCache(str(tmp_path))
+    scheduler, model = _scheduler(2)
+    scheduler.submit(0, torch.arange(4.).view(4, 1, 1, 1))
+    first = scheduler.run(cache, seed=0)
+    scheduler.submit(0, torch.arange(4.).view(4, 1, 1, 1))
+    assert torch.equal(scheduler.run(cache, seed=0)[0], first[0])
+    assert model.batches == [2, 2]
+    assert np.array_equal(first[0].view(-1).numpy(), [0, 2, 4, 6])
@@ -0,0 +1,34 @@
+import numpy as np
+import torch
+from utils.tensor_cache import TensorCache, CachedTensorDataset
+
+
+def _batches(rows, size=3):
+    return (torch.full((len(rows[start:start+size]), 2, 2), 1.) * torch.as_tensor(rows[start:start+size],
+                                                                                   dtype=torch.float).view(-1, 1, 1)
+            for start in range(0, len(rows), size))
+
+
+def test_memory_cache():
+    cache = TensorCache(10)
+    rows = np.array([7, 2, 5, 9])
+    assert np.array_equal(cache.missing(rows), rows)
+    cache.fill(rows, _batches(rows))
+    assert np.array_equal(cache.missing(np.arange(10)), [0, 1, 3, 4, 6, 8])
+    assert torch.equal(cache.get(5), torch.full((2, 2), 5.))
+    dataset = CachedTensorDataset(cache, rows, np.array([0, 1, 2, 3]))
+    idx, image, label = dataset[2]
+    assert (idx, label) == (2, 2) and torch.equal(image, torch.full((2, 2), 5.))
+
+
+def test_disk_cache_starts_warm(tmp_path):
+    rows = np.array([1, 3, 4])
+    cache = TensorCache(6, str(tmp_path), fp16=True)
+    cache.fill(rows, _batches(rows))
+    assert cache.get(3).dtype == torch.float32
+
+    warm = TensorCache(6, str(tmp_path), fp16=True)
+    assert np.array_equal(warm.missing(np.arange(6)), [0, 2, 5])
+    assert torch.equal(warm.get(4), torch.full((2, 2), 4.))
+    # The memory map is reopened by every worker rather than pickled
+    assert warm.__getstate__()['_data'] is None
@@ -0,0 +1,46 @@
+import os
+import numpy as np
+from PIL import Image
+from utils.data import iTinyImageNet200
+
+
+def _make_tree(root, value):
+    # TinyImageNet layout: train/<wnid>/images/*.JPEG, val/images/*.JPEG with val_annotations.txt
+    image = Image.fromarray(np.full((64, 64, 3), value, dtype=np.uint8))
+    for wnid in ('n01', 'n02'):
+        os.makedirs(os.path.join(root, 'train', wnid, 'images'))
+        for i in range(2):
+            image.save(os.path.join(root, 'train', wnid, 'images', '{}_{}.JPEG'.format(wnid, i)))
+    os.makedirs(os.path.join(root, 'val', 'images'))
+    with open(os.path.join(root, 'val', 'val_annotations.txt'), 'w') as f:
+        for i, wnid in enumerate(('n01', 'n02')):
+            image.save(os.path.join(root, 'val', 'images', 'val_{}.JPEG'.format(i)))
+            f.write('val_{}.JPEG\t{}\t0\t0\t64\t64\n'.format(i, wnid))
+
+
+def _load(monkeypatch, datasets):
+    monkeypatch.setenv('PUBLICDATASETS', str(datasets))
+    data = iTinyImageNet200()
+    data.download_data()
+    return data
+
+
+def test_cache_is_keyed_by_root_and_fingerprint(tmp_path, monkeypatch):
+    monkeypatch.setenv('DATASETCACHE', str(tmp_path / 'cache'))
+    _make_tree(str(tmp_path / 'a' / 'tiny-imagenet-200'), 10)
+    _make_tree(str(tmp_path / 'b' / 'tiny-imagenet-200'), 200)
+
+    data = _load(monkeypatch, tmp_path / 'a')
+    assert data.train_data.shape == (4, 64, 64, 3) and list(data.train_targets) == [0, 0, 1, 1]
+    assert list(data.test_targets) == [0, 1]
+    value_a = int(np.median(data.train_data))
+    # Another root is ingested on its own instead of serving the arrays of the first one
+    value_b = int(np.median(_load(monkeypatch, tmp_path / 'b').train_data))
+    assert abs(value_a - 10) < 5 and abs(value_b - 200) < 5
+    assert int(np.median(_load(monkeypatch, tmp_path / 'a').train_data)) == value_a
+
+    # Adding an image changes the fingerprint of the tree
+    images = tmp_path / 'a' / 'tiny-imagenet-200' / 'train' / 'n02' / 'images'
+    Image.fromarray(np.zeros((64, 64, 3), dtype=np.uint8)).save(str(images / 'n02_2.JPEG'))
+    os.utime(str(images), ns=(0, os.stat(str(images)).st_mtime_ns + 10**9))
+    assert len(_load(monkeypatch, tmp_path / 'a').train_data) == 5
@@ -23,7 +23,13 @@ def _train(args):
     _set_device(args)
     print_args(args)
 
-    data_manager = DataManager(args['dataset'], args['shuffle'], args['seed'], args['init_cls'], args['increment'])
+    data_manager = DataManager(args['dataset'], args['shuffle'], args['seed'], args['init_cls'], args['increment'],
+                               image_cache_size=args.get('image_cache_size'),
+                               shared_memory=args.get('shared_memory', False),
+                               persistent_workers=args.get('persistent_workers', False),
+                               num_workers=args.get('num_workers', 4),
+                               test_cache=args.get('test_cache'),
+                               test_cache_fp16=args.get('test_cache_fp16', False))
     model = factory.get_model(args['model_name'], args)
     inverse_nme_accy = None
 
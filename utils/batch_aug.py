@@ -0,0 +1,132 @@
+import numpy as np
+import torch
+from torch.nn import functional as F
+from torchvision import transforms
+
+
+class BatchAugment(object):
+    '''
+    Batched, tensor-domain version of the transform lists declared in iData (train_trsf/test_trsf + common_trsf).
+    Takes a uint8 batch [N, H, W, C] and returns the normalized float batch [N, C, H, W], drawing the random
+    parameters per sample exactly as the PIL transforms would.
+    Only the transforms used by the in-memory datasets are supported.
+    '''
+
+    def __init__(self, trsf_list):
+        self.ops = []
+        self.to_tensor = False
+        for trsf in trsf_list:
+            if isinstance(trsf, transforms.RandomCrop):
+                self.ops.append(self._random_crop_op(trsf))
+            elif isinstance(trsf, transforms.RandomHorizontalFlip):
+                self.ops.append(self._flip_op(trsf.p))
+            elif isinstance(trsf, transforms.ColorJitter):
+                self.ops.append(self._brightness_op(trsf))
+            elif isinstance(trsf, transforms.ToTensor):
+                # uint8 -> [0, 1] float conversion is done once up front, see __call__
+                self.to_tensor = True
+            elif isinstance(trsf, transforms.Normalize):
+                self.ops.append(self._normalize_op(trsf.mean, trsf.std))
+            else:
+                raise NotImplementedError('Batched augmentation does not support {}.'.format(trsf))
+        assert self.to_tensor, 'ToTensor is required in the transform list.'
+
+    def __call__(self, images):
+        # [N, H, W, C] uint8 -> [N, C, H, W] float in [0, 1]
+        x = images.permute(0, 3, 1, 2).float().div_(255.)
+        for op in self.ops:
+            x = op(x)
+        return x
+
+    @staticmethod
+    def _random_crop_op(trsf):
+        if trsf.padding_mode != 'constant' or trsf.pad_if_needed:
+            raise NotImplementedError('Batched RandomCrop only supports constant padding.')
+        size = trsf.size if isinstance(trsf.size, (tuple, list)) else (trsf.size, trsf.size)
+        padding = trsf.padding if trsf.padding is not None else 0
+        if isinstance(padding, int):
+            padding = (padding, padding, padding, padding)
+        elif len(padding) == 2:
+            padding = (padding[0], padding[1], padding[0], padding[1])
+        left, top, right, bottom = padding
+        fill = trsf.fill / 255.
+
+        def op(x):
+            x = F.pad(x, (left, right, top, bottom), value=fill)
+            n, _, h, w = x.shape
+            th, tw = size
+            # one offset per sample, then gather all crops with a single advanced index
+            offset_y = torch.randint(0, h - th + 1, (n, 1), device=x.device)
+            offset_x = torch.randint(0, w - tw + 1, (n, 1), device=x.device)
+            rows = offset_y + torch.arange(th, device=x.device)  # [N, th]
+            cols = offset_x + torch.arange(tw, device=x.device)  # [N, tw]
+            batch = torch.arange(n, device=x.device)[:, None, None]
+            x = x[batch, :, rows[:, :, None], cols[:, None, :]]  # [N, th, tw, C]
+            return x.permute(0, 3, 1, 2)
+
+        return op
+
+    @staticmethod
+    def _flip_op(p):
+        def op(x):
+            mask = torch.rand(x.shape[0], device=x.device) < p
+            return torch.where(mask[:, None, None, None], x.flip(3), x)
+
+        return op
+
+    @staticmethod
+    def _brightness_op(trsf):
+        if trsf.contrast is not None or trsf.saturation is not None or trsf.hue is not None:
+            raise NotImplementedError('Batched ColorJitter only supports brightness.')
+        if trsf.brightness is None:
+            return lambda x: x
+        low, high = trsf.brightness
+
+        def op(x):
+            factor = torch.empty(x.shape[0], 1, 1, 1, device=x.device).uniform_(low, high)
+            return x.mul_(factor).clamp_(0., 1.)
+
+        return op
+
+    @staticmethod
+    def _normalize_op(mean, std):
+        mean = torch.tensor(mean).view(1, -1, 1, 1)
+        std = torch.tensor(std).view(1, -1, 1, 1)
+
+        def op(x):
+            return x.sub_(mean.to(x.device)).div_(std.to(x.device))
+
+        return op
+
+
+class BatchLoader(object):
+    '''
+    Drop-in replacement of DataLoader(DummyDataset(...)) for in-memory datasets.
+    The uint8 images are held as one contiguous tensor and every batch is augmented at once by BatchAugment,
+    so the cost scales with the number of batches instead of the number of samples.
+    Yields (idx, inputs, targets) like DummyDataset does.
+    '''
+
+    def __init__(self, images, labels, trsf_list, batch_size, shuffle=False, device=None):
+        assert len(images) == len(labels), 'Data size error!'
+        self.images = torch.from_numpy(np.ascontiguousarray(images))
+        self.labels = torch.from_numpy(np.asarray(labels, dtype=np.int64))
+        self.augment = BatchAugment(trsf_list)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.device = device
+        if device is not None and torch.device(device).type == 'cuda':
+            self.images = self.images.to(device)
+
+    def __len__(self):
+        return (len(self.labels) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        nb_samples = len(self.labels)
+        order = torch.randperm(nb_samples) if self.shuffle else torch.arange(nb_samples)
+        for start in range(0, nb_samples, self.batch_size):
+            idx = order[start:start+self.batch_size]
+            inputs = self.images[idx.to(self.images.device)]
+            if self.device is not None:
+                inputs = inputs.to(self.device, non_blocking=True)
+            yield idx, self.augment(inputs), self.labels[idx]
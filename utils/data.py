@@ -1,10 +1,13 @@
 import numpy as np
 import sys
 import os
+import hashlib
+import logging
 import pandas as pd
 from PIL import Image
 from torchvision import datasets, transforms
 from utils.toolkit import split_images_labels
+from utils.image_cache import get_cache_root, parallel_map
 
 
 class iData(object):
@@ -104,11 +107,8 @@ class iImageNet1000(iData):
         train_dir = os.path.join(os.environ["IMAGENETDATASET"], "train")
         test_dir = os.path.join(os.environ["IMAGENETDATASET"], "val")
         
-        train_dset = datasets.ImageFolder(train_dir)
-        test_dset = datasets.ImageFolder(test_dir)
-
-        self.train_data, self.train_targets = split_images_labels(train_dset.imgs)
-        self.test_data, self.test_targets = split_images_labels(test_dset.imgs)
+        self.train_data, self.train_targets = image_folder(train_dir)
+        self.test_data, self.test_targets = image_folder(test_dir)
 
 class SD_198(iData):
     use_path = True
@@ -215,11 +215,8 @@ class iImageNet100(iData):
         train_dir = '/home/20/zhengjin/Datasets/miniImageNet/train'
         test_dir = '/home/20/zhengjin/Datasets/miniImageNet/val'
 
-        train_dset = datasets.ImageFolder(train_dir)
-        test_dset = datasets.ImageFolder(test_dir)
-
-        self.train_data, self.train_targets = split_images_labels(train_dset.imgs)
-        self.test_data, self.test_targets = split_images_labels(test_dset.imgs)
+        self.train_data, self.train_targets = image_folder(train_dir)
+        self.test_data, self.test_targets = image_folder(test_dir)
  
 class iTinyImageNet200(iData):
     use_path = False
@@ -242,10 +239,31 @@ class iTinyImageNet200(iData):
         self.train_dir = os.path.join(self.root_dir, "train")
         self.val_dir = os.path.join(self.root_dir, "val")
 
-        self._create_class_idx_dict_train()
-        self._create_class_idx_dict_val()
-
-        self._make_dataset()
+        # Decoded once into uint8 arrays, later runs memory-map them. Like image_folder, the cache is keyed by the
+        # dataset root and ingested again when the mtime fingerprint of its tree changes
+        key = hashlib.md5(os.path.realpath(self.root_dir).encode()).hexdigest()
+        cache_dir = os.path.join(get_cache_root(), "tinyimagenet_" + key)
+        files = [os.path.join(cache_dir, name + ".npy") for name in
+                 ("train_data", "train_targets", "test_data", "test_targets")]
+        fingerprint = self._fingerprint()
+        fingerprint_file = os.path.join(cache_dir, "fingerprint.npy")
+        if not (all(os.path.exists(f) for f in files + [fingerprint_file]) and
+                np.array_equal(np.load(fingerprint_file), fingerprint)):
+            self._create_class_idx_dict_train()
+            self._create_class_idx_dict_val()
+            self._make_dataset(cache_dir)
+            np.save(os.path.join(cache_dir, "fingerprint.tmp.npy"), fingerprint)
+            os.replace(os.path.join(cache_dir, "fingerprint.tmp.npy"), fingerprint_file)
+
+        self.train_data, self.test_data = np.load(files[0], mmap_mode='r'), np.load(files[2], mmap_mode='r')
+        self.train_targets, self.test_targets = np.load(files[1]), np.load(files[3])
+
+    def _fingerprint(self):
+        # mtimes of the train tree down to the image directories of every class, then of the val images and labels
+        class_dirs = sorted(d.path for d in os.scandir(self.train_dir) if d.is_dir())
+        val_files = [os.path.join(self.val_dir, "images"), os.path.join(self.val_dir, "val_annotations.txt")]
+        return np.concatenate([_folder_fingerprint(self.train_dir)] + [_folder_fingerprint(d) for d in class_dirs] +
+                              [np.array([os.stat(f).st_mtime_ns for f in val_files], dtype=np.int64)])
 
     def _create_class_idx_dict_train(self):
         if sys.version_info >= (3, 5):
@@ -253,13 +271,6 @@ class iTinyImageNet200(iData):
         else:
             classes = [d for d in os.listdir(self.train_dir) if os.path.isdir(os.path.join(train_dir, d))]
         classes = sorted(classes)
-        num_images = 0
-        for root, dirs, files in os.walk(self.train_dir):
-            for f in files:
-                if f.endswith(".JPEG"):
-                    num_images = num_images + 1
-
-        self.len_dataset = num_images
 
         self.tgt_idx_to_class = {i: classes[i] for i in range(len(classes))}
         self.class_to_tgt_idx = {classes[i]: i for i in range(len(classes))}
@@ -286,7 +297,7 @@ class iTinyImageNet200(iData):
         self.class_to_tgt_idx = {classes[i]: i for i in range(len(classes))}
         self.tgt_idx_to_class = {i: classes[i] for i in range(len(classes))}
 
-    def _make_dataset(self, Train=True):
+    def _make_dataset(self, cache_dir):
         train_images = []
         test_images = []
         train_list_of_dirs = [target for target in self.class_to_tgt_idx.keys()]
@@ -301,10 +312,8 @@ class iTinyImageNet200(iData):
                 for fname in sorted(files):
                     if (fname.endswith(".JPEG")):
                         path = os.path.join(root, fname)
-                        #add picture loading code
-                        item = (pil_loader(path), self.class_to_tgt_idx[tgt])
-                        train_images.append(item)
-        
+                        train_images.append((path, self.class_to_tgt_idx[tgt]))
+
         for tgt in test_list_of_dirs:
             dirs = os.path.join(self.val_dir, tgt)
             if not os.path.isdir(dirs):
@@ -314,11 +323,61 @@ class iTinyImageNet200(iData):
                 for fname in sorted(files):
                     if (fname.endswith(".JPEG")):
                         path = os.path.join(root, fname)
-                        item = (pil_loader(path), self.class_to_tgt_idx[self.val_img_to_class[fname]])
-                        test_images.append(item)
-
-        self.train_data, self.train_targets = split_images_labels(train_images)
-        self.test_data, self.test_targets = split_images_labels(test_images)
+                        test_images.append((path, self.class_to_tgt_idx[self.val_img_to_class[fname]]))
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        logging.info('Ingesting {} TinyImageNet images into {}'.format(len(train_images) + len(test_images),
+                                                                      cache_dir))
+        for split, images in (("train", train_images), ("test", test_images)):
+            paths, targets = split_images_labels(images)
+            # Targets are written last and mark the split as complete
+            _ingest_images(paths, os.path.join(cache_dir, split + "_data.npy"), (64, 64, 3))
+            np.save(os.path.join(cache_dir, split + "_targets.tmp.npy"), targets)
+            os.replace(os.path.join(cache_dir, split + "_targets.tmp.npy"),
+                       os.path.join(cache_dir, split + "_targets.npy"))
+
+
+def _ingest_images(paths, filename, shape):
+    # Decode paths in parallel straight into an [N, *shape] uint8 .npy file
+    tmp_file = filename[:-len(".npy")] + ".tmp.npy"
+    data = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.uint8, shape=(len(paths),) + shape)
+    for row, img in enumerate(parallel_map(pil_loader, paths)):
+        data[row] = img
+    data.flush()
+    del data
+    os.replace(tmp_file, filename)
+
+
+def image_folder(root):
+    '''
+    (paths, targets) of datasets.ImageFolder(root), read from a metadata index persisted in the cache directory.
+    The tree is only walked again when the mtime of root or of one of its class directories changes, which is
+    the case whenever files are added, removed or renamed.
+    '''
+    fingerprint = _folder_fingerprint(root)
+    key = hashlib.md5(os.path.abspath(root).encode()).hexdigest()
+    index_file = os.path.join(get_cache_root(), 'folder_index_{}.npz'.format(key))
+    if os.path.exists(index_file):
+        index = np.load(index_file)
+        if np.array_equal(index['fingerprint'], fingerprint):
+            return index['paths'], index['targets']
+
+    logging.info('Indexing image folder {}'.format(root))
+    dset = datasets.ImageFolder(root)
+    paths, targets = split_images_labels(dset.imgs)
+    if not os.path.exists(get_cache_root()):
+        os.makedirs(get_cache_root())
+    tmp_file = os.path.join(get_cache_root(), 'folder_index_{}.tmp.npz'.format(key))
+    np.savez(tmp_file, paths=paths, targets=targets, classes=np.array(dset.classes), fingerprint=fingerprint)
+    os.replace(tmp_file, index_file)
+    return paths, targets
+
+
+# mtimes of root and of its class directories, in sorted order
+def _folder_fingerprint(root):
+    entries = sorted((d.name, d.stat().st_mtime_ns) for d in os.scandir(root) if d.is_dir())
+    return np.array([os.stat(root).st_mtime_ns] + [mtime for _, mtime in entries], dtype=np.int64)
 
 
 def pil_loader(path):
@@ -1,15 +1,36 @@
+import os
+import hashlib
 import logging
 import numpy as np
 from PIL import Image
-from torch.utils.data import Dataset
+import torch
+from torch.utils.data import DataLoader, Dataset, Sampler
 from torchvision import transforms
 from utils.data import iCIFAR10, iCIFAR100, iImageNet1000, iImageNet100, iTinyImageNet200, iCIFAR100_Wo_Norm, Skin7, SD_198
+from utils.batch_aug import BatchLoader
+from utils.image_cache import ImageCache, get_cache_root
+from utils.shared_array import to_shared
+from utils.loader_pool import LoaderPool, PooledLoader
+from utils.path_table import PathTable, IdLoader
+from utils.tensor_cache import TensorCache, CachedTensorDataset
+from utils.image_codec import to_pil, decode_rows
 
 
 class DataManager(object):
-    def __init__(self, dataset_name, shuffle, seed, init_cls, increment):
+    def __init__(self, dataset_name, shuffle, seed, init_cls, increment, image_cache_size=None, shared_memory=False,
+                 persistent_workers=False, num_workers=4, test_cache=None, test_cache_fp16=False):
         self.dataset_name = dataset_name
         self._setup_data(dataset_name, shuffle, seed)
+        if image_cache_size is not None and self.use_path:
+            self._setup_image_cache(image_cache_size)
+        if shared_memory:
+            self._share_data()
+        # Created on first use so the workers see the final (cached / shared) arrays
+        self._persistent_workers = persistent_workers
+        self._num_workers = num_workers
+        # Persistent loader pools by number of workers
+        self._pools, self._pool_nb_paths = {}, 0
+        self._test_cache = self._setup_test_cache(test_cache, test_cache_fp16)
         assert init_cls <= len(self._class_order), 'No enough classes.'
         # 10 init 10 incre
         # self._increments = [10, 10, 10, ... ]
@@ -28,87 +49,127 @@ class DataManager(object):
         return self._increments[task]
 
     def get_dataset(self, indices, source, mode, appendent=None, ret_data=False):
-        if source == 'train':
-            x, y = self._train_data, self._train_targets
-        elif source == 'test':
-            x, y = self._test_data, self._test_targets
-        else:
-            raise ValueError('Unknown data source {}.'.format(source))
+        '''
+        appendent is a (data, targets) tuple or a list of them, e.g. exemplar memory plus synthetic memory.
+        Unless ret_data is set, nothing is copied: the dataset indexes into the source arrays and the appendents.
+        '''
+        x, y, class_index = self._get_source(source)
+        trsf = transforms.Compose(self._get_trsf_list(mode))
+
+        rows = _select_rows(class_index, indices)
+        parts = _appendent_parts(appendent)
+        if self._test_cache is not None and source == 'test' and mode == 'test' and not parts and not ret_data:
+            self._fill_test_cache(rows, x, y, trsf)
+            return CachedTensorDataset(self._test_cache, rows, y[rows])
 
-        if mode == 'train':
-            #* before list argument makes the elements in list be passed separately
-            #** before dict argument makes the elements in dict be passed separately
-            trsf = transforms.Compose([*self._train_trsf, *self._common_trsf])
-        elif mode == 'flip':
-            trsf = transforms.Compose([*self._test_trsf, transforms.RandomHorizontalFlip(p=1.), *self._common_trsf])
-        elif mode == 'test':
-            trsf = transforms.Compose([*self._test_trsf, *self._common_trsf])
-        else:
+        if ret_data:
+            data = _concatenate_rows([x[rows]] + [data for data, _ in parts]) if parts else x[rows]
+            targets = np.concatenate([y[rows]] + [targets for _, targets in parts]) if parts else y[rows]
+            return data, targets, DummyDataset(data, targets, trsf, self.use_path, self._loader)
+
+        source_ids = np.concatenate([np.zeros(len(rows), dtype=np.int16)] +
+                                    [np.full(len(targets), i+1, dtype=np.int16) for i, (_, targets) in enumerate(parts)])
+        rows = np.concatenate([rows] + [np.arange(len(targets)) for _, targets in parts])
+        return CompositeDataset([(x, y)] + parts, source_ids, rows, trsf, self.use_path, self._loader)
+
+    def get_batch_loader(self, indices, source, mode, batch_size, shuffle=False, appendent=None, device=None):
+        '''
+        Same selection as get_dataset, but the whole uint8 array is kept as one tensor and augmented per batch.
+        Only available for in-memory datasets (use_path=False).
+        '''
+        if self.use_path:
+            raise ValueError('Batched augmentation requires an in-memory dataset, {} uses paths.'.format(
+                self.dataset_name))
+        data, targets, _ = self.get_dataset(indices, source, mode, appendent=appendent, ret_data=True)
+        data = decode_rows(data)  # Encoded exemplars are decoded for the lifetime of this loader
+
+        return BatchLoader(data, targets, self._get_trsf_list(mode), batch_size, shuffle=shuffle, device=device)
+
+    def get_loader(self, indices, source, mode, batch_size, shuffle=False, appendent=None, num_workers=None):
+        '''
+        DataLoader over the same samples as get_dataset. With persistent_workers every loader is served by one
+        long-lived worker pool that is re-pointed at the requested rows, so short loops such as per-class
+        herding do not fork and tear down workers each time; loaders asking for another num_workers get a pool of
+        their own.
+        '''
+        num_workers = self._num_workers if num_workers is None else num_workers
+        if not self._persistent_workers or (self._test_cache is not None and source == 'test' and mode == 'test'
+                                            and not _appendent_parts(appendent)):
+            return DataLoader(self.get_dataset(indices, source, mode, appendent=appendent),
+                              batch_size=batch_size, shuffle=shuffle, num_workers=num_workers)
+        _, _, class_index = self._get_source(source)
+        self._get_trsf_list(mode)  # Validate mode before it reaches the workers
+        return PooledLoader(self._get_pool(num_workers), mode, source, _select_rows(class_index, indices),
+                            _appendent_parts(appendent), batch_size, shuffle=shuffle)
+
+    def register_paths(self, paths):
+        '''
+        Add image files created during training (e.g. synthesized exemplars saved to disk) to the path table of a
+        path-based dataset and return their file ids, which can be stored next to the ids of the dataset images.
+        '''
+        if not self.use_path:
+            raise ValueError('{} is an in-memory dataset, it has no path table.'.format(self.dataset_name))
+
+        return self._paths.append(paths)
+
+    def get_dataset_with_split(self, indices, source, mode, appendent=None, val_samples_per_class=0):
+        x, y, class_index = self._get_source(source)
+        if mode not in ('train', 'test'):
             raise ValueError('Unknown mode {}.'.format(mode))
+        trsf = transforms.Compose(self._get_trsf_list(mode))
 
-        data, targets = [], []
-        for idx in indices:
-            class_data, class_targets = self._select(x, y, low_range=idx, high_range=idx+1)
-            data.append(class_data)
-            targets.append(class_targets)
+        train_rows, val_rows = _split_rows(class_index, indices, val_samples_per_class)
+        train_data, train_targets = [x[train_rows]], [y[train_rows]]
+        val_data, val_targets = [x[val_rows]], [y[val_rows]]
 
-        if appendent is not None and len(appendent) != 0:
+        if appendent is not None:
             appendent_data, appendent_targets = appendent
-            data.append(appendent_data)
-            targets.append(appendent_targets)
+            appendent_index = _build_class_index(appendent_targets, int(np.max(appendent_targets))+1)
+            train_rows, val_rows = _split_rows(appendent_index, range(len(appendent_index[0])-1),
+                                               val_samples_per_class)
+            val_data.append(appendent_data[val_rows])
+            val_targets.append(appendent_targets[val_rows])
+            train_data.append(appendent_data[train_rows])
+            train_targets.append(appendent_targets[train_rows])
 
-        data, targets = np.concatenate(data), np.concatenate(targets)
+        #np.concatenate: Join a sequence of arrays along an existing axis
+        train_data, train_targets = _concatenate_rows(train_data), np.concatenate(train_targets)
+        val_data, val_targets = _concatenate_rows(val_data), np.concatenate(val_targets)
 
-        if ret_data:
-            return data, targets, DummyDataset(data, targets, trsf, self.use_path)
-        else:
-            return DummyDataset(data, targets, trsf, self.use_path)
+        return DummyDataset(train_data, train_targets, trsf, self.use_path, self._loader), \
+            DummyDataset(val_data, val_targets, trsf, self.use_path, self._loader)
 
-    def get_dataset_with_split(self, indices, source, mode, appendent=None, val_samples_per_class=0):
+    def _get_source(self, source):
         if source == 'train':
-            x, y = self._train_data, self._train_targets
+            return self._train_data, self._train_targets, self._train_class_index
         elif source == 'test':
-            x, y = self._test_data, self._test_targets
+            return self._test_data, self._test_targets, self._test_class_index
         else:
             raise ValueError('Unknown data source {}.'.format(source))
 
+    def _get_pool(self, num_workers):
+        # Workers hold a snapshot of the path table, restart them if paths were registered since
+        if self.use_path and self._pool_nb_paths != len(self._paths):
+            self._pools, self._pool_nb_paths = {}, len(self._paths)
+        if num_workers not in self._pools:
+            sources = {'train': (self._train_data, self._train_targets), 'test': (self._test_data, self._test_targets)}
+            trsfs = {mode: transforms.Compose(self._get_trsf_list(mode)) for mode in ('train', 'flip', 'test')}
+            self._pools[num_workers] = LoaderPool(sources, trsfs, self.use_path, self._loader, num_workers)
+            logging.info('Started a persistent pool of {} data loading workers'.format(num_workers))
+        return self._pools[num_workers]
+
+    def _get_trsf_list(self, mode):
         if mode == 'train':
-            trsf = transforms.Compose([*self._train_trsf, *self._common_trsf])
+            #* before list argument makes the elements in list be passed separately
+            #** before dict argument makes the elements in dict be passed separately
+            return [*self._train_trsf, *self._common_trsf]
+        elif mode == 'flip':
+            return [*self._test_trsf, transforms.RandomHorizontalFlip(p=1.), *self._common_trsf]
         elif mode == 'test':
-            trsf = transforms.Compose([*self._test_trsf, *self._common_trsf])
+            return [*self._test_trsf, *self._common_trsf]
         else:
             raise ValueError('Unknown mode {}.'.format(mode))
 
-        train_data, train_targets = [], []
-        val_data, val_targets = [], []
-        for idx in indices:
-            class_data, class_targets = self._select(x, y, low_range=idx, high_range=idx+1)
-            val_indx = np.random.choice(len(class_data), val_samples_per_class, replace=False)
-            train_indx = list(set(np.arange(len(class_data))) - set(val_indx))
-            val_data.append(class_data[val_indx])
-            val_targets.append(class_targets[val_indx])
-            train_data.append(class_data[train_indx])
-            train_targets.append(class_targets[train_indx])
-
-        if appendent is not None:
-            appendent_data, appendent_targets = appendent
-            for idx in range(0, int(np.max(appendent_targets))+1):
-                append_data, append_targets = self._select(appendent_data, appendent_targets,
-                                                           low_range=idx, high_range=idx+1)
-                val_indx = np.random.choice(len(append_data), val_samples_per_class, replace=False)
-                train_indx = list(set(np.arange(len(append_data))) - set(val_indx))
-                val_data.append(append_data[val_indx])
-                val_targets.append(append_targets[val_indx])
-                train_data.append(append_data[train_indx])
-                train_targets.append(append_targets[train_indx])
-        
-        #np.concatenate: Join a sequence of arrays along an existing axis
-        train_data, train_targets = np.concatenate(train_data), np.concatenate(train_targets)
-        val_data, val_targets = np.concatenate(val_data), np.concatenate(val_targets)
-
-        return DummyDataset(train_data, train_targets, trsf, self.use_path), \
-            DummyDataset(val_data, val_targets, trsf, self.use_path)
-
     def _setup_data(self, dataset_name, shuffle, seed):
         idata = _get_idata(dataset_name)
         idata.download_data()
@@ -117,6 +178,14 @@ class DataManager(object):
         self._train_data, self._train_targets = idata.train_data, idata.train_targets
         self._test_data, self._test_targets = idata.test_data, idata.test_targets
         self.use_path = idata.use_path
+        self._loader = pil_loader
+        if self.use_path:
+            # Samples are integer ids into one table holding the train then the test paths
+            self._paths = PathTable(np.concatenate((self._train_data, self._test_data)))
+            self._train_data = np.arange(len(self._train_data))
+            self._test_data = np.arange(len(self._train_data), len(self._paths))
+            self._loader = IdLoader(self._paths, pil_loader)
+            logging.info('{} paths stored in a {:.1f} MB table'.format(len(self._paths), self._paths.nbytes() / 2**20))
 
         # Transforms
         self._train_trsf = idata.train_trsf
@@ -136,41 +205,232 @@ class DataManager(object):
         self._train_targets = _map_new_class_index(self._train_targets, self._class_order)
         self._test_targets = _map_new_class_index(self._test_targets, self._class_order)
 
-    #select the data of classes [low_range, high_range) 
-    def _select(self, x, y, low_range, high_range):
-        # both tuple and array can be used as index
-        # np.where return a tuple(array, )
-        # list must be converted into tuple before it is used as index
-        idxes = np.where(np.logical_and(y >= low_range, y < high_range))
-        return x[idxes], y[idxes]
+        # Class -> rows tables, so selecting classes costs O(selected samples) instead of a scan per class
+        self._train_class_index = _build_class_index(self._train_targets, len(self._class_order))
+        self._test_class_index = _build_class_index(self._test_targets, len(self._class_order))
+
+    def _setup_test_cache(self, test_cache, fp16):
+        # 'memory' or 'disk', the disk cache is keyed by the test transform and test set so it is never served stale
+        if test_cache is None:
+            return None
+        if test_cache == 'memory':
+            cache_dir = None
+        elif test_cache == 'disk':
+            key = '{}|{}|{}|{}'.format(self.dataset_name, transforms.Compose(self._get_trsf_list('test')),
+                                       'fp16' if fp16 else 'fp32', self._test_fingerprint())
+            cache_dir = os.path.join(get_cache_root(), '{}_test_tensors_{}'.format(
+                self.dataset_name, hashlib.md5(key.encode()).hexdigest()[:12]))
+        else:
+            raise ValueError('Unknown test cache {}.'.format(test_cache))
+        logging.info('Caching transformed test tensors in {}'.format(cache_dir or 'memory'))
+
+        return TensorCache(len(self._test_targets), cache_dir, fp16)
+
+    def _test_fingerprint(self):
+        # Number of test rows and a hash of their labels (in the dataset's own class ids, so a cache is shared by
+        # every class order) and of their paths or pixels
+        digest = hashlib.md5()
+        digest.update(np.asarray(self._class_order)[self._test_targets].astype(np.int64).tobytes())
+        if self.use_path:
+            for file_id in self._test_data:
+                digest.update(self._paths[file_id].encode('utf-8'))
+        else:
+            digest.update(np.ascontiguousarray(self._test_data).tobytes())
+        return '{}:{}'.format(len(self._test_targets), digest.hexdigest())
+
+    def _fill_test_cache(self, rows, x, y, trsf):
+        # Transform the rows of classes evaluated for the first time, once, with the regular loader workers
+        missing = self._test_cache.missing(rows)
+        if len(missing) == 0:
+            return
+        loader = DataLoader(DummyDataset(x[missing], y[missing], trsf, self.use_path, self._loader),
+                            batch_size=256, shuffle=False, num_workers=self._num_workers)
+        self._test_cache.fill(missing, (inputs for _, inputs, _ in loader))
+        logging.info('Cached {} test tensors ({:.1f} MB held)'.format(len(missing),
+                                                                     self._test_cache.nbytes() / 2**20))
+
+    def _setup_image_cache(self, short_side):
+        # Decode each image once at the given short side, then serve every epoch from the memory-mapped cache
+        cache_dir = os.path.join(get_cache_root(), '{}_{}'.format(self.dataset_name, short_side))
+        paths = [self._paths[file_id] for file_id in range(len(self._paths))]
+        cache = ImageCache(cache_dir) if ImageCache.exists(cache_dir) else None
+        rows = cache.rows_of(paths) if cache is not None else None
+        if rows is None or np.any(rows < 0):
+            targets = np.concatenate((self._train_targets, self._test_targets))
+            ImageCache.build(paths, targets, cache_dir, short_side)
+            cache = ImageCache(cache_dir)
+            rows = cache.rows_of(paths)
+        self._loader = IdLoader(self._paths, pil_loader, cache, rows)
+        logging.info('Serving {} images from cache {}'.format(len(cache), cache_dir))
+
+    def _share_data(self):
+        # Move the arrays into POSIX shared memory once; datasets built on them are pickled to DataLoader workers
+        # by segment name, so every worker maps the same pages instead of holding its own copy
+        self._train_data, self._train_targets = to_shared(self._train_data), to_shared(self._train_targets)
+        self._test_data, self._test_targets = to_shared(self._test_data), to_shared(self._test_targets)
+        logging.info('Dataset arrays moved to shared memory ({:.1f} MB)'.format(
+            (self._train_data.nbytes + self._test_data.nbytes) / 2**20))
 
 
 class DummyDataset(Dataset):
-    def __init__(self, images, labels, trsf, use_path=False):
+    def __init__(self, images, labels, trsf, use_path=False, loader=None):
         assert len(images) == len(labels), 'Data size error!'
         self.images = images
         self.labels = labels
         self.trsf = trsf
         self.use_path = use_path
+        # image -> PIL.Image, pil_loader for paths or an IdLoader for file ids
+        self.loader = loader if loader is not None else pil_loader
 
     def __len__(self):
         return len(self.images)
 
     def __getitem__(self, idx):
         if self.use_path:
-            image = self.trsf(pil_loader(self.images[idx]))
+            image = self.trsf(self.loader(self.images[idx]))
         else:
-            image = self.trsf(Image.fromarray(self.images[idx]))
+            image = self.trsf(to_pil(self.images[idx]))
         label = self.labels[idx]
 
         return idx, image, label
 
+class CompositeDataset(Dataset):
+    '''
+    Zero-copy concatenation of several (data, targets) sources: sample i is row rows[i] of sources[source_ids[i]].
+    Source 0 holds the selected classes of the train/test arrays, the others are appendents such as the exemplar
+    memory.
+    '''
+
+    def __init__(self, sources, source_ids, rows, trsf, use_path=False, loader=None):
+        assert len(source_ids) == len(rows), 'Data size error!'
+        self.sources = sources
+        self.source_ids = source_ids
+        self.rows = rows
+        self.trsf = trsf
+        self.use_path = use_path
+        self.loader = loader if loader is not None else pil_loader
+
+    @property
+    def labels(self):
+        labels = np.empty(len(self.rows), dtype=np.int64)
+        for i, (_, targets) in enumerate(self.sources):
+            mask = self.source_ids == i
+            labels[mask] = targets[self.rows[mask]]
+        return labels
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        images, labels = self.sources[self.source_ids[idx]]
+        row = self.rows[idx]
+        if self.use_path:
+            image = self.trsf(self.loader(images[row]))
+        else:
+            image = self.trsf(to_pil(images[row]))
+        label = labels[row]
+
+        return idx, image, label
+
+
+class ReplayBatchSampler(Sampler):
+    '''
+    Batch sampler for a CompositeDataset that guarantees round(batch_size * replay_ratio) replayed samples (any
+    appendent) per batch, the rest being new-class samples. An epoch is one pass over the new-class samples,
+    replayed samples are cycled through in a reshuffled order.
+    '''
+
+    def __init__(self, dataset, batch_size, replay_ratio):
+        self.new_idxes = np.flatnonzero(dataset.source_ids == 0)
+        self.old_idxes = np.flatnonzero(dataset.source_ids != 0)
+        assert len(self.new_idxes) > 0, 'No new-class samples to replay against.'
+        self.nb_old = int(round(batch_size * replay_ratio)) if len(self.old_idxes) > 0 else 0
+        self.nb_new = batch_size - self.nb_old
+        assert self.nb_new > 0, 'Replay ratio leaves no room for new-class samples.'
+
+    def __len__(self):
+        return (len(self.new_idxes) + self.nb_new - 1) // self.nb_new
+
+    def __iter__(self):
+        new_idxes = self.new_idxes[torch.randperm(len(self.new_idxes)).numpy()]
+        old_idxes, old_pos = self.old_idxes[torch.randperm(len(self.old_idxes)).numpy()], 0
+        for start in range(0, len(new_idxes), self.nb_new):
+            batch = new_idxes[start:start+self.nb_new].tolist()
+            for _ in range(self.nb_old):
+                if old_pos == len(old_idxes):
+                    old_idxes, old_pos = self.old_idxes[torch.randperm(len(self.old_idxes)).numpy()], 0
+                batch.append(int(old_idxes[old_pos]))
+                old_pos += 1
+            yield batch
+
+
+# np.concatenate, except that raw image rows and encoded exemplar rows (object arrays) end up in one object array
+def _concatenate_rows(arrays):
+    if all(array.dtype != object for array in arrays) or all(array.dtype == object for array in arrays):
+        return np.concatenate(arrays)
+    rows = np.empty(sum(len(array) for array in arrays), dtype=object)
+    start = 0
+    for array in arrays:
+        for row in array:
+            rows[start] = row
+            start += 1
+    return rows
+
+
+# (data, targets) tuple or list of tuples -> list of non-empty (data, targets)
+def _appendent_parts(appendent):
+    if appendent is None or len(appendent) == 0:
+        return []
+    if isinstance(appendent, tuple):
+        appendent = [appendent]
+    return [(data, targets) for data, targets in appendent if len(targets) != 0]
+
+
+# CSR-style class index: rows of class c are rows[offsets[c]:offsets[c+1]], in their original order
+def _build_class_index(y, nb_classes):
+    y = np.asarray(y, dtype=np.int64)
+    rows = np.argsort(y, kind='stable')
+    offsets = np.zeros(nb_classes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(y, minlength=nb_classes), out=offsets[1:])
+    return offsets, rows
+
+
+# rows of the classes in `indices`, grouped by class in the order of `indices`
+def _select_rows(class_index, indices):
+    offsets, rows = class_index
+    if len(indices) == 0:
+        return np.array([], dtype=np.int64)
+    return np.concatenate([rows[offsets[idx]:offsets[idx+1]] for idx in indices])
+
+
+# randomly hold out val_samples_per_class rows of every class in `indices`
+def _split_rows(class_index, indices, val_samples_per_class):
+    offsets, rows = class_index
+    train_rows, val_rows = [], []
+    for idx in indices:
+        class_rows = rows[offsets[idx]:offsets[idx+1]]
+        val_indx = np.random.choice(len(class_rows), val_samples_per_class, replace=False)
+        train_mask = np.ones(len(class_rows), dtype=bool)
+        train_mask[val_indx] = False
+        val_rows.append(class_rows[val_indx])
+        train_rows.append(class_rows[train_mask])
+    if len(train_rows) == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    return np.concatenate(train_rows), np.concatenate(val_rows)
+
+
 # map class y to its index of order
 # y = [0, 1, 2, 3, 4]
 # order = [1, 3, 0, 2, 4]
 # result = [2, 0, 3, 1, 4] : 0 -> 2, 1 -> 0, 2 -> 3, 3 -> 1, 4 -> 4 
 def _map_new_class_index(y, order):
-    return np.array(list(map(lambda x: order.index(x), y)))
+    y, order = np.asarray(y, dtype=np.int64), np.asarray(order, dtype=np.int64)
+    lookup = np.full(max(y.max(initial=0), order.max(initial=0)) + 1, -1, dtype=np.int64)
+    lookup[order] = np.arange(len(order))
+    new_y = lookup[y]
+    if np.any(new_y < 0):
+        raise ValueError('Classes {} are not in the class order.'.format(np.unique(y[new_y < 0]).tolist()))
+    return new_y
 
 
 def _get_idata(dataset_name):
@@ -0,0 +1,273 @@
+import os
+import tempfile
+import weakref
+from collections import OrderedDict
+import numpy as np
+
+
+class DiskArray(object):
+    '''
+    Append-only file of fixed-shape rows, read through a memory map and a per-process LRU cache of pages
+    (page_rows consecutive rows, at most cache_pages of them). Rows never move once written, so views (DiskRows)
+    stay valid while rows are appended; compact() copies the live rows into a new file.
+    Pickles by file name: DataLoader workers map the file themselves instead of receiving a copy of the rows.
+    '''
+
+    def __init__(self, path, row_shape, dtype, page_rows=64, cache_pages=256):
+        self.path = path
+        self.row_shape = tuple(row_shape)
+        self.dtype = np.dtype(dtype)
+        self.page_rows = page_rows
+        self.cache_pages = cache_pages
+        self.length = 0
+        self._map, self._map_length = None, 0
+        self._pages = OrderedDict()
+        open(path, 'wb').close()
+        # The creating process owns the file, copies made by pickling (workers, deepcopy) do not
+        self._finalizer = weakref.finalize(self, _remove, path)
+
+    @property
+    def row_nbytes(self):
+        return int(np.prod(self.row_shape, dtype=np.int64)) * self.dtype.itemsize
+
+    def append(self, data):
+        '''Write rows at the end of the file and return their row ids.'''
+        data = np.ascontiguousarray(data, dtype=self.dtype)
+        assert data.shape[1:] == self.row_shape, 'Row shape {} != {}.'.format(data.shape[1:], self.row_shape)
+        with open(self.path, 'ab') as f:
+            f.write(data.tobytes())
+        # The last page may have been cached while it was partially filled
+        self._pages.pop(self.length // self.page_rows, None)
+        rows = np.arange(self.length, self.length + len(data))
+        self.length += len(data)
+        return rows
+
+    def get(self, row):
+        page, offset = divmod(int(row), self.page_rows)
+        return self._page(page)[offset]
+
+    def take(self, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        out = np.empty((len(rows),) + self.row_shape, dtype=self.dtype)
+        pages = rows // self.page_rows
+        for page in np.unique(pages):
+            mask = pages == page
+            out[mask] = self._page(page)[rows[mask] - page * self.page_rows]
+        return out
+
+    def _page(self, page):
+        cached = self._pages.get(page)
+        if cached is not None:
+            self._pages.move_to_end(page)
+            return cached
+        if self._map is None or self._map_length < self.length:
+            self._map = np.memmap(self.path, dtype=self.dtype, mode='r', shape=(self.length,) + self.row_shape)
+            self._map_length = self.length
+        cached = np.array(self._map[page*self.page_rows:(page+1)*self.page_rows])
+        self._pages[page] = cached
+        if len(self._pages) > self.cache_pages:
+            self._pages.popitem(last=False)
+        return cached
+
+    def __deepcopy__(self, memo):
+        # Written rows never change, copies of a view can share the file
+        return self
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_map'], state['_map_length'] = None, 0
+        state['_pages'] = OrderedDict()
+        state['_finalizer'] = None
+        return state
+
+
+class DiskRows(object):
+    '''
+    Array-like view of some rows of a DiskArray: len(), integer indexing (one row as an ndarray), slicing, masks
+    and index arrays (another view, nothing is read) and np.asarray() (reads the rows).
+    Assigning rows (view[mask] = images) appends the images to the file and points the view at them; other views
+    keep the old rows.
+    '''
+
+    def __init__(self, disk, rows):
+        self.disk = disk
+        self.rows = np.asarray(rows, dtype=np.int64)
+
+    @property
+    def shape(self):
+        return (len(self.rows),) + self.disk.row_shape
+
+    @property
+    def dtype(self):
+        return self.disk.dtype
+
+    @property
+    def ndim(self):
+        return 1 + len(self.disk.row_shape)
+
+    @property
+    def nbytes(self):
+        return len(self.rows) * self.disk.row_nbytes
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            return self.disk.get(self.rows[idx])
+        return DiskRows(self.disk, self.rows[idx])
+
+    def __setitem__(self, idx, data):
+        # Copy-on-write of the row ids, views sharing them (slices of this one) are left as they were
+        rows = self.rows.copy()
+        rows[idx] = spill(self.disk, data).rows
+        self.rows = rows
+
+    def copy(self):
+        return DiskRows(self.disk, self.rows.copy())
+
+    def __iter__(self):
+        for row in self.rows:
+            yield self.disk.get(row)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self.disk.take(self.rows)
+        return data if dtype is None else data.astype(dtype)
+
+    def __eq__(self, other):
+        return np.asarray(self) == other
+
+    def __ne__(self, other):
+        return np.asarray(self) != other
+
+
+def spill(disk, data):
+    '''Rows of data as a view of disk; rows already on disk are reused, anything else is appended.'''
+    if isinstance(data, DiskRows) and data.disk is disk:
+        return data
+    if len(data) == 0:
+        return DiskRows(disk, [])
+    return DiskRows(disk, disk.append(np.asarray(data)))
+
+
+def compact(disk, views, path):
+    '''
+    Copy the rows used by views into a new DiskArray at path, in order, and return it with the matching new
+    views. The old file is removed once the old DiskArray is garbage collected.
+    '''
+    new_disk = DiskArray(path, disk.row_shape, disk.dtype, disk.page_rows, disk.cache_pages)
+    new_views = []
+    for view in views:
+        new_views.append(DiskRows(new_disk, new_disk.append(disk.take(view.rows)) if len(view) > 0 else []))
+    return new_disk, new_views
+
+
+class DiskExemplarStore(object):
+    '''
+    Exemplar memory with the same interface as ExemplarStore, for image arrays too large for RAM. Images are
+    appended to a DiskArray under directory and never rewritten; the store only keeps the row ids and targets,
+    so replacing or reducing classes is bookkeeping. data is a DiskRows view. Superseded rows are reclaimed by
+    compact(), which BaseLearner calls once the memory of a task is built.
+    '''
+
+    def __init__(self, directory, page_rows=64, cache_pages=256):
+        self.directory = directory
+        self.page_rows = page_rows
+        self.cache_pages = cache_pages
+        self._disk = None
+        self._rows = np.zeros(0, dtype=np.int64)
+        self._targets = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self._targets)
+
+    @property
+    def data(self):
+        return np.array([]) if self._disk is None else DiskRows(self._disk, self._rows)
+
+    @property
+    def targets(self):
+        return self._targets
+
+    @property
+    def classes(self):
+        return np.unique(self._targets).astype(np.int64).tolist()
+
+    def nbytes(self):
+        return (0 if self._disk is None else len(self._rows) * self._disk.row_nbytes) + self._targets.nbytes
+
+    def class_nbytes(self):
+        row_nbytes = 0 if self._disk is None else self._disk.row_nbytes
+        return {class_idx: int(np.sum(self._targets == class_idx)) * row_nbytes for class_idx in self.classes}
+
+    def reserve(self, capacity):
+        pass
+
+    def set_data(self, data):
+        self._rows = self._write(data)
+
+    def set_targets(self, targets):
+        self._targets = np.array(targets, dtype=np.int64)
+
+    def append(self, data, targets):
+        assert len(data) == len(targets), 'Data size error!'
+        self._rows = np.concatenate((self._rows, self._write(data)))
+        self._targets = np.concatenate((self._targets, np.asarray(targets, dtype=np.int64)))
+
+    def add_class(self, class_idx, data, targets=None):
+        if targets is None:
+            targets = np.full(len(data), class_idx)
+        keep = self._targets != class_idx
+        self._rows, self._targets = self._rows[keep], self._targets[keep]
+        self.append(data, targets)
+
+    def get_class(self, class_idx):
+        mask = np.flatnonzero(self._targets == class_idx)
+        return self.data[mask], self._targets[mask]
+
+    def replace_rows(self, mask, data):
+        '''Append the new images of the rows selected by mask and remap the rows to them, see ExemplarStore.'''
+        if self._disk is None:
+            return
+        view = DiskRows(self._disk, self._rows)
+        view[mask] = data
+        self._rows = view.rows
+
+    def reduce(self, m):
+        '''Keep the first m exemplars of every class, grouped in class order.'''
+        if len(self._targets) == 0:
+            return
+        keep = np.concatenate([np.flatnonzero(self._targets == class_idx)[:m] for class_idx in self.classes])
+        self._rows, self._targets = self._rows[keep], self._targets[keep]
+
+    def compact(self):
+        '''Rewrite the file when more than half of it holds superseded rows.'''
+        if self._disk is None or self._disk.length <= 2 * len(self._rows):
+            return
+        self._disk, (view,) = compact(self._disk, [DiskRows(self._disk, self._rows)], new_file(self.directory))
+        self._rows = view.rows
+
+    def _write(self, data):
+        if len(data) == 0:
+            return np.zeros(0, dtype=np.int64)
+        if self._disk is None:
+            data = np.asarray(data)
+            if data.ndim < 2:
+                raise ValueError('DiskExemplarStore stores image arrays, got rows of shape {}.'.format(data.shape[1:]))
+            self._disk = DiskArray(new_file(self.directory), data.shape[1:], data.dtype, self.page_rows,
+                                   self.cache_pages)
+        return spill(self._disk, data).rows
+
+
+def new_file(directory, prefix='exemplars_'):
+    '''Path of a new, uniquely named file under directory.'''
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    fd, path = tempfile.mkstemp(prefix=prefix, suffix='.bin', dir=directory)
+    os.close(fd)
+    return path
+
+
+def _remove(path):
+    if os.path.exists(path):
+        os.remove(path)
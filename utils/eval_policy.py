@@ -0,0 +1,79 @@
+import copy
+import logging
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from torch.utils.data import DataLoader, Subset
+
+
+class EvalPolicy(object):
+    '''
+    Decides when and on what the per-epoch monitoring accuracy of a learner is computed. Built from the config:
+        eval_every (default 1): evaluate after every k-th epoch, other epochs report nan.
+        eval_subsample (default None): monitor on a fixed stratified subsample of that many test samples per class.
+        eval_async (default False): evaluate a frozen copy of the weights on a background thread while training
+            goes on. An epoch then reports the latest finished evaluation, which is logged with its own epoch.
+        eval_diagnostics (default True): run the extra per-task diagnostic passes some learners make.
+    The last epoch of a run is always evaluated on the full test set, synchronously.
+    '''
+
+    def __init__(self, every=1, subsample=None, async_eval=False, diagnostics=True, seed=0):
+        if every < 1:
+            raise ValueError('eval_every must be at least 1, got {}.'.format(every))
+        self.every = every
+        self.subsample = subsample
+        self.async_eval = async_eval
+        self.diagnostics = diagnostics
+        self.seed = seed
+        self._executor = None
+        self._pending = None  # (epoch, future) of the background evaluation in flight
+        self._last = float('nan')
+        self._subset = (None, None)  # (dataset, subsample loader) of the last monitored test set
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(every=args.get('eval_every', 1), subsample=args.get('eval_subsample'),
+                   async_eval=args.get('eval_async', False), diagnostics=args.get('eval_diagnostics', True))
+
+    def evaluate(self, compute, model, loader, epoch, epochs, *args):
+        '''
+        Accuracy of model after epoch (counted from 1) of epochs, by compute(model, loader, *args), or nan when
+        this epoch is skipped.
+        '''
+        if epoch >= epochs:
+            self._collect(wait=True)
+            self._last = float('nan')
+            return compute(model, loader, *args)
+        if epoch % self.every != 0:
+            return self._collect() if self.async_eval else float('nan')
+
+        loader = self._monitor_loader(loader)
+        if not self.async_eval:
+            return compute(model, loader, *args)
+        self._collect(wait=True)  # At most one evaluation in flight
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = (epoch, self._executor.submit(compute, copy.deepcopy(model), loader, *args))
+        return self._last
+
+    def _collect(self, wait=False):
+        if self._pending is not None and (wait or self._pending[1].done()):
+            epoch, future = self._pending
+            self._pending = None
+            self._last = future.result()
+            logging.info('Epoch {} => Monitored test accuracy {:.2f}'.format(epoch, self._last))
+        return self._last
+
+    def _monitor_loader(self, loader):
+        # Loaders without a labelled dataset (batched or pooled loaders) are monitored in full
+        dataset = getattr(loader, 'dataset', None)
+        if self.subsample is None or not hasattr(dataset, 'labels'):
+            return loader
+        if self._subset[0] is not dataset:
+            labels = np.asarray(dataset.labels)
+            order = np.random.RandomState(self.seed).permutation(len(labels))
+            order = order[np.argsort(labels[order], kind='stable')]
+            starts = np.searchsorted(labels[order], labels[order])
+            idxes = order[np.arange(len(order)) - starts < self.subsample]
+            self._subset = (dataset, DataLoader(Subset(dataset, np.sort(idxes)), batch_size=loader.batch_size,
+                                                shuffle=False, num_workers=loader.num_workers))
+        return self._subset[1]
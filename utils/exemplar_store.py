@@ -0,0 +1,298 @@
+import numpy as np
+from utils.image_codec import EncodedImage, encode_image
+
+
+class ExemplarStore(object):
+    '''
+    Exemplar memory backed by preallocated arrays instead of one np.concatenate per class.
+    Rows of a class occupy a contiguous slot range; data/targets are zero-copy views of the filled part, valid
+    until the next reduce() or add_class() of an existing class, which rewrite rows in place.
+    '''
+
+    def __init__(self, capacity=0):
+        self._capacity = capacity
+        self._data, self._targets = None, None
+        self._nb_data, self._nb_targets = 0, 0
+        self._owned = False  # False when the buffers are arrays handed in by set_data/set_targets
+        self._slots = {}  # class_idx -> (start, end), None when it has to be rebuilt from the targets
+
+    def __len__(self):
+        return self._nb_targets
+
+    @property
+    def data(self):
+        return np.array([]) if self._data is None else self._data[:self._nb_data]
+
+    @property
+    def targets(self):
+        return np.array([]) if self._targets is None else self._targets[:self._nb_targets]
+
+    @property
+    def classes(self):
+        return np.unique(self.targets).astype(np.int64).tolist()
+
+    def nbytes(self):
+        return self.data.nbytes + self.targets.nbytes
+
+    def class_nbytes(self):
+        '''Bytes used by the exemplars of every class, {class_idx: bytes}.'''
+        data, targets = self.data, self.targets
+        row_nbytes = data.nbytes // len(data) if len(data) > 0 else 0
+        return {class_idx: int(np.sum(targets == class_idx)) * row_nbytes for class_idx in self.classes}
+
+    def reserve(self, capacity):
+        # Grow once to the expected memory size instead of doubling repeatedly
+        self._capacity = max(self._capacity, capacity)
+        if self._data is not None and len(self._data) < capacity:
+            self._reallocate(capacity, self._data[:1])
+
+    def set_data(self, data):
+        '''Replace the whole data array, e.g. `learner._data_memory = ...` in learners managing memory by hand.'''
+        data = np.asarray(data)
+        if self._data is not None and _is_prefix_view(data, self._data):
+            # Truncation such as self._data_memory[:-k]: keep the buffer
+            self._nb_data = len(data)
+        elif len(data) == 0:
+            self._nb_data = 0
+        else:
+            self._data, self._nb_data = data, len(data)
+            self._owned = False
+
+    def set_targets(self, targets):
+        targets = np.asarray(targets)
+        if self._targets is not None and _is_prefix_view(targets, self._targets):
+            self._nb_targets = len(targets)
+        elif len(targets) == 0:
+            self._nb_targets = 0
+        else:
+            self._targets, self._nb_targets = targets, len(targets)
+            self._owned = False
+        self._slots = None
+
+    def append(self, data, targets):
+        '''Append rows without any class bookkeeping, the equivalent of concatenating to the memory.'''
+        assert len(data) == len(targets), 'Data size error!'
+        assert self._nb_data == self._nb_targets, 'Exemplar size error.'
+        start = self._nb_data
+        self._write(start, data, targets)
+        if self._slots is not None and len(targets) > 0:
+            label = int(targets[0])
+            if label not in self._slots and np.all(np.asarray(targets) == label):
+                self._slots[label] = (start, start + len(targets))
+            else:
+                self._slots = None
+
+    def add_class(self, class_idx, data, targets=None):
+        '''Store the exemplars of a class, replacing the ones it already has.'''
+        if targets is None:
+            targets = np.full(len(data), class_idx)
+        slots = self._class_slots()
+        if slots is None:
+            self._gather(np.flatnonzero(self.targets != class_idx))
+            self.append(data, targets)
+            return
+        if class_idx in slots and slots[class_idx][1] - slots[class_idx][0] >= len(data):
+            start, end = slots[class_idx]
+            self._make_owned()
+            self._data[start:start+len(data)] = data
+            self._targets[start:start+len(data)] = targets
+            if start + len(data) < end:
+                self._shrink_slot(class_idx, len(data))
+            return
+        if class_idx in slots:
+            self._shrink_slot(class_idx, 0)
+        start = self._nb_data
+        self._write(start, data, targets)
+        self._slots[class_idx] = (start, start + len(data))
+
+    def replace_rows(self, mask, data):
+        '''
+        Overwrite the images of the rows selected by mask (boolean mask or row indexes), e.g. exemplars that are
+        re-synthesized in place, keeping their targets.
+        '''
+        self._make_owned()
+        self.data[mask] = data
+
+    def get_class(self, class_idx):
+        slots = self._class_slots()
+        if slots is None:
+            mask = np.where(self.targets == class_idx)[0]
+            return self.data[mask], self.targets[mask]
+        start, end = slots.get(class_idx, (0, 0))
+        return self.data[start:end], self.targets[start:end]
+
+    def reduce(self, m):
+        '''Keep the first m exemplars of every class, compacting the rows in place.'''
+        slots = self._class_slots()
+        if slots is None:
+            # Rows of a class are spread out: keep the first m of each class, grouped in class order
+            targets = self.targets
+            self._gather(np.concatenate([np.where(targets == class_idx)[0][:m] for class_idx in self.classes]))
+            return
+        self._make_owned()
+        new_slots, end = {}, 0
+        for class_idx, (start, stop) in sorted(slots.items(), key=lambda item: item[1][0]):
+            k = min(m, stop - start)
+            if start != end:
+                self._data[end:end+k] = self._data[start:start+k]
+                self._targets[end:end+k] = self._targets[start:start+k]
+            new_slots[class_idx] = (end, end + k)
+            end += k
+        self._nb_data = self._nb_targets = end
+        self._slots = new_slots
+
+    def _shrink_slot(self, class_idx, k):
+        # Drop the tail of one class and close the gap; O(rows after it), only used on replacement
+        start, end = self._slots[class_idx]
+        self._make_owned()
+        tail = slice(end, self._nb_data)
+        nb_tail = self._nb_data - end
+        self._data[start+k:start+k+nb_tail] = self._data[tail]
+        self._targets[start+k:start+k+nb_tail] = self._targets[tail]
+        gap = end - start - k
+        self._nb_data -= gap
+        self._nb_targets -= gap
+        self._slots = {c: (s - gap, e - gap) if s >= end else (s, e) for c, (s, e) in self._slots.items()}
+        if k == 0:
+            del self._slots[class_idx]
+        else:
+            self._slots[class_idx] = (start, start + k)
+
+    def _class_slots(self):
+        # None when the rows of some class are not contiguous (only possible after set_targets/append)
+        if self._slots is None:
+            targets = self.targets.astype(np.int64)
+            if len(targets) > 0 and not _is_grouped(targets):
+                return None
+            self._slots = {}
+            if len(targets) > 0:
+                bounds = np.flatnonzero(np.diff(targets)) + 1
+                starts = np.concatenate(([0], bounds))
+                ends = np.concatenate((bounds, [len(targets)]))
+                for start, end in zip(starts, ends):
+                    self._slots[int(targets[start])] = (int(start), int(end))
+        return self._slots
+
+    def _gather(self, rows):
+        self._make_owned()
+        nb_rows = len(rows)
+        if nb_rows > 0:
+            self._data[:nb_rows] = self._data[rows]
+            self._targets[:nb_rows] = self._targets[rows]
+        self._nb_data = self._nb_targets = nb_rows
+        self._slots = None
+
+    def _write(self, start, data, targets):
+        data, targets = np.asarray(data), np.asarray(targets)
+        end = start + len(data)
+        if not self._fits(end, data):
+            self._reallocate(max(end, self._capacity, 2 * len(self._data) if self._data is not None else 0), data)
+        self._data[start:end] = data
+        self._targets[start:end] = targets
+        self._nb_data = self._nb_targets = end
+
+    def _fits(self, end, data):
+        if self._data is None or not self._owned or end > len(self._data):
+            return False
+        if self._nb_data == 0:
+            return self._data.dtype == data.dtype and self._data.shape[1:] == data.shape[1:]
+        return np.promote_types(self._data.dtype, data.dtype) == self._data.dtype
+
+    def _make_owned(self):
+        if not self._owned and self._nb_data > 0:
+            self._reallocate(max(self._nb_data, self._capacity), self.data)
+
+    def _reallocate(self, capacity, sample):
+        dtype = sample.dtype if self._nb_data == 0 else np.promote_types(self._data.dtype, sample.dtype)
+        shape = sample.shape[1:] if self._nb_data == 0 else self._data.shape[1:]
+        data = np.empty((capacity,) + shape, dtype=dtype)
+        targets = np.empty(capacity, dtype=np.int64)
+        if self._nb_data > 0:
+            data[:self._nb_data] = self.data
+        if self._nb_targets > 0:
+            targets[:self._nb_targets] = self.targets
+        self._data, self._targets = data, targets
+        self._owned = True
+
+
+
+class CompressedExemplarStore(ExemplarStore):
+    '''
+    ExemplarStore whose image rows are kept encoded (see utils.image_codec) in an object array. The datasets
+    decode them when a sample is loaded, i.e. lazily in the DataLoader workers. Rows that are not images (file
+    ids of path-based datasets) are stored as they are.
+    With a class budget in bytes, every class keeps the longest prefix of its exemplars (herding order) that
+    fits in it.
+    '''
+
+    def __init__(self, codec='png', quality=90, downsample=2, capacity=0):
+        super().__init__(capacity)
+        self.codec = codec
+        self.quality = quality
+        self.downsample = downsample
+        self.class_budget = None
+
+    def encode(self, data):
+        encoded = np.empty(len(data), dtype=object)
+        for i, image in enumerate(data):
+            if isinstance(image, np.ndarray) and image.ndim >= 2:
+                image = encode_image(image, self.codec, self.quality, self.downsample)
+            encoded[i] = image
+        return encoded
+
+    def set_data(self, data):
+        data = np.asarray(data)
+        super().set_data(data if data.dtype == object else self.encode(data))
+
+    def append(self, data, targets):
+        super().append(self.encode(data), targets)
+
+    def add_class(self, class_idx, data, targets=None):
+        data = self.encode(data)
+        keep = self._nb_within_budget(data)
+        super().add_class(class_idx, data[:keep], None if targets is None else np.asarray(targets)[:keep])
+
+    def replace_rows(self, mask, data):
+        '''Encode the new images, then shrink the classes they push over their byte budget.'''
+        super().replace_rows(mask, self.encode(data))
+        self._apply_budget(np.unique(self.targets[mask]))
+
+    def set_class_budget(self, class_budget):
+        '''Set the byte budget of every class and shrink the classes that exceed it.'''
+        self.class_budget = class_budget
+        self._apply_budget(self.classes)
+
+    def _apply_budget(self, classes):
+        for class_idx in classes:
+            data, targets = self.get_class(class_idx)
+            keep = self._nb_within_budget(data)
+            if keep < len(data):
+                super().add_class(class_idx, data[:keep].copy(), targets[:keep].copy())
+
+    def nbytes(self):
+        return sum(_row_nbytes(image) for image in self.data) + self.targets.nbytes
+
+    def class_nbytes(self):
+        data, targets = self.data, self.targets
+        return {class_idx: sum(_row_nbytes(image) for image in data[targets == class_idx])
+                for class_idx in self.classes}
+
+    def _nb_within_budget(self, data):
+        if self.class_budget is None:
+            return len(data)
+        used = np.cumsum([_row_nbytes(image) for image in data])
+        return int(np.searchsorted(used, self.class_budget, side='right'))
+
+
+def _row_nbytes(image):
+    return image.nbytes if isinstance(image, (EncodedImage, np.ndarray)) else np.asarray(image).nbytes
+
+def _is_prefix_view(array, buffer):
+    return array.ndim == buffer.ndim and array.dtype == buffer.dtype and array.strides == buffer.strides and \
+        array.__array_interface__['data'][0] == buffer.__array_interface__['data'][0] and len(array) <= len(buffer)
+
+
+def _is_grouped(targets):
+    # every class occupies a single run of rows
+    run_starts = targets[np.concatenate(([True], targets[1:] != targets[:-1]))]
+    return len(run_starts) == len(np.unique(run_starts))
@@ -0,0 +1,84 @@
+import numpy as np
+import torch
+
+
+class FeatureTracker(object):
+    '''
+    L2-normalized features collected from the forward passes of the last training epoch(s), so exemplar
+    construction does not need separate extraction passes.
+    Two things are kept for each row of the training set (the train loader's sample index):
+    - per-row vectors on the host, the last view seen, used as herding inputs;
+    - per-class running means (Welford, merged batch by batch) on device, over every view seen, used as the
+      old-class NME means.
+    '''
+
+    def __init__(self, dim, device=None):
+        self._device = device
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        self.targets = np.zeros(0, dtype=np.int64)
+        self.seen = np.zeros(0, dtype=bool)
+        self._counts = torch.zeros(0, device=device)
+        self._means = torch.zeros(0, dim, device=device)
+
+    def __len__(self):
+        return len(self.targets)
+
+    def update(self, idxes, vectors, targets):
+        '''vectors: normalized [B, d] tensor of the samples idxes of the train loader, targets: [B] tensor.'''
+        vectors, targets = vectors.detach().float(), targets.detach().long()
+        idxes = np.asarray(idxes, dtype=np.int64)
+        self._grow_rows(int(idxes.max()) + 1)
+        self._grow_classes(int(targets.max()) + 1)
+        self.vectors[idxes] = vectors.cpu().numpy()
+        self.targets[idxes] = targets.cpu().numpy()
+        self.seen[idxes] = True
+
+        targets = targets.to(self._device)
+        batch_counts = torch.bincount(targets, minlength=len(self._counts)).float()
+        batch_sums = torch.zeros_like(self._means).index_add_(0, targets, vectors.to(self._device))
+        present = batch_counts > 0
+        batch_means = batch_sums[present] / batch_counts[present, None]
+        counts = self._counts[present] + batch_counts[present]
+        # Chan et al. merge of two running means: mean += (batch_mean - mean) * k / (n + k)
+        self._means[present] += (batch_means - self._means[present]) * (batch_counts[present] / counts)[:, None]
+        self._counts[present] = counts
+
+    def replace(self, rows, vectors):
+        '''Overwrite rows with new vectors (e.g. from a clean pass) and recompute the means of their classes.'''
+        self.vectors[rows] = vectors
+        self.seen[rows] = True
+        classes = np.unique(self.targets[rows])
+        for class_idx in classes:
+            class_rows = np.flatnonzero(self.seen & (self.targets == class_idx))
+            self._means[class_idx] = torch.as_tensor(self.vectors[class_rows].mean(0), device=self._device)
+            self._counts[class_idx] = len(class_rows)
+
+    def rows_matching(self, targets, start=0):
+        '''Tracked vectors of rows start.. when they were all seen and their targets are targets, else None.'''
+        end = start + len(targets)
+        if start < 0 or end > len(self) or not self.seen[start:end].all() or \
+                not np.array_equal(self.targets[start:end], targets):
+            return None
+        return self.vectors[start:end]
+
+    def class_mean(self, class_idx):
+        if class_idx >= len(self._counts) or self._counts[class_idx] == 0:
+            return None
+        mean = self._means[class_idx].cpu().numpy()
+        return mean / np.linalg.norm(mean)
+
+    def _grow_rows(self, nb_rows):
+        if nb_rows > len(self):
+            vectors = np.zeros((nb_rows, self.vectors.shape[1]), dtype=np.float32)
+            vectors[:len(self)] = self.vectors
+            targets = np.zeros(nb_rows, dtype=np.int64)
+            targets[:len(self)] = self.targets
+            seen = np.zeros(nb_rows, dtype=bool)
+            seen[:len(self)] = self.seen
+            self.vectors, self.targets, self.seen = vectors, targets, seen
+
+    def _grow_classes(self, nb_classes):
+        if nb_classes > len(self._counts):
+            extra = nb_classes - len(self._counts)
+            self._counts = torch.cat((self._counts, torch.zeros(extra, device=self._device)))
+            self._means = torch.cat((self._means, torch.zeros(extra, self._means.shape[1], device=self._device)))
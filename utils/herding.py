@@ -0,0 +1,47 @@
+import torch
+
+
+def herding_selection(vectors, m, device=None):
+    '''
+    iCaRL herding on one class: rows of vectors (already L2-normalized) in selection order, m of them.
+    '''
+    return herding_selection_batch([vectors], m, device)[0]
+
+
+def herding_selection_batch(vectors_list, m, device=None):
+    '''
+    Herding for several classes at once. Classes are padded to the largest one and processed as one [C, n, d]
+    tensor on device; chosen rows are masked instead of deleted and the sum of the selected vectors is kept
+    running, so each step costs one batched matrix-vector product.
+
+    Step k picks argmin_i ||mu - (S + v_i) / k||, which expands to
+    ||v_i||^2 - 2 v_i.(k mu - S) + const, the same choice as the original loop.
+    '''
+    if len(vectors_list) == 0:
+        return []
+    for vectors in vectors_list:
+        assert len(vectors) >= m, 'Not enough samples ({}) to select {} exemplars.'.format(len(vectors), m)
+    nb_classes, max_n = len(vectors_list), max(len(vectors) for vectors in vectors_list)
+    dim = vectors_list[0].shape[1]
+
+    feats = torch.zeros(nb_classes, max_n, dim, device=device)
+    selectable = torch.zeros(nb_classes, max_n, dtype=torch.bool, device=device)
+    for c, vectors in enumerate(vectors_list):
+        feats[c, :len(vectors)] = torch.as_tensor(vectors, dtype=torch.float32, device=device)
+        selectable[c, :len(vectors)] = True
+    means = torch.stack([feats[c, :len(vectors)].mean(0) for c, vectors in enumerate(vectors_list)])  # [C, d]
+    sq_norms = (feats ** 2).sum(-1)  # [C, n]
+
+    running_sum = torch.zeros(nb_classes, dim, device=device)
+    selected = torch.empty(nb_classes, m, dtype=torch.long, device=device)
+    rows = torch.arange(nb_classes, device=device)
+    for k in range(1, m+1):
+        target = k * means - running_sum  # [C, d]
+        dists = sq_norms - 2 * torch.bmm(feats, target.unsqueeze(-1)).squeeze(-1)
+        dists[~selectable] = float('inf')
+        i = dists.argmin(1)
+        selected[:, k-1] = i
+        selectable[rows, i] = False
+        running_sum += feats[rows, i]
+
+    return [indices for indices in selected.cpu().numpy()]
@@ -0,0 +1,127 @@
+import os
+import logging
+import numpy as np
+from multiprocessing import Pool
+from PIL import Image
+from torchvision.transforms import functional as TF
+
+
+def get_cache_root():
+    return os.environ.get("DATASETCACHE", "./data/cache")
+
+
+def parallel_map(fn, items, num_workers=None, chunksize=64):
+    '''
+    Ordered map over a process pool, used for one-time decoding of whole datasets.
+    '''
+    num_workers = num_workers or os.cpu_count()
+    if num_workers <= 1:
+        for item in items:
+            yield fn(item)
+        return
+    with Pool(num_workers) as pool:
+        for result in pool.imap(fn, items, chunksize=chunksize):
+            yield result
+
+
+def _load_rgb(path):
+    # Same as pil_loader in data_manager
+    with open(path, 'rb') as f:
+        img = Image.open(f)
+        return img.convert('RGB')
+
+
+def _decode_resized(args):
+    path, short_side = args
+    img = _load_rgb(path)
+    # Same rule as transforms.Resize(short_side), but never upscale: smaller images are resized later anyway
+    if min(img.size) > short_side:
+        img = TF.resize(img, short_side)
+    return np.asarray(img, dtype=np.uint8)
+
+
+class ImageCache(object):
+    '''
+    Decoded images of a path-based dataset, resized once to a fixed short side and stored as raw uint8 in one
+    memory-mapped file. Images are written grouped by class, so a task only pages in its own classes' shards.
+    Called like pil_loader: cache(path) -> PIL.Image, paths missing from the cache are decoded from disk.
+    '''
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        index = np.load(os.path.join(cache_dir, 'index.npz'))
+        self.paths = index['paths']
+        self.offsets = index['offsets']  # [N+1] byte offsets into images.bin
+        self.shapes = index['shapes']  # [N, 3] (h, w, c)
+        self._row_of = None
+        self._blob = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, path):
+        return path in self._get_row_of()
+
+    def __call__(self, path):
+        # Paths added after the cache was built (e.g. synthesized images) are read from disk
+        row = self._get_row_of().get(path)
+        if row is None:
+            return _load_rgb(path)
+        return self.load(row)
+
+    def rows_of(self, paths):
+        '''Cache row of every path, -1 for paths that are not cached.'''
+        row_of = self._get_row_of()
+        return np.fromiter((row_of.get(path, -1) for path in paths), dtype=np.int64, count=len(paths))
+
+    def load(self, row):
+        return Image.fromarray(self.get(row))
+
+    def get(self, row):
+        if self._blob is None:
+            # Opened lazily so that every DataLoader worker maps the file itself
+            self._blob = np.memmap(os.path.join(self.cache_dir, 'images.bin'), dtype=np.uint8, mode='r')
+        start, end = self.offsets[row], self.offsets[row+1]
+        return np.asarray(self._blob[start:end]).reshape(self.shapes[row])
+
+    def _get_row_of(self):
+        if self._row_of is None:
+            self._row_of = {path: row for row, path in enumerate(self.paths)}
+        return self._row_of
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_blob'] = None
+        state['_row_of'] = None
+        return state
+
+    @staticmethod
+    def exists(cache_dir):
+        return os.path.exists(os.path.join(cache_dir, 'index.npz'))
+
+    @staticmethod
+    def build(paths, targets, cache_dir, short_side, num_workers=None):
+        '''
+        Decode every image once, sorted by class, and write images.bin plus index.npz into cache_dir.
+        The index is written last, so an interrupted build is simply redone on the next run.
+        '''
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        order = np.argsort(targets, kind='stable')
+        paths = np.asarray(paths)[order]
+        logging.info('Building image cache of {} images at short side {} in {}'.format(len(paths), short_side,
+                                                                                      cache_dir))
+
+        offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+        shapes = np.zeros((len(paths), 3), dtype=np.int32)
+        with open(os.path.join(cache_dir, 'images.bin'), 'wb') as f:
+            jobs = ((path, short_side) for path in paths)
+            for row, img in enumerate(parallel_map(_decode_resized, jobs, num_workers)):
+                f.write(img.tobytes())
+                offsets[row+1] = offsets[row] + img.nbytes
+                shapes[row] = img.shape
+
+        tmp_file = os.path.join(cache_dir, 'index.tmp.npz')
+        np.savez(tmp_file, paths=paths, offsets=offsets, shapes=shapes)
+        os.replace(tmp_file, os.path.join(cache_dir, 'index.npz'))
+        logging.info('Image cache built: {:.1f} MB'.format(offsets[-1] / 2**20))
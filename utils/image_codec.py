@@ -0,0 +1,64 @@
+import io
+import numpy as np
+from PIL import Image
+
+
+class EncodedImage(object):
+    '''
+    One image kept encoded in memory and decoded on access, typically in a DataLoader worker.
+    codec: 'png' and 'webp' (lossless), 'jpeg' (lossy, quality) or 'fp16' (float16 pixels downsampled by an
+    integer factor, upsampled back on decode).
+    '''
+    __slots__ = ('payload', 'codec', 'shape', 'small_shape')
+
+    def __init__(self, payload, codec, shape, small_shape=None):
+        self.payload = payload
+        self.codec = codec
+        self.shape = shape
+        self.small_shape = small_shape
+
+    @property
+    def nbytes(self):
+        return len(self.payload)
+
+    def decode(self):
+        if self.codec == 'fp16':
+            small = np.frombuffer(self.payload, dtype=np.float16).reshape(self.small_shape)
+            img = Image.fromarray(np.clip(small.astype(np.float32) * 255 + 0.5, 0, 255).astype(np.uint8))
+            return img.resize((self.shape[1], self.shape[0]), Image.BILINEAR)
+        return Image.open(io.BytesIO(self.payload)).convert('RGB')
+
+
+def encode_image(image, codec='png', quality=90, downsample=2):
+    '''uint8 [H, W, C] array -> EncodedImage.'''
+    image = np.asarray(image, dtype=np.uint8)
+    if codec == 'fp16':
+        img = Image.fromarray(image)
+        small_size = (max(1, image.shape[1] // downsample), max(1, image.shape[0] // downsample))
+        small = np.asarray(img.resize(small_size, Image.BILINEAR), dtype=np.float32) / 255
+        return EncodedImage(small.astype(np.float16).tobytes(), codec, image.shape, small.shape)
+
+    buffer = io.BytesIO()
+    if codec == 'png':
+        Image.fromarray(image).save(buffer, format='PNG')
+    elif codec == 'webp':
+        Image.fromarray(image).save(buffer, format='WEBP', lossless=True)
+    elif codec == 'jpeg':
+        Image.fromarray(image).save(buffer, format='JPEG', quality=quality)
+    else:
+        raise ValueError('Unknown image codec {}.'.format(codec))
+    return EncodedImage(buffer.getvalue(), codec, image.shape)
+
+
+def to_pil(image):
+    '''Dataset row -> PIL.Image, for raw uint8 arrays and EncodedImage alike.'''
+    if isinstance(image, EncodedImage):
+        return image.decode()
+    return Image.fromarray(image)
+
+
+def decode_rows(data):
+    '''Array of rows, some or all of them EncodedImage, -> one uint8 [N, H, W, C] array.'''
+    if data.dtype != object:
+        return data
+    return np.stack([np.asarray(to_pil(image)) for image in data])
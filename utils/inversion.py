@@ -0,0 +1,346 @@
+import copy
+import logging
+import random
+import time
+from collections import OrderedDict
+import numpy as np
+import torch
+from torch import optim
+from torch.nn import functional as F
+from torchvision import transforms
+
+
+def get_image_prior_losses(inputs_jit):
+    # COMPUTE total variation regularization loss
+    diff1 = inputs_jit[:, :, :, :-1] - inputs_jit[:, :, :, 1:]
+    diff2 = inputs_jit[:, :, :-1, :] - inputs_jit[:, :, 1:, :]
+    diff3 = inputs_jit[:, :, 1:, :-1] - inputs_jit[:, :, :-1, 1:]
+    diff4 = inputs_jit[:, :, :-1, :-1] - inputs_jit[:, :, 1:, 1:]
+
+    loss_var_l2 = torch.norm(diff1) + torch.norm(diff2) + torch.norm(diff3) + torch.norm(diff4)
+    loss_var_l1 = (diff1.abs() / 255.0).mean() + (diff2.abs() / 255.0).mean() + (
+            diff3.abs() / 255.0).mean() + (diff4.abs() / 255.0).mean()
+    loss_var_l1 = loss_var_l1 * 255.0
+    return loss_var_l1, loss_var_l2
+
+
+def get_sample_prior_losses(inputs_jit):
+    '''Per-sample get_image_prior_losses: (l1, l2) total variation of every image, each of shape [B].'''
+    diffs = [inputs_jit[:, :, :, :-1] - inputs_jit[:, :, :, 1:],
+             inputs_jit[:, :, :-1, :] - inputs_jit[:, :, 1:, :],
+             inputs_jit[:, :, 1:, :-1] - inputs_jit[:, :, :-1, 1:],
+             inputs_jit[:, :, :-1, :-1] - inputs_jit[:, :, 1:, 1:]]
+    loss_var_l1 = sum(diff.abs().flatten(1).mean(1) for diff in diffs)
+    loss_var_l2 = sum(torch.norm(diff.flatten(1), dim=1) for diff in diffs)
+    return loss_var_l1, loss_var_l2
+
+
+def bn_loss_scale(i, iterations):
+    '''Weight of the BN statistics loss at iteration i: warm-up schedules for 600 and 2000 iterations, else 1e-3.'''
+    if iterations == 600:
+        return 1e-3 if i <= 200 else 1e-2 if i <= 400 else 5e-2
+    if iterations == 2000:
+        return 1e-3 if i <= 500 else 5e-3 if i <= 1200 else 1e-2
+    return 1e-3
+
+
+def to_uint8(images):
+    '''Synthesized [B, C, H, W] batch in [0, 1] -> uint8 [B, H, W, C] array.'''
+    return (images.detach().cpu().numpy().transpose(0, 2, 3, 1) * 255).astype(np.uint8)
+
+
+class FeatureInverter(object):
+    '''
+    DeepInversion-style synthesis: random images are optimized so that the convnet reproduces the feature vectors
+    of target images, under the BN statistics loss of its DeepInversionFeatureHook layers and TV/L2 image priors.
+    mean/std: normalization applied to the images before the convnet (None: none).
+    init: 'randn' or 'rand' starting images.
+    Every sample keeps its best iterate by its own loss: the feature, TV and L2 terms only, the BN statistics term
+    is a loss of the whole batch and is not part of the best-iterate choice.
+    patience: a sample whose best loss did not improve by a relative tol for patience iterations is frozen and left
+    out of the batch, so every iteration only runs the convnet on the samples still optimized (their BN statistics
+    and TV/L2 batch terms are then those of the smaller batch); the inversion stops once every sample is frozen or
+    after iterations. None: every sample runs all iterations.
+    coarse_factor: coarse-to-fine schedule, the first iterations optimize images coarse_factor times smaller (against
+    the features of the downsampled targets), which are then upsampled and refined at full resolution for the last
+    fine_ratio of the iterations. The convnet must pool its features adaptively. 1: full resolution throughout.
+    '''
+
+    def __init__(self, iterations, mean=None, std=None, init='randn', lr=0.01, jitter=10, var_scale_l2=1e-4,
+                 var_scale_l1=0.0, l2_scale=1e-5, first_bn_multiplier=1., patience=None, tol=1e-3, coarse_factor=1,
+                 fine_ratio=0.25):
+        if init not in ('randn', 'rand'):
+            raise ValueError('Unknown inversion init {}.'.format(init))
+        if coarse_factor < 1 or not 0 < fine_ratio <= 1:
+            raise ValueError('Invalid coarse-to-fine schedule: coarse_factor {}, fine_ratio {}.'.format(
+                coarse_factor, fine_ratio))
+        self.iterations = iterations
+        self.normalize = transforms.Normalize(mean=mean, std=std) if mean is not None else None
+        self.init = init
+        self.lr = lr
+        self.jitter = jitter
+        self.var_scale_l2 = var_scale_l2
+        self.var_scale_l1 = var_scale_l1
+        self.l2_scale = l2_scale
+        self.first_bn_multiplier = first_bn_multiplier
+        self.patience = patience
+        self.tol = tol
+        self.coarse_factor = coarse_factor
+        self.fine_ratio = fine_ratio
+
+    def invert(self, model, image):
+        '''
+        Synthesize one batch: image [B, C, H, W] of targets on the model's device -> images in [0, 1] of the same
+        shape. The BN hooks of model must be set (set_hook).
+        '''
+        model.eval()
+        if len(image.shape) == 3:
+            image = image.unsqueeze(0)
+        init = torch.randn_like if self.init == 'randn' else torch.rand_like
+
+        start = 0
+        if self.coarse_factor > 1:
+            start = self.iterations - int(round(self.iterations * self.fine_ratio))
+            coarse_image = F.avg_pool2d(image, self.coarse_factor)
+            coarse_x = self._optimize(model, init(coarse_image), coarse_image, 0, start,
+                                      max(1, self.jitter // self.coarse_factor))
+            rand_x = F.interpolate(coarse_x, size=image.shape[2:], mode='bilinear', align_corners=False)
+        else:
+            rand_x = init(image)
+        return self._optimize(model, rand_x, image, start, self.iterations, self.jitter)
+
+    def _optimize(self, model, rand_x, image, start, stop, jitter):
+        # Iterations start..stop of the schedule from rand_x against the features of image, returns the best iterates
+        normalize = self.normalize if self.normalize is not None else (lambda x: x)
+        with torch.no_grad():
+            ori_fv = model.fv(image)
+
+        rand_x = rand_x.detach().clone().requires_grad_(True)
+        optimizer = optim.Adam([rand_x], lr=self.lr, betas=[0.5, 0.9], eps=1e-8)
+
+        best_img = rand_x.detach().clamp(0, 1)
+        best_loss = torch.full((len(image),), float('inf'), device=image.device)
+        stale = torch.zeros(len(image), dtype=torch.long, device=image.device)
+        # Samples still optimized, frozen ones keep their image and are left out of the batch
+        active = torch.ones(len(image), dtype=torch.bool, device=image.device)
+        i = start - 1
+        for i in range(start, stop):
+            rows = torch.arange(len(image), device=image.device) if active.all() else active.nonzero().squeeze(1)
+            x = rand_x if len(rows) == len(image) else rand_x[rows]
+            target_fv = ori_fv if len(rows) == len(image) else ori_fv[rows]
+
+            # roll
+            off1 = random.randint(-jitter, jitter)
+            off2 = random.randint(-jitter, jitter)
+            inputs_jit = torch.roll(x, shifts=(off1, off2), dims=(2, 3))
+
+            # R_prior losses
+            loss_var_l1, loss_var_l2 = get_image_prior_losses(inputs_jit)
+
+            # l2 loss on images
+            sample_l2 = torch.norm(inputs_jit.view(inputs_jit.shape[0], -1), dim=1)
+            loss_l2 = sample_l2.mean()
+
+            # main loss
+            rnd_fv = model.fv(normalize(inputs_jit))
+            sample_main = torch.div(torch.norm(rnd_fv - target_fv, dim=1), torch.norm(target_fv, dim=1))
+            main_loss = sample_main.mean()
+
+            # bn loss
+            rescale = [self.first_bn_multiplier] + [1. for _ in range(len(model.loss_r_feature_layers) - 1)]
+            loss_r_feature = sum(
+                [rescale[idx] * item.r_feature for idx, item in enumerate(model.loss_r_feature_layers)])
+            loss = main_loss + bn_loss_scale(i, self.iterations) * loss_r_feature + \
+                self.var_scale_l2 * loss_var_l2 + self.var_scale_l1 * loss_var_l1 + self.l2_scale * loss_l2
+
+            # Keep the best iterate of every sample, the losses are those of rand_x before this step
+            with torch.no_grad():
+                sample_var_l1, sample_var_l2 = get_sample_prior_losses(inputs_jit)
+                sample_loss = sample_main + self.var_scale_l2 * sample_var_l2 + \
+                    self.var_scale_l1 * sample_var_l1 + self.l2_scale * sample_l2
+                improved = sample_loss < best_loss[rows] * (1 - self.tol)
+                stale[rows] = torch.where(improved, torch.zeros_like(stale[rows]), stale[rows] + 1)
+                better = sample_loss < best_loss[rows]
+                best_loss[rows[better]] = sample_loss[better]
+                best_img[rows[better]] = x.detach()[better].clamp(0, 1)
+                frozen = rand_x.detach()[~active].clone()
+
+            optimizer.zero_grad()
+            loss.backward()
+
+            optimizer.step()
+            rand_x.data = torch.clamp(rand_x.data, 0, 1)
+            # Adam keeps moving the rows left out on their past moments, put them back
+            rand_x.data[~active] = frozen
+
+            if self.patience is not None:
+                active &= stale < self.patience
+                if not active.any():
+                    break
+
+        if self.patience is not None:
+            logging.info('Inversion of {} images at {}x{} stopped after {} iterations, {} not converged'.format(
+                len(image), image.shape[2], image.shape[3], i + 1, int(active.sum())))
+        return best_img
+
+
+class SynthesisScheduler(object):
+    '''
+    Packs the targets of many classes into batches of pack_size images, runs the inversion once per packed batch
+    and scatters the results back per key. Synthesis time then follows the number of images, not the number of
+    classes. Targets are submitted under a key (e.g. the class index, submitting a key again extends it) and
+    run() returns {key: synthesized [N, C, H, W] batch in [0, 1], on the host} in submission order, while stream()
+    yields every (key, batch) as soon as all the packed batches holding its targets are done.
+    pack_keys=False never mixes keys in a batch: every key is cut into batches of at most pack_size images, the
+    composition of the per-class DataLoader loops. Packing keeps the per-image feature loss but mixes classes in the
+    BN-statistics and image-prior terms, which are batch losses. pack_size=None inverts every key as one batch.
+    run(cache) looks every packed batch up in a SynthesisCache first and stores the ones it synthesizes. Those are
+    seeded from their cache key on forked RNG streams, so a cached batch is exactly what the run would synthesize
+    and hits or misses leave the random state of the run untouched.
+    '''
+
+    def __init__(self, inverter, model, device, pack_size=256, pack_keys=True):
+        self.inverter = inverter
+        self.model = model
+        self.device = torch.device(device)
+        self.pack_size = pack_size
+        self.pack_keys = pack_keys
+        self._targets = OrderedDict()
+
+    def __len__(self):
+        return sum(len(images) for parts in self._targets.values() for images in parts)
+
+    def submit(self, key, images):
+        self._targets.setdefault(key, []).append(images.detach().cpu())
+
+    def run(self, cache=None, seed=None, workers=0, threads=1):
+        keys = list(self._targets)
+        synthesized = dict(self.stream(cache, seed, workers, threads))
+        return OrderedDict((key, synthesized[key]) for key in keys)
+
+    def stream(self, cache=None, seed=None, workers=0, threads=1):
+        '''
+        Generator of (key, synthesized batch) in completion order, see run().
+        workers > 1 (CPU only): the packed batches are inverted by a pool of worker processes, each given a frozen
+        copy of the model and threads intra-op threads, and are collected (and cached) as they finish. Batches are
+        then split so that every worker gets one, and each is seeded on its own. Workers are spawned, the entry script
+        must be guarded by if __name__ == '__main__' (main.py is).
+        '''
+        if len(self._targets) == 0:
+            return
+        parallel = workers > 1 and self.device.type == 'cpu'
+        keys = list(self._targets)
+        counts = [sum(len(images) for images in self._targets[key]) for key in keys]
+        targets = torch.cat([images for key in keys for images in self._targets[key]])
+        self._targets = OrderedDict()
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        if self.pack_size is None:
+            spans = list(zip(offsets[:-1], offsets[1:]))
+        else:
+            pack_size = self.pack_size
+            if parallel:
+                pack_size = min(pack_size, int(np.ceil(len(targets) / workers)))
+            bounds = [(0, len(targets))] if self.pack_keys else zip(offsets[:-1], offsets[1:])
+            spans = [(start, min(start + pack_size, end)) for begin, end in bounds
+                     for start in range(begin, end, pack_size)]
+        # Number of packed batches of every key still to be synthesized, a key is done when it drops to 0
+        remaining = np.zeros(len(keys), dtype=np.int64)
+        for start, end in spans:
+            remaining[_keys_of(offsets, start, end)] += 1
+
+        start_time = time.time()
+        synthesized = torch.empty_like(targets)
+        for i in np.flatnonzero(remaining == 0):
+            yield keys[i], synthesized[offsets[i]:offsets[i+1]]
+        model_digest = cache.model_digest(self.model) if cache is not None else None
+        pending = []
+        for start, end in spans:
+            key = cache.key(model_digest, targets[start:end], self.inverter, seed) if cache is not None else None
+            images = cache.get(key) if key is not None else None
+            if images is None:
+                pending.append((start, end, key))
+            else:
+                synthesized[start:end] = images
+                for i in _complete(remaining, offsets, start, end):
+                    yield keys[i], synthesized[offsets[i]:offsets[i+1]]
+
+        if parallel and len(pending) > 0:
+            results = self._run_parallel(targets, pending, workers, threads)
+        else:
+            results = self._run_serial(targets, pending)
+        for start, end, key, images in results:
+            synthesized[start:end] = images
+            if key is not None:
+                cache.put(key, images)
+            for i in _complete(remaining, offsets, start, end):
+                yield keys[i], synthesized[offsets[i]:offsets[i+1]]
+        logging.info('Synthesized {} images of {} classes in {} batches ({} from cache{}), {:.1f}s'.format(
+            len(targets), len(keys), len(spans), len(spans) - len(pending),
+            ', {} workers'.format(workers) if parallel else '', time.time() - start_time))
+
+    def _run_serial(self, targets, pending):
+        self.model.set_hook()
+        try:
+            for start, end, key in pending:
+                yield start, end, key, self._invert(targets[start:end], key)
+        finally:
+            self.model.remove_hook()
+
+    def _invert(self, targets, key=None):
+        if key is None:
+            return self.inverter.invert(self.model, targets.to(self.device)).cpu()
+        state = random.getstate()
+        with torch.random.fork_rng(devices=[self.device] if self.device.type == 'cuda' else []):
+            _seed(key)
+            try:
+                return self.inverter.invert(self.model, targets.to(self.device)).cpu()
+            finally:
+                random.setstate(state)
+
+    def _run_parallel(self, targets, pending, workers, threads):
+        model = copy.deepcopy(self.model).cpu().eval()
+        for param in model.parameters():
+            param.requires_grad_(False)
+        # Uncached batches are seeded from the RNG of the run, so results do not depend on the worker scheduling
+        tasks = [(start, end, key, targets[start:end], key if key is not None else int(torch.randint(2**62, ())))
+                 for start, end, key in pending]
+        context = torch.multiprocessing.get_context('spawn')
+        with context.Pool(min(workers, len(tasks)), initializer=_init_synthesis_worker,
+                          initargs=(model, self.inverter, threads)) as pool:
+            for start, end, key, images in pool.imap_unordered(_synthesis_task, tasks):
+                yield start, end, key, images
+
+
+def _keys_of(offsets, start, end):
+    # Indexes of the keys with targets in rows start..end
+    return np.flatnonzero((offsets[:-1] < end) & (offsets[1:] > start) & (offsets[1:] > offsets[:-1]))
+
+
+def _complete(remaining, offsets, start, end):
+    # Count the packed batch of rows start..end as synthesized, returns the indexes of the keys it completes
+    keys = _keys_of(offsets, start, end)
+    remaining[keys] -= 1
+    return keys[remaining[keys] == 0]
+
+
+def _seed(seed):
+    # Seed the python and torch RNGs from an int or a hex digest
+    random.seed(seed)
+    torch.manual_seed(int(seed[:15], 16) if isinstance(seed, str) else seed)
+
+
+_worker_state = None
+
+
+def _init_synthesis_worker(model, inverter, threads):
+    global _worker_state
+    torch.set_num_threads(threads)
+    model.set_hook()
+    _worker_state = (model, inverter)
+
+
+def _synthesis_task(task):
+    start, end, key, targets, seed = task
+    model, inverter = _worker_state
+    _seed(seed)
+    return start, end, key, inverter.invert(model, targets)
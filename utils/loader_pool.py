@@ -0,0 +1,144 @@
+import threading
+import numpy as np
+import torch
+from utils.image_codec import to_pil
+from utils.shared_array import is_shared, to_shared
+from torch.utils.data import DataLoader, Dataset, Sampler
+
+
+class _PoolDataset(Dataset):
+    '''
+    Loads whole batches in the workers. A batch is (mode, source, idx, keys, parts): sample i is row keys[i, 1] of
+    the 'train'/'test' array `source` if keys[i, 0] is 0, else of the (data, targets) part parts[keys[i, 0]]
+    shipped with the batch (e.g. exemplars, see PooledLoader).
+    '''
+
+    def __init__(self, sources, trsfs, use_path, loader):
+        self.sources = sources
+        self.trsfs = trsfs
+        self.use_path = use_path
+        self.loader = loader
+
+    def __getitem__(self, batch):
+        mode, source, idx, keys, parts = batch
+        parts = dict(parts)
+        parts[0] = self.sources[source]
+        trsf = self.trsfs[mode]
+        images, labels = [], []
+        for part, row in keys:
+            data, targets = parts[part]
+            if self.use_path:
+                images.append(trsf(self.loader(data[row])))
+            else:
+                images.append(trsf(to_pil(data[row])))
+            labels.append(targets[row])
+
+        return torch.from_numpy(idx), torch.stack(images), torch.as_tensor(np.asarray(labels))
+
+
+class _RepointableBatchSampler(Sampler):
+    def __init__(self):
+        self.batches = []
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+class LoaderPool(object):
+    '''
+    One DataLoader with persistent workers, shared by every loader a DataManager hands out. Loaders only differ
+    by the batches they feed through the sampler, so switching from the train set to a single class for
+    herding re-points warm workers instead of forking new ones.
+    '''
+
+    def __init__(self, sources, trsfs, use_path, loader, num_workers):
+        self._sampler = _RepointableBatchSampler()
+        self._dataset = _PoolDataset(sources, trsfs, use_path, loader)
+        # batch_size=None: the sampler yields whole batches, which the dataset loads and stacks itself
+        self._loader = DataLoader(self._dataset, sampler=self._sampler, batch_size=None, num_workers=num_workers,
+                                  persistent_workers=num_workers > 0)
+        # Held while a loader is consumed, claimed without blocking so the check and the claim are one step even
+        # when another thread (e.g. an eval_async evaluation) iterates at the same time
+        self._active = threading.Lock()
+
+    def iterate(self, batches):
+        if not self._active.acquire(blocking=False):
+            # A pooled loader is already being consumed (nested loops, another thread): serve this one from a
+            # throwaway loader
+            sampler = _RepointableBatchSampler()
+            sampler.batches = batches
+            for batch in DataLoader(self._dataset, sampler=sampler, batch_size=None, num_workers=0):
+                yield batch
+            return
+        try:
+            self._sampler.batches = batches
+            for batch in self._loader:
+                yield batch
+        finally:
+            self._active.release()
+
+
+class PooledLoader(object):
+    '''
+    DataLoader look-alike served by a LoaderPool. Yields (idx, inputs, targets) like DataLoader(DummyDataset).
+    Appendent parts that are plain arrays are moved to shared memory once and travel with every batch by segment
+    name; other rows (encoded images, disk views) are shipped as the slice a batch uses.
+    '''
+
+    def __init__(self, pool, mode, source, rows, parts, batch_size, shuffle=False):
+        self._pool = pool
+        self._mode = mode
+        self._source = source
+        self._keys = make_keys(rows, parts)
+        self._parts = [(_share(data), _share(np.asarray(targets))) for data, targets in parts]
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return (len(self._keys) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        order = torch.randperm(len(self._keys)).numpy() if self.shuffle else np.arange(len(self._keys))
+        batches = [self._batch(order[start:start+self.batch_size])
+                   for start in range(0, len(self._keys), self.batch_size)]
+        return self._pool.iterate(batches)
+
+    def _batch(self, idx):
+        keys = self._keys[idx]
+        parts = []
+        for part in np.unique(keys[:, 0]):
+            if part == 0:
+                continue
+            data, targets = self._parts[part-1]
+            if is_shared(data):
+                parts.append((part, (data, targets)))
+            else:
+                mask = keys[:, 0] == part
+                used = keys[mask, 1]
+                parts.append((part, (data[used], targets[used])))
+                keys[mask, 1] = np.arange(len(used))
+        return self._mode, self._source, idx, keys, parts
+
+
+def make_keys(rows, parts):
+    '''
+    [N, 2] (part, row) keys for `rows` of a train/test source (part 0) followed by every row of every
+    (data, targets) appendent part (parts 1, 2, ...).
+    '''
+    lengths = [len(rows)] + [len(targets) for _, targets in parts]
+    keys = np.empty((sum(lengths), 2), dtype=np.int64)
+    keys[:, 0] = np.repeat(np.arange(len(lengths)), lengths)
+    keys[:, 1] = np.concatenate([np.asarray(rows, dtype=np.int64)] + [np.arange(n) for n in lengths[1:]])
+    return keys
+
+
+def _share(array):
+    # In-memory arrays are copied to shared memory, anything else (memory maps, object arrays, DiskRows) is left as is
+    if is_shared(array):
+        return array
+    if isinstance(array, np.ndarray) and not isinstance(array, np.memmap) and array.dtype != object:
+        return to_shared(array)
+    return array
@@ -0,0 +1,141 @@
+import numpy as np
+
+
+class ConfusionMatrix(object):
+    '''
+    [C, C] counts of (true class, top-1 prediction) plus per-class top-k hits, accumulated batch by batch with
+    bincount, so evaluation never keeps y_pred/y_true for the whole test set. Grows when larger labels show up.
+    '''
+
+    def __init__(self, nb_classes=0):
+        self.matrix = np.zeros((nb_classes, nb_classes), dtype=np.int64)
+        self.topk_hits = np.zeros(nb_classes, dtype=np.int64)
+
+    @property
+    def nb_classes(self):
+        return len(self.matrix)
+
+    def update(self, y_pred, y_true):
+        '''y_pred: [N, topk] ranked predictions (or [N] top-1), y_true: [N].'''
+        y_pred, y_true = np.asarray(y_pred, dtype=np.int64), np.asarray(y_true, dtype=np.int64)
+        if y_pred.ndim == 1:
+            y_pred = y_pred[:, None]
+        if len(y_true) == 0:
+            return
+        self._grow(max(y_pred.max(), y_true.max()) + 1)
+        nb_classes = self.nb_classes
+        self.matrix += np.bincount(y_true * nb_classes + y_pred[:, 0],
+                                   minlength=nb_classes * nb_classes).reshape(nb_classes, nb_classes)
+        self.topk_hits += np.bincount(y_true[(y_pred == y_true[:, None]).any(1)], minlength=nb_classes)
+
+    def count(self, classes=None):
+        counts = self.matrix.sum(1)
+        return counts.sum() if classes is None else counts[self._valid(classes)].sum()
+
+    def accuracy(self, classes=None):
+        '''Top-1 accuracy in percent over the samples whose true class is in classes (all by default).'''
+        correct = np.diag(self.matrix)
+        if classes is not None:
+            classes = self._valid(classes)
+            correct, total = correct[classes].sum(), self.matrix[classes].sum()
+        else:
+            correct, total = correct.sum(), self.matrix.sum()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.around(correct * 100 / total, decimals=2)
+
+    def topk_accuracy(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.around(self.topk_hits.sum() * 100 / self.matrix.sum(), decimals=2)
+
+    def mean_class_recall(self):
+        '''Mean over the classes present in the test set of their recall, as a fraction.'''
+        counts = self.matrix.sum(1)
+        present = counts > 0
+        return (np.diag(self.matrix)[present] / counts[present]).mean()
+
+    def grouped(self, nb_old, init_cls=0, increment=10):
+        '''Same dict as utils.toolkit.accuracy: total, init classes, every increment, old and new.'''
+        all_acc = {}
+        all_acc['total'] = self.accuracy()
+        max_class = np.flatnonzero(self.matrix.sum(1))[-1]
+
+        if init_cls != 0:
+            label = '{}-{}'.format(str(0).rjust(2, '0'), str(init_cls-1).rjust(2, '0'))
+            all_acc[label] = self.accuracy(range(0, init_cls))
+
+        # Grouped accuracy
+        for class_id in range(init_cls, max_class, increment):
+            label = '{}-{}'.format(str(class_id).rjust(2, '0'), str(class_id+increment-1).rjust(2, '0'))
+            all_acc[label] = self.accuracy(range(class_id, class_id + increment))
+
+        # Old and new accuracy
+        all_acc['old'] = 0 if self.count(range(nb_old)) == 0 else self.accuracy(range(nb_old))
+        all_acc['new'] = self.accuracy(range(nb_old, self.nb_classes))
+
+        return all_acc
+
+    def _valid(self, classes):
+        classes = np.asarray(classes, dtype=np.int64)
+        return classes[classes < self.nb_classes]
+
+    def _grow(self, nb_classes):
+        if nb_classes > self.nb_classes:
+            matrix = np.zeros((nb_classes, nb_classes), dtype=np.int64)
+            matrix[:self.nb_classes, :self.nb_classes] = self.matrix
+            topk_hits = np.zeros(nb_classes, dtype=np.int64)
+            topk_hits[:self.nb_classes] = self.topk_hits
+            self.matrix, self.topk_hits = matrix, topk_hits
+
+
+class TaskAccuracyMatrix(object):
+    '''
+    acc[t, j]: accuracy on the classes of task j after learning task t, filled from one confusion matrix per
+    evaluation. Forgetting and backward transfer follow Chaudhry et al. and Lopez-Paz & Ranzato.
+    '''
+
+    def __init__(self):
+        self._bounds = [0]  # task j covers classes [bounds[j], bounds[j+1])
+        self._rows = []
+
+    @property
+    def matrix(self):
+        acc = np.full((len(self._rows), len(self._rows)), np.nan)
+        for t, row in enumerate(self._rows):
+            acc[t, :len(row)] = row
+        return acc
+
+    def update(self, confusion, nb_classes):
+        '''Record the accuracy on every task seen so far, now that nb_classes classes have been learned.'''
+        if nb_classes > self._bounds[-1]:
+            self._bounds.append(nb_classes)
+        row = [confusion.accuracy(range(start, end)) for start, end in zip(self._bounds[:-1], self._bounds[1:])]
+        if len(self._rows) == len(self._bounds) - 1:
+            self._rows[-1] = row  # Re-evaluation of the current task
+        else:
+            self._rows.append(row)
+
+    def forgetting(self):
+        '''Mean over old tasks of the best accuracy they ever had minus their current accuracy.'''
+        if len(self._rows) < 2:
+            return 0.
+        acc = self.matrix
+        return np.around(np.mean(np.nanmax(acc[:-1, :-1], axis=0) - acc[-1, :-1]), decimals=2)
+
+    def backward_transfer(self):
+        '''Mean over old tasks of their current accuracy minus the accuracy right after learning them.'''
+        if len(self._rows) < 2:
+            return 0.
+        acc = self.matrix
+        return np.around(np.mean(acc[-1, :-1] - np.diag(acc)[:-1]), decimals=2)
+
+
+def weighted_task_average(task_accs, init_cls, increment):
+    '''Running average of per-task accuracies, each task weighted by its number of classes.'''
+    class_each_step = np.array([init_cls] + [increment] * (len(task_accs) - 1))
+    task_accs = np.array(task_accs)
+    weighted_accs = []
+    for i in range(len(task_accs)):
+        temp_acc = class_each_step[:i+1] / sum(class_each_step[:i+1])
+        weighted_accs.append(round(sum(task_accs[:i+1] * temp_acc), 2))
+
+    return weighted_accs
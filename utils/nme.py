@@ -0,0 +1,48 @@
+import numpy as np
+import torch
+
+
+class NMEClassifier(object):
+    '''
+    Nearest-mean-of-exemplars classification with the class means kept on device as float32 banks.
+    ||m - v||^2 = ||m||^2 - 2 m.v + ||v||^2, and ||v||^2 does not change the ranking of a sample, so scoring is a
+    matrix multiply over fixed-size chunks of features followed by top-k. A bank (e.g. 'class_means') is
+    updated incrementally: only rows that differ from the last uploaded means are copied to the device.
+    '''
+
+    def __init__(self, device=None, chunk_size=8192):
+        self._device = device
+        self._chunk_size = chunk_size
+        self._banks = {}  # name -> (host copy [C, d], device means [C, d], squared norms [C])
+
+    def update(self, name, class_means):
+        class_means = np.asarray(class_means, dtype=np.float32)
+        host, means, _ = self._banks.get(name, (None, None, None))
+        if host is None or host.shape[1:] != class_means.shape[1:]:
+            means = torch.from_numpy(class_means).to(self._device)
+        else:
+            nb_kept = min(len(host), len(class_means))
+            changed = np.flatnonzero(np.any(host[:nb_kept] != class_means[:nb_kept], axis=1))
+            means = means[:nb_kept]
+            if len(changed) > 0:
+                means[torch.from_numpy(changed).to(self._device)] = torch.from_numpy(class_means[changed]).to(
+                    self._device)
+            if len(class_means) > nb_kept:
+                means = torch.cat((means, torch.from_numpy(class_means[nb_kept:]).to(self._device)))
+        self._banks[name] = (class_means.copy(), means, (means ** 2).sum(1))
+
+    def predict(self, name, vectors, topk):
+        '''Indices of the topk nearest means of every row of vectors, nearest first: [N, topk].'''
+        _, means, sq_norms = self._banks[name]
+        topk = min(topk, len(means))
+        preds = []
+        with torch.no_grad():
+            for start in range(0, len(vectors), self._chunk_size):
+                chunk = torch.as_tensor(vectors[start:start+self._chunk_size], dtype=torch.float32,
+                                        device=self._device)
+                scores = 2 * chunk @ means.T - sq_norms  # larger is nearer
+                preds.append(scores.topk(topk, dim=1)[1].cpu().numpy())
+        if len(preds) == 0:
+            return np.zeros((0, topk), dtype=np.int64)
+
+        return np.concatenate(preds)
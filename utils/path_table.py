@@ -0,0 +1,64 @@
+import os
+import numpy as np
+
+
+class PathTable(object):
+    '''
+    Compact list of file paths: every path is a root (shared by a whole batch of paths) plus a relative part,
+    all relative parts living in one utf-8 byte blob. Datasets and exemplar memory hold integer file ids instead
+    of fixed-width unicode arrays, so slicing them and shipping them to workers costs 8 bytes per sample.
+    '''
+
+    def __init__(self, paths=()):
+        self.roots = []
+        self.root_ids = np.zeros(0, dtype=np.int16)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.blob = np.zeros(0, dtype=np.uint8)
+        if len(paths) > 0:
+            self.append(paths)
+
+    def __len__(self):
+        return len(self.root_ids)
+
+    def __getitem__(self, file_id):
+        start, end = self.offsets[file_id], self.offsets[file_id+1]
+        return self.roots[self.root_ids[file_id]] + self.blob[start:end].tobytes().decode('utf-8')
+
+    def nbytes(self):
+        return self.root_ids.nbytes + self.offsets.nbytes + self.blob.nbytes
+
+    def append(self, paths):
+        '''Add paths and return their file ids.'''
+        paths = [str(path) for path in paths]
+        if len(paths) == 0:
+            return np.zeros(0, dtype=np.int64)
+        prefix = os.path.commonprefix(paths)
+        root = prefix[:prefix.rfind(os.sep)+1]
+        if root not in self.roots:
+            self.roots.append(root)
+        encoded = [path[len(root):].encode('utf-8') for path in paths]
+
+        file_ids = np.arange(len(self), len(self) + len(paths))
+        lengths = np.fromiter((len(e) for e in encoded), dtype=np.int64, count=len(encoded))
+        self.root_ids = np.concatenate((self.root_ids, np.full(len(paths), self.roots.index(root), dtype=np.int16)))
+        self.offsets = np.concatenate((self.offsets, self.offsets[-1] + np.cumsum(lengths)))
+        self.blob = np.concatenate((self.blob, np.frombuffer(b''.join(encoded), dtype=np.uint8)))
+        return file_ids
+
+
+class IdLoader(object):
+    '''
+    file id -> PIL.Image. Ids covered by the optional ImageCache (cache_rows maps ids to cache rows, -1 when
+    missing) are served from it, the others are resolved through the table and opened with loader.
+    '''
+
+    def __init__(self, table, loader, cache=None, cache_rows=None):
+        self.table = table
+        self.loader = loader
+        self.cache = cache
+        self.cache_rows = cache_rows
+
+    def __call__(self, file_id):
+        if self.cache is not None and file_id < len(self.cache_rows) and self.cache_rows[file_id] >= 0:
+            return self.cache.load(self.cache_rows[file_id])
+        return self.loader(self.table[file_id])
@@ -0,0 +1,105 @@
+import os
+import sys
+import threading
+import weakref
+from collections import OrderedDict
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+# Segments this process has attached to recently, by name, so every unpickled array reuses one mapping. Only the
+# last _max_attached are remembered: a mapping is closed once no array uses it, so segments shipped with batches
+# (see PooledLoader) do not stay mapped in long-lived workers
+_attached = OrderedDict()
+_max_attached = 32
+# Guards _attached, and the resource tracker while attaching on Python < 3.13
+_lock = threading.Lock()
+
+
+class SharedNDArray(np.ndarray):
+    '''
+    ndarray whose buffer lives in POSIX shared memory. It pickles by segment name, so DataLoader workers (and any
+    other process) attach to the same pages instead of receiving a copy. Views keep that property; results of
+    fancy indexing are ordinary private copies and pickle as plain ndarrays.
+    '''
+
+    def __array_finalize__(self, obj):
+        self._shm = getattr(obj, '_shm', None)
+
+    def __reduce__(self):
+        offset = self._offset()
+        if offset is not None:
+            return _attach, (self._shm.name, self.shape, self.dtype.str, offset, self.strides)
+        return self.view(np.ndarray).__reduce__()
+
+    def _offset(self):
+        # Offset of the data in the segment, None for private copies (e.g. results of fancy indexing)
+        shm = self._shm
+        if shm is None:
+            return None
+        base = np.frombuffer(shm.buf, dtype=np.uint8).__array_interface__['data'][0]
+        offset = self.__array_interface__['data'][0] - base
+        if 0 <= offset < shm.size or self.size == 0:
+            return max(offset, 0)
+        return None
+
+
+def is_shared(array):
+    '''Whether array pickles by segment name rather than by value.'''
+    return isinstance(array, SharedNDArray) and array._offset() is not None
+
+
+def to_shared(array):
+    '''
+    Copy array into a new shared memory segment owned by the calling process; the segment is unlinked when the
+    returned array (and every view of it) is garbage collected or the process exits.
+    '''
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf).view(SharedNDArray)
+    shared[...] = array
+    shared._shm = shm
+    weakref.finalize(shm, _unlink, shm.name, os.getpid())
+    return shared
+
+
+def _attach(name, shape, dtype, offset, strides):
+    with _lock:
+        shm = _attached.get(name)
+        if shm is not None:
+            _attached.move_to_end(name)
+        else:
+            shm = _open_untracked(name)
+            _attached[name] = shm
+            if len(_attached) > _max_attached:
+                _attached.popitem(last=False)
+    array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset, strides=strides)
+    array = array.view(SharedNDArray)
+    array._shm = shm
+    return array
+
+
+def _open_untracked(name):
+    # Attach without registering with the resource tracker, which is shared with the creator and would then lose track
+    # of (or unlink) the creator's segment. Before Python 3.13 registering cannot be turned off, it is skipped for this
+    # call only, under _lock
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, create=False, track=False)
+    register = resource_tracker.register
+    resource_tracker.register = lambda *args: None
+    try:
+        return shared_memory.SharedMemory(name=name, create=False)
+    finally:
+        resource_tracker.register = register
+
+
+def _unlink(name, owner_pid):
+    # Forked children inherit the finalizer, only the creating process removes the segment. unlink() also drops the
+    # registration the creation made with the resource tracker
+    if os.getpid() != owner_pid:
+        return
+    try:
+        shm = shared_memory.SharedMemory(name=name, create=False)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
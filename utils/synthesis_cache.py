@@ -0,0 +1,58 @@
+import hashlib
+import os
+import tempfile
+import numpy as np
+import torch
+
+
+class SynthesisCache(object):
+    '''
+    Content-addressed on-disk store of synthesized batches, shared by runs. An entry is keyed by a hash of
+    everything the synthesis depends on (network weights and BN statistics, target images, inverter
+    hyperparameters and seed, see key()), so a rerun or a resumed crashed run finds the batches it would synthesize
+    again. Entries are float32 .npy files sharded in 256 subdirectories by the first byte of their key, and are
+    written to a temporary file then renamed: a crashed run leaves complete entries only.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def model_digest(model):
+        '''Hash of the parameters and buffers of model.'''
+        digest = hashlib.sha1()
+        for name, value in model.state_dict().items():
+            digest.update(name.encode())
+            digest.update(value.detach().cpu().contiguous().numpy().tobytes())
+        return digest.hexdigest()
+
+    @staticmethod
+    def key(model_digest, targets, inverter, seed):
+        digest = hashlib.sha1(model_digest.encode())
+        digest.update(repr(sorted(vars(inverter).items())).encode())
+        digest.update(repr(seed).encode())
+        digest.update(repr(tuple(targets.shape)).encode())
+        digest.update(targets.detach().cpu().contiguous().numpy().tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        '''Cached [B, C, H, W] batch of key, None if absent.'''
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        return torch.from_numpy(np.load(path))
+
+    def put(self, key, images):
+        path = self._path(key)
+        shard = os.path.dirname(path)
+        if not os.path.exists(shard):
+            os.makedirs(shard, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=shard)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, images.detach().cpu().numpy().astype(np.float32))
+        os.replace(tmp_path, path)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.npy')
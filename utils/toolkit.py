@@ -1,7 +1,7 @@
 import os
 import numpy as np
 import torch
-from sklearn.metrics import confusion_matrix
+from utils.metrics import ConfusionMatrix
 
 def count_parameters(model, trainable=False):
     if trainable:
@@ -26,31 +26,10 @@ def makedirs(path):
 
 def accuracy(y_pred, y_true, nb_old, init_cls=0, increment=10):
     assert len(y_pred) == len(y_true), 'Data length error.'
-    all_acc = {}
-    all_acc['total'] = np.around((y_pred == y_true).sum()*100 / len(y_true), decimals=2)
+    confusion = ConfusionMatrix()
+    confusion.update(y_pred, y_true)
 
-
-    if init_cls != 0:
-        idxes = np.where(np.logical_and(y_true >= 0, y_true < init_cls))[0]
-        label = '{}-{}'.format(str(0).rjust(2, '0'), str(init_cls-1).rjust(2, '0'))
-        all_acc[label] = np.around((y_pred[idxes] == y_true[idxes]).sum()*100 / len(idxes), decimals=2)
-
-    # Grouped accuracy
-    for class_id in range(init_cls, np.max(y_true), increment):
-        idxes = np.where(np.logical_and(y_true >= class_id, y_true < class_id + increment))[0]
-        label = '{}-{}'.format(str(class_id).rjust(2, '0'), str(class_id+increment-1).rjust(2, '0'))
-        all_acc[label] = np.around((y_pred[idxes] == y_true[idxes]).sum()*100 / len(idxes), decimals=2)
-
-    # Old accuracy
-    idxes = np.where(y_true < nb_old)[0]
-    all_acc['old'] = 0 if len(idxes) == 0 else np.around((y_pred[idxes] == y_true[idxes]).sum()*100 / len(idxes),
-                                                         decimals=2)
-
-    # New accuracy
-    idxes = np.where(y_true >= nb_old)[0]
-    all_acc['new'] = np.around((y_pred[idxes] == y_true[idxes]).sum()*100 / len(idxes), decimals=2)
-
-    return all_acc
+    return confusion.grouped(nb_old, init_cls, increment)
 
 
 def split_images_labels(imgs):
@@ -65,8 +44,6 @@ def split_images_labels(imgs):
 
 def calculate_mean_class_recall(y_true, y_pred):
     """ Calculate the mean class recall for the dataset X """
-    cm = confusion_matrix(y_true, y_pred)
-    right_of_class = np.diag(cm)
-    num_of_class = cm.sum(axis=1)
-    mcr = (right_of_class / num_of_class).mean()
-    return mcr
\ No newline at end of file
+    confusion = ConfusionMatrix()
+    confusion.update(y_pred, y_true)
+    return confusion.mean_class_recall()